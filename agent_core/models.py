@@ -32,6 +32,8 @@ class EvaluationTask(models.Model):
     version = models.CharField(max_length=50, help_text="e.g. 3.2", null=True)
     base_commit = models.CharField(max_length=100, help_text="Git SHA", null=True)
 
+    workspace_placement = models.JSONField(default=dict, blank=True, help_text="Storage tier the workspace was placed on, and tier hit rates.")
+
     def __str__(self):
         return f"Task: {self.nocode_bench_id} - {self.status}"
 
@@ -50,6 +52,7 @@ class EvaluationAttempt(models.Model):
     raw_response = models.TextField(help_text="Original response from LLM")
     generated_patch = models.TextField(help_text="The git diff generated in this attempt")
     test_output = models.TextField(help_text="Pytest output logs")
+    model_name = models.CharField(max_length=100, blank=True, default='', help_text="Coder model of this attempt (cascade history).")
     
     timestamp = models.DateTimeField(auto_now_add=True)
 
@@ -1,24 +1,91 @@
 # agent_core/tasks.py
 import logging
-import shutil
 import os
 import subprocess
 from celery import shared_task
 from django.utils import timezone
 from django.db import connection
 from django.conf import settings
-from google import generativeai as genai
+from google.generativeai.types import GenerationConfig
 
 from .models import EvaluationTask, EvaluationResult, EvaluationAttempt
 
 # Import new utilities
-from .utils.workspace import setup_workspace, setup_custom_workspace, get_file_contexts, onerror
-from .utils.llm_client import get_relevant_files, build_prompt_for_attempt, parse_llm_response,generate_with_retry
-from .utils.docker_runner import run_tests_in_docker
+from .utils.workspace import setup_custom_workspace, get_file_contexts, read_workspace_file, write_workspace_file, reset_workspace, workspace_diff, mark_workspace_owner, workspace_placement
+from .utils.workspace_pool import lease_workspace, release_workspace
+from .utils.reclaimer import discard_workspace, reap_orphaned_workspaces
+from .utils.llm_client import get_relevant_files, build_prompt_parts, parse_llm_response,generate_with_retry, generate_parallel_edits, with_cached_prefix
+from .utils.llm_pool import get_model
+from .utils.import_graph import expand_related_files
+from .utils.edit_blocks import apply_file_edit
+from .utils.docker_runner import run_tests_in_docker, reap_runner_containers
 from .utils.metrics import calculate_all_metrics
+from .utils.candidates import race_candidates, best_candidate
+from .utils.model_cascade import plan_cascade
+from .utils.log_condenser import condense_attempt
 
 logger = logging.getLogger(__name__)
 
+def _syntax_error(file_path, content):
+    """Cheap check run on each file as it arrives from the stream, before the Docker run."""
+    if not file_path.endswith('.py'): return None
+    try:
+        compile(content, file_path, 'exec')
+    except SyntaxError as e:
+        return f"{file_path}:{e.lineno}: {e.msg}"
+    return None
+
+def _apply_report(apply_errors):
+    return ("EDITS NOT APPLIED:\n" + "\n".join(apply_errors) + "\n\n") if apply_errors else ""
+
+def _find_relevant_files(doc_change, workspace_path):
+    """Retrieval cascade: a stronger model is only asked when the cheaper one finds nothing."""
+    for model_name in plan_cascade('retrieval', None):
+        relevant_files = get_relevant_files(get_model(model_name, api_key=settings.GEMINI_API_KEY), doc_change, workspace_path)
+        if relevant_files: return relevant_files
+        logger.info(f"{model_name} found no relevant files, escalating")
+    return []
+
+def _race_candidates(task, model, model_name, prompt_parts, workspace_path, count, attempt_num):
+    """
+    Sample `count` responses at once and test their distinct patches in parallel
+    containers. Returns the best candidate; the others that were tested are
+    recorded as attempts here.
+    """
+    safe_p2p_names = list(set([t.split('[')[0] for t in task.p2p_test_names]))
+    config = GenerationConfig(temperature=settings.LLM_CANDIDATE_TEMPERATURE)
+    prompt_text = "".join(prompt_parts)
+    # all candidates share the prefix: registered as cached content once
+    sample_model, sample_prompt = with_cached_prefix(model, *prompt_parts, reused=count > 1)
+
+    def sample(index):
+        # uncached: identical prompts must still give independent samples
+        return generate_with_retry(sample_model, sample_prompt, config, use_cache=False).text
+
+    def test(candidate, cancel):
+        return run_tests_in_docker(
+            str(task.id), task.repo, task.version, task.base_commit,
+            candidate.patch, task.feature_test_patch,
+            task.f2p_test_names,
+            safe_p2p_names,
+            cancel=cancel, candidate=candidate.index
+        )
+
+    candidates = race_candidates(workspace_path, count, sample, test)
+    best = best_candidate(candidates)
+    for candidate in candidates:
+        note = f" (same patch as {candidate.duplicate_of})" if candidate.status == 'DUPLICATE' else ""
+        logger.info(f"[Task {task.id}] Candidate {candidate.index}: {candidate.status}{note}")
+        if candidate is not best and candidate.status in ('TEST_FAILED', 'APPLY_FAILED'):
+            EvaluationAttempt.objects.create(
+                task=task, attempt_number=attempt_num, status=candidate.status,
+                prompt_text=prompt_text, raw_response=candidate.raw_response,
+                generated_patch=candidate.patch,
+                test_output=_apply_report(candidate.apply_errors) + candidate.test_output,
+                model_name=model_name
+            )
+    return best
+
 @shared_task(bind=True)
 def process_evaluation_task(self, task_id):
     MAX_ATTEMPTS = 1
@@ -44,110 +111,162 @@ def process_evaluation_task(self, task_id):
         logger.info(f"Starting task {task.id} for '{workspace_id_to_use}'")
 
         if not settings.GEMINI_API_KEY: raise Exception("Gemini client not configured.")
-        genai.configure(api_key=settings.GEMINI_API_KEY)
         
 
-        # 1. file retrieval setup
-        search_model = genai.GenerativeModel('gemini-2.5-flash')
-        # 2. use coder model for generation
-        coder_model = genai.GenerativeModel('gemini-2.5-pro') 
+        # coder models, cheapest first (models are long-lived, shared by all tasks of this worker);
+        # cheap models that keep failing on this repo are skipped
+        coder_models = plan_cascade('coder', task.repo)
         
-        workspace_path = setup_workspace(workspace_id_to_use)
+        workspace_path = lease_workspace(workspace_id_to_use, task.base_commit, owner=task.id)
+        # saved with the final status, to size the tmpfs tier
+        task.workspace_placement = workspace_placement(workspace_path)
         
-        # use Flash to find relevant files
-        logger.info(f"[Task {task.id}] Finding files using Flash model...")
-        relevant_files = get_relevant_files(search_model, task.doc_change_input, workspace_path)
+        # 1. file retrieval, cheapest model first
+        logger.info(f"[Task {task.id}] Finding files...")
+        relevant_files = _find_relevant_files(task.doc_change_input, workspace_path)
         
         if not relevant_files: raise Exception("AI failed to identify relevant files.")
+
+        # add direct imports / importers / package __init__ of the selected files (no extra LLM call)
+        relevant_files = expand_related_files(workspace_path, relevant_files, settings.RETRIEVAL_NEIGHBOURS)
         
         # fetch file contents
-        # limit to 200,000 chars
-        context_content_str = get_file_contexts(workspace_path, relevant_files, max_chars=200000)
+        # packed into settings.CONTEXT_TOKEN_BUDGET tokens, big files sliced around the doc change
+        context_content_str = get_file_contexts(workspace_path, relevant_files, query=task.doc_change_input)
         
         if not context_content_str: raise Exception("Relevant files could not be read.")
 
         history = []
+        previous_patch = None
+        candidate_count = int(settings.LLM_CANDIDATES)
         f2p_passed_count = f2p_total_count = p2p_passed_count = p2p_total_count = 0
         regression_tests_passed = False
 
-        # 2. Attempt Loop
-        for i in range(MAX_ATTEMPTS):
+        # 2. Attempt Loop: a failed attempt escalates to the next model of the cascade,
+        # the strongest one gets MAX_ATTEMPTS
+        for i in range(MAX_ATTEMPTS + len(coder_models) - 1):
             attempt_num = i + 1
-            prompt_text = build_prompt_for_attempt(task.doc_change_input, context_content_str, history)
+            model_name = coder_models[min(i, len(coder_models) - 1)]
+            can_escalate = i < len(coder_models) - 1
+            coder_model = get_model(model_name, api_key=settings.GEMINI_API_KEY)
+            logger.info(f"[Task {task.id}] Attempt {attempt_num} with {model_name}")
+            # the prefix (instructions + files) is the same for every attempt; history goes in the suffix
+            prompt_parts = build_prompt_parts(task.doc_change_input, context_content_str, history)
+            prompt_text = "".join(prompt_parts)
             
-            # --- Logic formerly in services.run_agent_attempt ---
-            try:
-                response = generate_with_retry(coder_model, prompt_text)
-                raw_response = response.text
-            except Exception as e:
-                # if all retries fail
-                logger.error(f"LLM Generation failed after retries: {e}")
-                final_status = 'FAILED'
-                break
+            if candidate_count > 1:
+                # N samples generated, deduplicated and tested in parallel containers; the first passing one wins
+                best = _race_candidates(task, coder_model, model_name, prompt_parts, workspace_path, candidate_count, attempt_num)
+                if best is None:
+                    logger.error(f"[Task {task.id}] No candidate produced a response")
+                    final_status = 'FAILED'
+                    # the stronger model may still answer
+                    if can_escalate: continue
+                    break
+                status_code, raw_response, final_patch = best.status, best.raw_response, best.patch
+                test_output = _apply_report(best.apply_errors) + best.test_output
+                if best.results:
+                    f2p_passed_count, f2p_total_count, p2p_passed_count, p2p_total_count = best.results
+                    regression_tests_passed = (p2p_passed_count == p2p_total_count) if p2p_total_count > 0 else True
+            else:
+                # --- Logic formerly in services.run_agent_attempt ---
+                reset_workspace(workspace_path)
+                applied, apply_errors, syntax_errors = {}, [], []
+
+                def apply_file(file_path, new_content):
+                    # called as soon as a file's block closes in the response stream
+                    if '..' in file_path or file_path in applied: return
+                    applied[file_path] = new_content
+                    original = read_workspace_file(workspace_path, file_path) or ''
+                    # SEARCH/REPLACE hunks, or a full file whose ELIDED markers are restored
+                    new_content, failures = apply_file_edit(original, new_content)
+                    apply_errors.extend(f"{file_path}: {failure}" for failure in failures)
+                    if new_content == original: return
+                    # writes with LF endings and never in place,
+                    # since workspace files may be hardlinks into the snapshot
+                    write_workspace_file(workspace_path, file_path, new_content)
+                    error = _syntax_error(file_path, new_content)
+                    if error:
+                        logger.warning(f"[Task {task.id}] Generated file does not compile: {error}")
+                        syntax_errors.append(error)
 
-            modified_files = parse_llm_response(raw_response)
+                try:
+                    response = None
+                    if settings.LLM_PARALLEL_EDITS and len(relevant_files) > 1:
+                        # plan once, then one concurrent call per file (None: single-file plan, or no file came back)
+                        response = generate_parallel_edits(coder_model, task.doc_change_input, context_content_str, history)
+                    if response is None:
+                        # from the second attempt on the prefix is sent again, then caching it pays off
+                        response = generate_with_retry(*with_cached_prefix(coder_model, *prompt_parts, reused=i > 0), on_file=apply_file)
+                    raw_response = response.text
+                except Exception as e:
+                    # if all retries fail
+                    logger.error(f"LLM Generation failed after retries with {model_name}: {e}")
+                    final_status = 'FAILED'
+                    # the stronger model may still answer; only the last one failing fails the task
+                    if can_escalate: continue
+                    break
+
+                modified_files = {p: c for p, c in parse_llm_response(raw_response).items() if '..' not in p}
             
-            # Apply Changes
-            if modified_files:
-                subprocess.run(['git', 'reset', '--hard', 'HEAD'], cwd=workspace_path, capture_output=True)
-                for file_path, new_content in modified_files.items():
-                    if '..' in file_path: continue
-                    full_path = os.path.join(workspace_path, file_path)
-                    os.makedirs(os.path.dirname(full_path), exist_ok=True)
-                    
-                    # added newline='\n' to prevent CRLF on Windows
-                    # new line to ensure content itself does not contain CRLF (double safety)
-                    with open(full_path, 'w', encoding='utf-8', newline='\n') as f: 
-                        # write content with LF 
-                        f.write(new_content.replace('\r\n', '\n'))
-                
-                # Get Git Diff
-                diff_res = subprocess.run(
-                    ['git', 'diff'], 
-                    cwd=workspace_path, 
-                    capture_output=True, 
-                    text=True, 
-                    encoding='utf-8'
-                )
+                # Apply Changes
+                if modified_files:
+                    if applied != modified_files:
+                        # a retried stream (or a response that was not streamed): apply the final text
+                        reset_workspace(workspace_path)
+                        applied.clear()
+                        apply_errors.clear()
+                        syntax_errors.clear()
+                        for file_path, new_content in modified_files.items():
+                            apply_file(file_path, new_content)
                 
-                # final_patch with LF endings
-                final_patch = diff_res.stdout.replace('\r\n', '\n')
+                    # Get Git Diff (final_patch with LF endings)
+                    final_patch = workspace_diff(workspace_path)
                 
-                status_code = 'PASSED'
-            else:
-                status_code = 'APPLY_FAILED'
-                final_patch = ""
+                    # every hunk missed: nothing to test
+                    status_code = 'APPLY_FAILED' if apply_errors and not final_patch.strip() else 'PASSED'
+                else:
+                    status_code = 'APPLY_FAILED'
+                    final_patch = ""
 
-            test_output = ""
-            if status_code != 'APPLY_FAILED' and final_patch.strip():
+                if apply_errors:
+                    logger.warning(f"[Task {task.id}] {len(apply_errors)} edit hunks not applied")
+                test_output = _apply_report(apply_errors)
+                if status_code != 'APPLY_FAILED' and syntax_errors and can_escalate:
+                    # host-side validation failed: no container run, go straight to the stronger model
+                    status_code = 'TEST_FAILED'
+                    test_output += "GENERATED FILES DO NOT COMPILE:\n" + "\n".join(syntax_errors) + "\n"
+                elif status_code != 'APPLY_FAILED' and final_patch.strip():
                 
-                safe_p2p_names = list(set([t.split('[')[0] for t in task.p2p_test_names]))
+                    safe_p2p_names = list(set([t.split('[')[0] for t in task.p2p_test_names]))
                 
-                # Run Docker Tests
-                f2p_p, f2p_t, p2p_p, p2p_t, test_output = run_tests_in_docker(
-                    str(task.id), task.repo, task.version, task.base_commit,
-                    final_patch, task.feature_test_patch, 
-                    task.f2p_test_names, 
-                    safe_p2p_names
-                )
-
-                f2p_passed_count, f2p_total_count = f2p_p, f2p_t
-                p2p_passed_count, p2p_total_count = p2p_p, p2p_t
+                    # Run Docker Tests
+                    f2p_p, f2p_t, p2p_p, p2p_t, docker_output = run_tests_in_docker(
+                        str(task.id), task.repo, task.version, task.base_commit,
+                        final_patch, task.feature_test_patch, 
+                        task.f2p_test_names, 
+                        safe_p2p_names
+                    )
+                    test_output += docker_output
+
+                    f2p_passed_count, f2p_total_count = f2p_p, f2p_t
+                    p2p_passed_count, p2p_total_count = p2p_p, p2p_t
                 
-                ft_pass = (f2p_p == f2p_t) if f2p_t > 0 else False
-                rt_pass = (p2p_p == p2p_t) if p2p_t > 0 else True
-                regression_tests_passed = rt_pass
+                    ft_pass = (f2p_p == f2p_t) if f2p_t > 0 else False
+                    rt_pass = (p2p_p == p2p_t) if p2p_t > 0 else True
+                    regression_tests_passed = rt_pass
                 
-                if ft_pass and rt_pass: 
-                    status_code = 'PASSED'
-                else: 
-                    status_code = 'TEST_FAILED'
-            # ----------------------------------------------------
+                    if ft_pass and rt_pass: 
+                        status_code = 'PASSED'
+                    else: 
+                        status_code = 'TEST_FAILED'
+                # ----------------------------------------------------
 
             EvaluationAttempt.objects.create(
                 task=task, attempt_number=attempt_num, status=status_code,
                 prompt_text=prompt_text, raw_response=raw_response,
-                generated_patch=final_patch, test_output=test_output
+                generated_patch=final_patch, test_output=test_output,
+                model_name=model_name
             )
             
             applied_successfully = (status_code != 'APPLY_FAILED')
@@ -156,10 +275,13 @@ def process_evaluation_task(self, task_id):
                 break
             elif status_code == 'APPLY_FAILED':
                 final_status = 'FAILED_APPLY'
-                break
+                # unusable output: worth asking a stronger model, not the same one again
+                if not can_escalate: break
             else:
                 final_status = 'FAILED_TEST'
-                history.append(f"ATTEMPT {attempt_num} FAILED.\nPATCH:\n{final_patch}\nERRORS:\n{test_output}")
+                # failing tests, exceptions and frames in the edited files, not the whole log
+                history.append(condense_attempt(attempt_num, final_patch, test_output, previous_patch))
+                previous_patch = final_patch
 
         # 3. Metrics & Save
         run_time = (timezone.now() - task.start_time).total_seconds()
@@ -183,8 +305,9 @@ def process_evaluation_task(self, task_id):
             task.save()
     finally:
         connection.close()
-        if workspace_path and os.path.exists(workspace_path):
-            shutil.rmtree(workspace_path, onerror=onerror)
+        if workspace_path:
+            # back to the pool (scoped reset), or deleted if the pool is full
+            release_workspace(workspace_path)
 
 @shared_task(bind=True)
 def process_custom_demo_task(self, task_id):
@@ -197,22 +320,40 @@ def process_custom_demo_task(self, task_id):
         task.save()
 
         if not settings.GEMINI_API_KEY: raise Exception("No Gemini Key")
-        genai.configure(api_key=settings.GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.5-pro')
 
         # Parse custom ID
         github_url = task.nocode_bench_id.replace("custom_", "", 1).split('#')[0]
         
         workspace_path = setup_custom_workspace(github_url)
-        relevant_files = get_relevant_files(model, task.doc_change_input, workspace_path)
-        context_content_str = get_file_contexts(workspace_path, relevant_files)
+        mark_workspace_owner(workspace_path, task.id)
+        relevant_files = _find_relevant_files(task.doc_change_input, workspace_path)
+        context_content_str = get_file_contexts(workspace_path, relevant_files, query=task.doc_change_input)
         
-        prompt = build_prompt_for_attempt(task.doc_change_input, context_content_str, [])
+        prompt_parts = build_prompt_parts(task.doc_change_input, context_content_str, [])
         
         # Simple Agent Run (No Docker)
-        response = model.generate_content(prompt)
+        # 1. Apply Changes (each file as soon as it is complete in the stream)
+        applied, originals = {}, {}
+
+        def apply_file(file_path, new_content):
+            if '..' in file_path or applied.get(file_path) == new_content: return
+            applied[file_path] = new_content
+            # hunks / ELIDED markers refer to the original file, even if a retried stream already rewrote it
+            if file_path not in originals:
+                originals[file_path] = read_workspace_file(workspace_path, file_path) or ''
+            new_content, failures = apply_file_edit(originals[file_path], new_content)
+            for failure in failures: logger.warning(f"Demo Task {task_id}: {file_path}: {failure}")
+            full_path = os.path.join(workspace_path, file_path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'w', encoding='utf-8') as f: f.write(new_content)
+
+        # cheapest coder model first; escalate while the response holds no usable file
+        for model_name in plan_cascade('coder', None):
+            model = get_model(model_name, api_key=settings.GEMINI_API_KEY)
+            response = generate_with_retry(model, "".join(prompt_parts), on_file=apply_file)
+            if applied or parse_llm_response(response.text): break
+            logger.info(f"Demo Task {task_id}: {model_name} returned no files, escalating")
         
-        # 1. Apply Changes
         token_count = 0
         if response.usage_metadata:
             token_count = response.usage_metadata.total_token_count
@@ -222,11 +363,10 @@ def process_custom_demo_task(self, task_id):
         final_patch = ""
         if modified_files:
             for file_path, new_content in modified_files.items():
-                if '..' in file_path: continue
-                full_path = os.path.join(workspace_path, file_path)
-                os.makedirs(os.path.dirname(full_path), exist_ok=True)
-                with open(full_path, 'w', encoding='utf-8') as f: f.write(new_content)
+                apply_file(file_path, new_content)
             
+            # intent-to-add, so files the model created are in the diff too
+            subprocess.run(['git', 'add', '-N', '--'] + sorted(applied), cwd=workspace_path, capture_output=True)
             res = subprocess.run(['git', 'diff', '--no-prefix'], cwd=workspace_path, capture_output=True, text=True, encoding='utf-8')
             final_patch = res.stdout
             task.status = 'COMPLETED'
@@ -259,4 +399,23 @@ def process_custom_demo_task(self, task_id):
             task.save()
     finally:
         connection.close()
-        if workspace_path: shutil.rmtree(workspace_path, onerror=onerror)
\ No newline at end of file
+        # deleted in the background so the worker slot is freed right away
+        if workspace_path: discard_workspace(workspace_path)
+
+@shared_task
+def reap_orphaned_resources():
+    """
+    Periodic cleanup (see CELERY_BEAT_SCHEDULE) of workspaces and runner_*
+    containers leaked by workers that crashed before their `finally` ran.
+    """
+    try:
+        running = {str(pk) for pk in EvaluationTask.objects.filter(status='RUNNING').values_list('id', flat=True)}
+        is_running = lambda task_id: str(task_id) in running
+
+        workspaces = reap_orphaned_workspaces(is_running, stale_seconds=settings.WORKSPACE_STALE_SECONDS)
+        containers = reap_runner_containers(is_running)
+        if workspaces or containers:
+            logger.info(f"Reaper: reclaimed {len(workspaces)} workspaces and {len(containers)} containers")
+        return {'workspaces': len(workspaces), 'containers': len(containers)}
+    finally:
+        connection.close()
@@ -2,6 +2,7 @@ import pytest
 import tempfile
 import shutil
 import os # 新增 os
+import subprocess
 from unittest.mock import patch, MagicMock
 from rest_framework.test import APIClient
 from django.urls import reverse
@@ -12,6 +13,25 @@ from agent_core.models import EvaluationTask, EvaluationResult
 from agent_core.tasks import process_evaluation_task
 # 新增匯入 parse_llm_response 以便單獨測試它
 from agent_core.utils.llm_client import parse_llm_response, get_relevant_files
+from agent_core.utils.storage_tiers import TierPlacer, parse_tiers
+
+
+def git(*args, cwd):
+    return subprocess.run(['git', '-c', 'user.email=t@t', '-c', 'user.name=t', *args],
+                          cwd=cwd, capture_output=True, text=True, check=True).stdout
+
+
+def _make_source_repo(source):
+    """Create a dataset-style git clone with two commits; returns the first one."""
+    os.makedirs(os.path.join(source, 'pkg'))
+    git('init', '-q', cwd=source)
+    with open(os.path.join(source, 'pkg', 'mod.py'), 'w') as f: f.write("x = 1\n")
+    git('add', '.', cwd=source)
+    git('commit', '-q', '-m', 'one', cwd=source)
+    first_commit = git('rev-parse', 'HEAD', cwd=source).strip()
+    with open(os.path.join(source, 'pkg', 'mod.py'), 'w') as f: f.write("x = 2\n")
+    git('commit', '-q', '-am', 'two', cwd=source)
+    return first_commit
 
 @pytest.mark.django_db
 class TestAgentCore:
@@ -71,13 +91,13 @@ class TestAgentCore:
     # --- 5. 邏輯測試：Tasks (模擬完整流程) ---
     @patch('agent_core.tasks.connection')
     @patch('agent_core.tasks.run_tests_in_docker')
-    @patch('agent_core.tasks.subprocess')
-    @patch('agent_core.tasks.setup_workspace')
+    @patch('agent_core.tasks.workspace_diff')
+    @patch('agent_core.tasks.lease_workspace')
     @patch('agent_core.tasks.get_relevant_files')
     @patch('agent_core.tasks.get_file_contexts')
     @patch('agent_core.tasks.generate_with_retry')
     @patch('agent_core.tasks.settings')
-    def test_process_evaluation_task_logic(self, mock_settings, mock_generate, mock_contexts, mock_get_files, mock_setup_ws, mock_subprocess, mock_run_docker, mock_connection):
+    def test_process_evaluation_task_logic(self, mock_settings, mock_generate, mock_contexts, mock_get_files, mock_setup_ws, mock_diff, mock_run_docker, mock_connection):
         """
         測試 process_evaluation_task 函式邏輯，模擬 Git Diff 和 Docker 執行。
         """
@@ -102,11 +122,8 @@ class TestAgentCore:
         mock_generate.return_value = mock_response
         # -----------------------------
         
-        # 模擬 subprocess.run (針對 git diff)
-        mock_proc = MagicMock()
-        mock_proc.stdout = "diff --git a/file1.py b/file1.py\n+print('fixed')"
-        mock_proc.returncode = 0
-        mock_subprocess.run.return_value = mock_proc
+        # 模擬 git diff
+        mock_diff.return_value = "diff --git a/file1.py b/file1.py\n+print('fixed')"
 
         # 模擬 Docker 回傳測試結果 (Pass)
         mock_run_docker.return_value = (1, 1, 1, 1, "Tests Passed")
@@ -212,4 +229,1057 @@ class TestAgentCore:
             # 呼叫讀檔函式
             context = get_file_contexts(tmpdir, ["test.py"])
             assert "print('hello')" in context
-            assert "--- START OF FILE: test.py ---" in context
\ No newline at end of file
+            assert "--- START OF FILE: test.py ---" in context
+
+    # --- 9. Snapshot store: 依 base_commit 建立快照並以連結方式建立工作區 ---
+    def test_snapshot_materialization(self):
+        """Snapshot follows base_commit and workspace writes never leak into it."""
+        from agent_core.utils.snapshots import get_snapshot, materialize_snapshot
+        from agent_core.utils.workspace import write_workspace_file
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'source')
+            first_commit = _make_source_repo(source)
+
+            snapshot_root = os.path.join(tmpdir, 'snapshots')
+            snapshot = get_snapshot(snapshot_root, 'owner/repo', source, first_commit)
+            assert get_snapshot(snapshot_root, 'owner/repo', source, first_commit) == snapshot
+
+            workspace = os.path.join(tmpdir, 'ws')
+            mode = materialize_snapshot(snapshot, workspace)
+            assert mode in ('reflink', 'hardlink', 'copy')
+            with open(os.path.join(workspace, 'pkg', 'mod.py')) as f:
+                assert f.read() == "x = 1\n"
+            # the reused index must see a clean tree
+            assert git('status', '--porcelain', cwd=workspace) == ""
+
+            write_workspace_file(workspace, 'pkg/mod.py', "x = 3\r\n")
+            assert "+x = 3" in git('diff', cwd=workspace)
+            with open(os.path.join(snapshot, 'pkg', 'mod.py')) as f:
+                assert f.read() == "x = 1\n"
+
+            # 找不到 base_commit: 不能用 HEAD 頂替, 也不留下快照
+            with pytest.raises(IOError):
+                get_snapshot(snapshot_root, 'owner/repo', source, 'deadbeef' * 5)
+            assert sorted(os.listdir(snapshot_root)) == [os.path.basename(snapshot)]
+
+    # --- 10. Workspace pool: 重用工作區並只重置被修改的檔案 ---
+    def test_workspace_pool_reuse_and_eviction(self):
+        from agent_core.utils.snapshots import get_snapshot, materialize_snapshot
+        from agent_core.utils.workspace import write_workspace_file
+        from agent_core.utils.workspace_pool import WorkspacePool
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'source')
+            first_commit = _make_source_repo(source)
+            snapshot = get_snapshot(os.path.join(tmpdir, 'snapshots'), 'owner/repo', source, first_commit)
+
+            created = []
+
+            def factory(nocode_bench_id, base_commit):
+                created.append(nocode_bench_id)
+                dest = os.path.join(tmpdir, f'ws_{len(created)}')
+                materialize_snapshot(snapshot, dest)
+                return dest
+
+            pool = WorkspacePool(max_idle=1, factory=factory)
+            ws = pool.lease('owner__repo-1', first_commit)
+            write_workspace_file(ws, 'pkg/mod.py', "x = 42\n")
+            write_workspace_file(ws, 'pkg/new_module.py', "y = 1\n")
+            pool.release(ws)
+
+            # same (repo, commit) gets the same, pristine directory back
+            assert pool.lease('owner__repo-2', first_commit) == ws
+            assert git('status', '--porcelain', '--ignored', cwd=ws) == ""
+            with open(os.path.join(ws, 'pkg', 'mod.py')) as f:
+                assert f.read() == "x = 1\n"
+
+            other = pool.lease('owner__repo-3', first_commit)
+            assert other != ws
+            pool.release(ws)
+            pool.release(other)
+            # cap of one idle workspace: the least recently used one is deleted
+            assert not os.path.exists(ws)
+            assert os.path.exists(other)
+            assert pool.stats == {'created': 2, 'reused': 1, 'evicted': 1}
+
+    # --- 11. Sparse workspace: 只在讀寫時才建立檔案 ---
+    def test_sparse_workspace(self):
+        from agent_core.utils import workspace
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first_commit = _make_source_repo(os.path.join(tmpdir, 'owner', 'repo'))
+            with patch.multiple(workspace, _placer=TierPlacer(parse_tiers('', os.path.join(tmpdir, 'ws'))),
+                                ORIGINAL_DATASET_ROOT=tmpdir,
+                                SNAPSHOT_ROOT=os.path.join(tmpdir, 'snapshots')):
+                ws = workspace.setup_workspace('owner__repo-1', first_commit, mode='sparse')
+
+            assert not os.path.exists(os.path.join(ws, 'pkg'))
+            assert workspace.list_workspace_files(ws) == ['pkg/mod.py']
+            assert git('status', '--porcelain', cwd=ws) == ""
+
+            assert workspace.get_file_contexts(ws, ['pkg/mod.py']).count("x = 1") == 1
+            assert workspace.workspace_diff(ws) == ""
+
+            workspace.write_workspace_file(ws, 'pkg/mod.py', "x = 5\n")
+            patch_text = workspace.workspace_diff(ws)
+            assert "-x = 1" in patch_text and "+x = 5" in patch_text
+            # 新檔案也要出現在 patch 裡 (git diff 不含 untracked)
+            workspace.write_workspace_file(ws, 'pkg/new.py', "y = 1\n")
+            patch_text = workspace.workspace_diff(ws)
+            assert "+x = 5" in patch_text and "new file mode" in patch_text and "+y = 1" in patch_text
+
+            workspace.reset_workspace(ws)
+            assert workspace.workspace_diff(ws) == ""
+            workspace.forget_workspace(ws)
+
+    # --- 12. Overlay workspace: 記憶體中的修改與 in-process diff ---
+    def test_overlay_workspace_diff(self):
+        from agent_core.utils import workspace
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first_commit = _make_source_repo(os.path.join(tmpdir, 'owner', 'repo'))
+            with patch.multiple(workspace, _placer=TierPlacer(parse_tiers('', os.path.join(tmpdir, 'ws'))),
+                                ORIGINAL_DATASET_ROOT=tmpdir,
+                                SNAPSHOT_ROOT=os.path.join(tmpdir, 'snapshots')):
+                ws = workspace.setup_workspace('owner__repo-1', first_commit, mode='overlay')
+                full_ws = workspace.setup_workspace('owner__repo-1', first_commit, mode='full')
+
+            assert not os.path.exists(ws)
+            assert workspace.read_workspace_file(ws, 'pkg/mod.py') == "x = 1\n"
+
+            # overlay 讀取: 未修改的檔案走共用 cache, 修改過的讀 overlay
+            assert "x = 1" in workspace.get_file_contexts(ws, ['pkg/mod.py'])
+            workspace.write_workspace_file(ws, 'pkg/mod.py', "x = 1\ny = 2")
+            assert "y = 2" in workspace.get_file_contexts(ws, ['pkg/mod.py'])
+            workspace.write_workspace_file(ws, 'pkg/extra.py', "z = 3\n")
+            fork = workspace.fork_workspace(ws)
+            workspace.write_workspace_file(fork, 'pkg/mod.py', "x = 9\n")
+            assert 'pkg/extra.py' in workspace.list_workspace_files(ws)
+
+            # the in-process patch must be accepted by git like a `git diff` one
+            patch_text = workspace.workspace_diff(ws)
+            with open(os.path.join(tmpdir, 'p.diff'), 'w') as f: f.write(patch_text)
+            git('apply', os.path.join(tmpdir, 'p.diff'), cwd=full_ws)
+            with open(os.path.join(full_ws, 'pkg', 'mod.py')) as f:
+                assert f.read() == "x = 1\ny = 2"
+            assert "+x = 9" in workspace.workspace_diff(fork)
+            # full mode: 新檔案也在 patch 裡, 且可被 git apply
+            workspace.write_workspace_file(full_ws, 'pkg/new.py', "y = 1\n")
+            full_patch = workspace.workspace_diff(full_ws)
+            assert "b/pkg/new.py" in full_patch and "+y = 1" in full_patch
+            workspace.reset_workspace(full_ws)
+            git('checkout', '-q', '--', '.', cwd=full_ws)
+            with open(os.path.join(tmpdir, 'full.diff'), 'w') as f: f.write(full_patch)
+            git('apply', '--check', os.path.join(tmpdir, 'full.diff'), cwd=full_ws)
+
+            workspace.reset_workspace(ws)
+            assert workspace.workspace_diff(ws) == ""
+            assert workspace.workspace_diff(fork) != ""
+            for path in (ws, fork, full_ws):
+                workspace.forget_workspace(path)
+
+    # --- 13. Reaper: 回收崩潰 worker 留下的工作區與容器 ---
+    @patch('agent_core.utils.docker_runner.client')
+    def test_reaper_reclaims_orphans(self, mock_client):
+        import json
+        import time
+        from agent_core.utils import reclaimer
+        from agent_core.utils.docker_runner import reap_runner_containers
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def make_ws(name, task_id):
+                os.makedirs(os.path.join(tmpdir, name, '.git'))
+                with open(os.path.join(tmpdir, name, '.git', 'nocode_owner.json'), 'w') as f:
+                    json.dump({'task_id': task_id, 'since': time.time() - 3600}, f)
+
+            make_ws('run_finished', 5)
+            make_ws('run_running', 6)
+            make_ws('run_idle', None)
+
+            with patch.multiple(reclaimer, workspace_roots=lambda: [tmpdir],
+                                SNAPSHOT_ROOT=os.path.join(tmpdir, '_snapshots')):
+                reaped = reclaimer.reap_orphaned_workspaces(lambda task_id: str(task_id) == '6', stale_seconds=7200)
+
+            assert reaped == [os.path.join(tmpdir, 'run_finished')]
+            assert os.path.exists(os.path.join(tmpdir, 'run_running'))
+            assert os.path.exists(os.path.join(tmpdir, 'run_idle'))
+
+        stale = MagicMock()
+        stale.name = f"runner_5_{int(time.time()) - 3600}"
+        live = MagicMock()
+        live.name = f"runner_6_{int(time.time()) - 3600}"
+        mock_client.containers.list.return_value = [stale, live]
+        assert reap_runner_containers(lambda task_id: task_id == '6') == [stale.name]
+        stale.remove.assert_called_once_with(force=True)
+        live.remove.assert_not_called()
+
+    # --- 14. Storage tiers: 依快照大小放置工作區 (tmpfs 預算不足時退回磁碟) ---
+    def test_storage_tier_placement(self):
+        from agent_core.utils.storage_tiers import parse_size
+
+        assert parse_size('2G') == 2 * 1024 ** 3
+        assert parse_size('') is None
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fast, disk = os.path.join(tmpdir, 'shm'), os.path.join(tmpdir, 'disk')
+            tiers = parse_tiers(f"tmpfs={fast}:1K", disk)
+            assert [(t.name, t.budget) for t in tiers] == [('tmpfs', 1024), ('disk', None)]
+
+            placer = TierPlacer(tiers)
+            assert placer.place(800).name == 'tmpfs'
+            assert placer.place(800).name == 'disk'  # over the tmpfs budget
+            placer.release('tmpfs', 800)
+            assert placer.place(800).name == 'tmpfs'
+
+            stats = placer.stats()
+            assert stats['tmpfs']['placed'] == 2 and stats['disk']['placed'] == 1
+            assert stats['tmpfs']['hit_rate'] == round(2 / 3, 4)
+
+    # --- 15. File catalog: 由 git metadata 建立並持久化的檔案清單 ---
+    def test_file_catalog(self):
+        from agent_core.utils.file_catalog import load_catalog, CATALOG_FILE
+        from agent_core.utils.snapshots import get_snapshot
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'source')
+            _make_source_repo(source)
+            os.makedirs(os.path.join(source, 'third_party'))
+            os.makedirs(os.path.join(source, 'gen'))
+            with open(os.path.join(source, 'third_party', 'lib.py'), 'w') as f: f.write("pass\n")
+            with open(os.path.join(source, 'gen', 'out.py'), 'w') as f: f.write("pass\n")
+            with open(os.path.join(source, '.gitattributes'), 'w') as f: f.write("gen/** linguist-generated\n")
+            git('add', '.', cwd=source)
+            git('commit', '-q', '-m', 'three', cwd=source)
+
+            snapshot = get_snapshot(os.path.join(tmpdir, 'snapshots'), 'owner/repo', source)
+            catalog = {e.path: e for e in load_catalog(snapshot)}
+            assert os.path.exists(os.path.join(snapshot, '.git', CATALOG_FILE))
+
+            assert catalog['pkg/mod.py'].size == len("x = 2\n")
+            assert catalog['pkg/mod.py'].ext == '.py'
+            assert not catalog['pkg/mod.py'].vendored
+            assert catalog['third_party/lib.py'].vendored
+            assert catalog['gen/out.py'].vendored
+
+    # --- 16. Lexical index: BM25 預先排序候選檔案 ---
+    def test_lexical_index_ranking(self):
+        from agent_core.utils.lexical_index import load_lexical_index, tokenize, INDEX_FILE
+
+        assert {'bar_label', 'bar', 'label', 'axes'} <= set(tokenize("Axes.bar_label"))
+        assert {'formatter', 'percent'} <= set(tokenize("class PercentFormatter:"))
+
+        with tempfile.TemporaryDirectory() as snapshot:
+            os.makedirs(os.path.join(snapshot, '.git'))
+            files = {
+                'lib/axes/_axes.py': 'class Axes:\n    def bar_label(self, container, labels=None):\n        """Label a bar plot."""\n',
+                'lib/ticker.py': 'class PercentFormatter:\n    """Format numbers as a percentage."""\n',
+                'lib/colors.py': 'def to_rgba(c):\n    return c\n',
+            }
+            for path, content in files.items():
+                os.makedirs(os.path.dirname(os.path.join(snapshot, path)), exist_ok=True)
+                with open(os.path.join(snapshot, path), 'w') as f: f.write(content)
+
+            paths = tuple(sorted(files))
+            index = load_lexical_index(snapshot, paths)
+            ranked = index.search("Add a `padding` argument to Axes.bar_label for bar labels", 2)
+            assert ranked[0][0] == 'lib/axes/_axes.py'
+            assert 'lib/colors.py' not in [p for p, _ in ranked]
+            assert index.signatures('lib/axes/_axes.py') == ['class Axes']
+            assert os.path.exists(os.path.join(snapshot, '.git', INDEX_FILE))
+
+            # 持久化後重新載入結果相同
+            load_lexical_index.cache_clear()
+            assert load_lexical_index(snapshot, paths).search("percentage formatter", 1)[0][0] == 'lib/ticker.py'
+            load_lexical_index.cache_clear()
+
+    # --- 17. Symbol index: AST 定義索引, 依 blob 增量更新 ---
+    def test_symbol_index(self):
+        from agent_core.utils import symbol_index
+        from agent_core.utils.snapshots import get_snapshot
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'source')
+            _make_source_repo(source)
+            os.makedirs(os.path.join(source, 'lib', 'axes'))
+            with open(os.path.join(source, 'lib', 'axes', '_axes.py'), 'w') as f:
+                f.write("class Axes:\n    def bar_label(self, container):\n        pass\n\nLIMIT = 3\n")
+            with open(os.path.join(source, 'lib', 'ticker.py'), 'w') as f:
+                f.write("class PercentFormatter:\n    pass\n")
+            git('add', '.', cwd=source)
+            git('commit', '-q', '-m', 'three', cwd=source)
+            snapshots = os.path.join(tmpdir, 'snapshots')
+
+            head = git('rev-parse', 'HEAD', cwd=source).strip()
+            index = symbol_index.load_symbol_index(get_snapshot(snapshots, 'owner/repo', source, head))
+            assert index.lookup('Axes.bar_label') == [('lib/axes/_axes.py', 'method', 2, 3)]
+            assert ['LIMIT', 'variable', 5, 5] in index.symbols('lib/axes/_axes.py')
+            assert index.resolve("Add `padding` to Axes.bar_label and a ``PercentFormatter`` option") == [
+                'lib/axes/_axes.py', 'lib/ticker.py']
+            assert index.resolve("See lib.ticker.PercentFormatter") == ['lib/ticker.py']
+
+            # 模組路徑要對齊 `/`: foo.Bar 不會對到 xfoo.py
+            entry = lambda: {'blob': '', 'symbols': [['Bar', 'class', 1, 2]], 'imports': []}
+            paths = symbol_index.SymbolIndex({'src/xfoo.py': entry(), 'src/foo/__init__.py': entry(), 'lib/foo.py': entry()})
+            assert paths.resolve("Use foo.Bar") == ['lib/foo.py']
+            assert symbol_index.SymbolIndex({'src/xfoo.py': entry()}).resolve("Use foo.Bar") == []
+
+            # 新 commit 只改了 mod.py: 其他檔案沿用舊索引
+            with open(os.path.join(source, 'pkg', 'mod.py'), 'w') as f: f.write("def grow():\n    pass\n")
+            git('commit', '-q', '-am', 'four', cwd=source)
+            head = git('rev-parse', 'HEAD', cwd=source).strip()
+            with patch.object(symbol_index, '_parse_parallel', wraps=symbol_index._parse_parallel) as mock_parse:
+                index = symbol_index.load_symbol_index(get_snapshot(snapshots, 'owner/repo', source, head))
+            assert mock_parse.call_args[0][1] == ['pkg/mod.py']
+            assert index.lookup('grow') == [('pkg/mod.py', 'function', 1, 2)]
+            assert index.lookup('Axes')[0][0] == 'lib/axes/_axes.py'
+            symbol_index.load_symbol_index.cache_clear()
+
+    # --- 18. Import graph: 依 fan-in 擴充一階鄰居檔案 ---
+    def test_import_graph_neighbours(self):
+        from agent_core.utils.import_graph import ImportGraph, module_names
+        from agent_core.utils.symbol_index import SymbolIndex
+
+        def entry(*imports):
+            return {'blob': '', 'symbols': [], 'imports': [list(i) for i in imports]}
+
+        index = SymbolIndex({
+            'lib/pkg/__init__.py': entry((1, 'core', ['Widget'])),
+            'lib/pkg/core.py': entry((1, 'util', ['helper']), (0, 'os', [])),
+            'lib/pkg/util.py': entry(),
+            'lib/pkg/plot.py': entry((0, 'pkg.core', []), (1, '', ['util'])),
+            'lib/pkg/other.py': entry((0, 'pkg.util', [])),
+            'lib/pkg/tests/__init__.py': entry(),
+            'lib/pkg/tests/test_core.py': entry((2, 'core', ['Widget'])),
+            'setup.py': entry(),
+        })
+        assert module_names(list(index.files))['lib/pkg/core.py'] == 'pkg.core'
+        assert module_names(list(index.files))['setup.py'] == 'setup'
+
+        graph = ImportGraph(index)
+        assert graph.imports['lib/pkg/plot.py'] == {'lib/pkg/core.py', 'lib/pkg/util.py'}
+        assert graph.importers['lib/pkg/core.py'] == {'lib/pkg/__init__.py', 'lib/pkg/plot.py', 'lib/pkg/tests/test_core.py'}
+        assert graph.fan_in('lib/pkg/util.py') == 3
+
+        # util 同時被 core 匯入且被 plot/other 匯入 (fan-in 最高); 測試檔不列入
+        assert graph.neighbours(['lib/pkg/core.py'], 2) == ['lib/pkg/util.py', 'lib/pkg/__init__.py']
+        assert 'lib/pkg/tests/test_core.py' not in graph.neighbours(['lib/pkg/core.py'], 10)
+
+    # --- 19. Context packer: 以 token 預算挑選整檔或切片, 並還原 ELIDED 區段 ---
+    def test_context_packer_budget(self):
+        from agent_core.utils.context_packer import pack_files, restore_elisions, count_tokens, ELISION_RE
+
+        small = "import os\n\ndef helper():\n    return 1\n"
+        big_lines = ["import numpy as np", ""]
+        for n in range(60):
+            body = "bar_label(self, container, padding)" if n == 42 else f"compute_{n}(value)"
+            big_lines += [f"def func_{n}(value):", f'    """Docstring {n}."""', f"    x = {n}", f"    y = x * {n}",
+                          f"    z = y + {n}", f"    w = z - {n}", f"    return {body}", ""]
+        big = "\n".join(big_lines)
+        budget = count_tokens(small) + 400
+
+        blocks = pack_files([('core.py', big), ('util.py', small)], budget, query="Add padding to bar_label")
+        assert len(blocks) == 2
+        # 小檔案完整保留, 大檔案只留下與 doc change 相關的區塊
+        assert blocks[1] == f"--- START OF FILE: util.py ---\n{small}\n--- END OF FILE: util.py ---\n"
+        assert blocks[0].startswith("--- START OF FILE: core.py ---")
+        assert "bar_label(self, container, padding)" in blocks[0]
+        assert "import numpy as np" in blocks[0]
+        assert ELISION_RE.search(blocks[0])
+        assert sum(count_tokens(b) for b in blocks) <= budget
+
+        # 模型保留 ELIDED 標記 -> 寫回時還原原始行
+        sliced = blocks[0].split('---\n', 1)[1].rsplit('\n--- END', 1)[0]
+        edited = sliced.replace("return bar_label(self, container, padding)", "return bar_label(self, container, padding=2)")
+        restored = restore_elisions(big, edited)
+        assert restored == big.replace("bar_label(self, container, padding)", "bar_label(self, container, padding=2)")
+
+    # --- 20. Symbol slicing: 只保留相關函式本體, 其餘留下簽名與 docstring ---
+    def test_symbol_slicing_roundtrip(self):
+        from agent_core.utils.context_packer import pack_files, restore_elisions, ELISION_RE
+
+        methods = []
+        for name in ('bar', 'bar_label', 'pie'):
+            methods += [f"    def {name}(self, x):", f'        """Plot {name}."""'] + [f"        x += {n}" for n in range(10)] + ["        return x", ""]
+        content = "\n".join(["import numpy as np", "", "", "class Axes:", '    """Axes."""', ""] + methods)
+
+        [block] = pack_files([('axes.py', content)], 10000, query="Add padding to Axes.bar_label", slice_min_tokens=10)
+        sliced = block.split('---\n', 1)[1].rsplit('\n--- END', 1)[0]
+        assert "    def bar(self, x):" in sliced and '        """Plot pie."""' in sliced
+        assert "def bar_label(self, x):\n" in sliced and sliced.count("x += 9") == 1
+        assert len(ELISION_RE.findall(sliced)) == 2
+        assert "        ... [ELIDED lines" in sliced  # 與被省略的程式碼同樣縮排
+
+        # 寫回: 模型只改了 bar_label, 省略的本體原樣還原
+        edited = sliced.replace("def bar_label(self, x):", "def bar_label(self, x, padding=0):")
+        assert restore_elisions(content, edited) == content.replace("def bar_label(self, x):", "def bar_label(self, x, padding=0):")
+
+        # 關閉切片時整檔送出
+        assert pack_files([('axes.py', content)], 10000, query="bar_label")[0].count("x += 9") == 3
+
+    # --- 21. Content cache: 跨任務共用的檔案內容 LRU (repo, commit, path) ---
+    def test_content_cache(self):
+        import threading
+        from agent_core.utils import workspace, content_cache
+        from agent_core.utils.content_cache import ContentCache, DiskStore, CachedContent
+
+        cache = ContentCache(max_bytes=10)
+        assert cache.get_or_load('a', lambda: "abcde\r\n") == CachedContent("abcde\n", 1)
+        assert cache.get_or_load('a', lambda: "changed") == CachedContent("abcde\n", 1)
+        cache.get_or_load('b', lambda: "fghij")
+        assert cache.get_or_load('c', lambda: None) is None
+        assert cache.stats()['evictions'] == 1  # 'a' 被淘汰
+        assert {k: cache.stats()[k] for k in ('entries', 'hits', 'misses')} == {'entries': 1, 'hits': 1, 'misses': 3}
+
+        # 同一個 key 同時讀取只載入一次
+        loads = []
+        def slow_load():
+            loads.append(1)
+            threading.Event().wait(0.05)
+            return "x"
+        threads = [threading.Thread(target=cache.get_or_load, args=('d', slow_load)) for _ in range(5)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert len(loads) == 1
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = DiskStore(os.path.join(tmpdir, 'cache'))
+            ContentCache(1000, store).get_or_load('k', lambda: "shared")
+            other = ContentCache(1000, store)
+            assert other.get_or_load('k', lambda: None) == CachedContent("shared", 1)
+            assert other.stats()['store_hits'] == 1
+
+            first_commit = _make_source_repo(os.path.join(tmpdir, 'owner', 'repo'))
+            with patch.multiple(workspace, _placer=TierPlacer(parse_tiers('', os.path.join(tmpdir, 'ws'))),
+                                ORIGINAL_DATASET_ROOT=tmpdir,
+                                SNAPSHOT_ROOT=os.path.join(tmpdir, 'snapshots')), \
+                    patch.object(content_cache, '_cache', ContentCache(1000)) as shared:
+                ws_a = workspace.setup_workspace('owner__repo-1', first_commit)
+                ws_b = workspace.setup_workspace('owner__repo-2', first_commit)
+                assert "x = 1" in workspace.get_file_contexts(ws_a, ['pkg/mod.py'])
+                assert "x = 1" in workspace.get_file_contexts(ws_b, ['pkg/mod.py'])
+                assert (shared.hits, shared.misses) == (1, 1)
+
+                # 已修改的檔案不走快取
+                workspace.write_workspace_file(ws_b, 'pkg/mod.py', "x = 7\n")
+                assert "x = 7" in workspace.get_file_contexts(ws_b, ['pkg/mod.py'])
+                assert (shared.hits, shared.misses) == (1, 1)
+                workspace.forget_workspace(ws_a)
+                workspace.forget_workspace(ws_b)
+
+    # --- 22. Hierarchical retrieval: 先選目錄再選檔案 ---
+    def test_hierarchical_retrieval(self):
+        import json
+        from django.test import override_settings
+        from agent_core.utils.repo_summary import directory_summary
+        from agent_core.utils.symbol_index import SymbolIndex
+
+        files = ['setup.py', 'lib/mpl/axes/_axes.py', 'lib/mpl/axes/_base.py', 'lib/mpl/ticker.py', 'doc/conf.py']
+        index = SymbolIndex({
+            'lib/mpl/axes/_axes.py': {'blob': '', 'imports': [], 'symbols': [
+                ['Axes', 'class', 1, 9], ['Axes.bar', 'method', 2, 3], ['_helper', 'function', 10, 11]]},
+            'lib/mpl/axes/_base.py': {'blob': '', 'imports': [], 'symbols': [['_AxesBase', 'class', 1, 5]]},
+        })
+        assert directory_summary(files, index, max_dirs=3) == [
+            '. (1 files)', 'doc/ (1 files)', 'lib/mpl/ (3 files): Axes']
+        assert directory_summary(files, index) == [
+            '. (1 files)', 'doc/ (1 files)', 'lib/mpl/ (1 files)', 'lib/mpl/axes/ (2 files): Axes']
+
+        with tempfile.TemporaryDirectory() as ws:
+            for f in files:
+                os.makedirs(os.path.dirname(os.path.join(ws, f)), exist_ok=True)
+                with open(os.path.join(ws, f), 'w') as fh: fh.write("pass\n")
+
+            model = MagicMock()
+            model.generate_content.side_effect = [
+                MagicMock(text=json.dumps({"directories": ["lib/mpl/axes/"]})),
+                MagicMock(text=json.dumps({"files": ["lib/mpl/axes/_axes.py", "doc/conf.py"]})),
+            ]
+            with override_settings(RETRIEVAL_HIERARCHY_THRESHOLD=3):
+                result = get_relevant_files(model, "Add padding to Axes.bar_label", ws)
+
+            dir_prompt = model.generate_content.call_args_list[0][0][0]
+            file_prompt = model.generate_content.call_args_list[1][0][0]
+            assert "lib/mpl/axes/ (2 files)" in dir_prompt
+            assert "lib/mpl/axes/_base.py" in file_prompt and "lib/mpl/ticker.py" not in file_prompt
+            assert result == ["lib/mpl/axes/_axes.py", "doc/conf.py"]
+
+    # --- 23. LLM response cache: 相同 (model, config, prompt) 直接回傳快取 ---
+    def test_llm_response_cache(self):
+        from types import SimpleNamespace
+        from agent_core.utils import llm_cache, llm_client
+        from agent_core.utils.llm_cache import ResponseCache, DiskTier, CachedResponse, response_key
+        from google.generativeai.types import GenerationConfig
+
+        model = MagicMock(model_name='models/gemini-2.5-pro', _generation_config={}, _system_instruction=None)
+        model.generate_content.return_value = SimpleNamespace(
+            text="--- START OF FILE: a.py ---\nx\n--- END OF FILE: a.py ---",
+            usage_metadata=SimpleNamespace(prompt_token_count=90, candidates_token_count=10, total_token_count=100))
+        json_config = GenerationConfig(response_mime_type="application/json")
+        assert response_key(model, "p", json_config) != response_key(model, "p")
+        assert response_key(MagicMock(), "p") is None  # 沒有 model_name 的物件不快取
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tier = DiskTier(tmpdir, ttl=3600, max_bytes=10 ** 6)
+            with patch.object(llm_cache, '_cache', ResponseCache(8, 3600, tier)) as cache:
+                first = llm_client.generate_with_retry(model, "prompt")
+                second = llm_client.generate_with_retry(model, "prompt")
+                llm_client.generate_with_retry(model, "prompt", use_cache=False)
+                assert model.generate_content.call_count == 2
+                assert second.text == first.text and second.usage_metadata.total_token_count == 100
+                assert cache.stats()['hits'] == 1 and cache.stats()['saved_tokens'] == 100
+
+            # 重新啟動的 worker: 記憶體是空的, 由磁碟層回答
+            restarted = ResponseCache(8, 3600, tier)
+            assert restarted.get(response_key(model, "prompt")).text == first.text
+            assert restarted.stats()['tier_hits'] == 1
+
+            # TTL 過期與大小上限
+            assert DiskTier(tmpdir, ttl=-1, max_bytes=10 ** 6).get(response_key(model, "prompt")) is None
+            for n in range(5):
+                tier.set(f"{n:064x}", CachedResponse("y" * 100))
+            tier.max_bytes = 300
+            tier.prune()
+            sizes = [os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(tmpdir) for f in fs]
+            assert sum(sizes) <= 300 and len(sizes) >= 1
+
+    # --- 24. Retry: 指數退避 + server retry hint + deadline + hedging ---
+    def test_llm_retry_backoff_and_hedging(self):
+        import threading
+        from google.api_core import exceptions as api_exceptions
+        from agent_core.utils import llm_retry
+        from agent_core.utils.llm_retry import call_with_retry, retry_hint, backoff_delay, LatencyTracker
+
+        assert retry_hint(api_exceptions.ResourceExhausted("Quota exceeded. Please retry in 2.5s")) == 2.5
+        assert retry_hint(api_exceptions.ServiceUnavailable("retry_delay { seconds: 7 }")) == 7
+        assert retry_hint(api_exceptions.InternalServerError("boom")) is None
+        assert all(2 <= backoff_delay(2, 1.0, 60.0) <= 4 for _ in range(20))
+        assert backoff_delay(0, 1.0, 60.0, hint=9.0) == 9.0
+
+        # 429 兩次後成功; 等待時間至少為 server hint
+        outcomes = [api_exceptions.ResourceExhausted("retry in 3s"), api_exceptions.ServiceUnavailable("down"), "ok"]
+        def flaky(timeout):
+            result = outcomes.pop(0)
+            if isinstance(result, Exception): raise result
+            return result
+        sleeps = []
+        assert call_with_retry(flaky, base_delay=0.01, sleep=sleeps.append) == "ok"
+        assert len(sleeps) == 2 and sleeps[0] >= 3
+
+        # 不可重試的錯誤直接拋出
+        calls = []
+        def bad_request(timeout):
+            calls.append(timeout)
+            raise api_exceptions.InvalidArgument("bad prompt")
+        with pytest.raises(api_exceptions.InvalidArgument):
+            call_with_retry(bad_request, sleep=sleeps.append)
+        assert len(calls) == 1
+
+        # 超過 deadline 時不再重試
+        def quota(timeout):
+            raise api_exceptions.ResourceExhausted("retry in 60s")
+        with pytest.raises(api_exceptions.ResourceExhausted):
+            call_with_retry(quota, deadline=5, sleep=sleeps.append)
+
+        # hedging: 第一個請求卡住時, 第二個請求先回來
+        release = threading.Event()
+        started = []
+        def slow_then_fast(timeout):
+            started.append(timeout)
+            if len(started) == 1:
+                release.wait(5)
+                return "slow"
+            return "fast"
+        tracker = LatencyTracker(min_samples=1)
+        tracker.record('m', 0.01)
+        with patch.object(llm_retry, 'latencies', tracker):
+            assert call_with_retry(slow_then_fast, key='m', hedge_percentile=95) == "fast"
+        release.set()
+        assert len(started) == 2
+
+    # --- 25. Rate limiter: 每個 model 的 RPM/TPM token bucket 與 AIMD 並行度 ---
+    def test_rate_limiter(self):
+        import threading
+        from google.api_core import exceptions as api_exceptions
+        from agent_core.utils.rate_limiter import RateLimiter, LocalBucket, AIMDLimiter, parse_limits
+
+        assert parse_limits("gemini-2.5-flash=1000/1000000, gemini-2.5-pro=150/") == {
+            'gemini-2.5-flash': (1000, 1000000), 'gemini-2.5-pro': (150, 0)}
+
+        now = [0.0]
+        bucket = LocalBucket(60, clock=lambda: now[0])  # 1 token / 秒
+        assert bucket.take(60) == 0
+        assert bucket.take(2) == pytest.approx(2.0)
+        now[0] += 2
+        assert bucket.take(2) == 0
+        assert bucket.take(1000) == pytest.approx(60.0)  # 超過容量: 等桶滿即可
+
+        aimd = AIMDLimiter(initial=2, latency_target=10)
+        aimd.acquire(); aimd.release(latency=1.0)
+        assert aimd.limit == 2.5
+        aimd.acquire(); aimd.release(latency=30.0)
+        assert aimd.limit == 2.25
+        aimd.acquire(); aimd.release(throttled=True)
+        assert aimd.limit == 1.125
+
+        # Redis 連不上時退回 process 內的 bucket; pro 與 flash 分開計算
+        sleeps, clock = [], [0.0]
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+        limiter = RateLimiter({'gemini-2.5-pro': (2, 1000)}, redis_url='redis://127.0.0.1:1/0',
+                              sleep=fake_sleep, clock=lambda: clock[0])
+        response = MagicMock(usage_metadata=MagicMock(total_token_count=900))
+        with limiter.slot('models/gemini-2.5-pro', 100) as record:
+            record(response)  # 實際用量 900 tokens
+        with limiter.slot('models/gemini-2.5-flash', 10 ** 6):
+            pass
+        assert sleeps == []
+        with pytest.raises(api_exceptions.ResourceExhausted):
+            with limiter.slot('models/gemini-2.5-pro', 200):
+                raise api_exceptions.ResourceExhausted("429")
+        assert sum(sleeps) == pytest.approx(6.0) and limiter.throttled == 1  # 剩下 100 tokens, 等 6 秒補滿 200
+        assert limiter.aimd('gemini-2.5-pro').limit == 2.125  # (4 + 1/4) / 2
+
+        # 並行上限: 第二個呼叫等到第一個結束
+        gate = AIMDLimiter(initial=1, maximum=1)
+        gate.acquire()
+        order = []
+        t = threading.Thread(target=lambda: (gate.acquire(), order.append('second')))
+        t.start()
+        threading.Event().wait(0.05)
+        order.append('first done')
+        gate.release(latency=0.1)
+        t.join()
+        assert order == ['first done', 'second']
+
+    # --- 26. Async LLM pool: 共用 model, 一個 worker 同時多個請求 ---
+    def test_async_llm_pool(self):
+        import asyncio
+        from agent_core.utils import llm_pool
+        from google.api_core import exceptions as api_exceptions
+        from agent_core.utils.llm_retry import call_with_retry_async
+
+        # 同一個 API key 只 configure 一次, model 物件重複使用
+        with patch.object(llm_pool, 'genai') as genai_mock, patch.dict(llm_pool._models, clear=True), \
+                patch.object(llm_pool, '_configured_key', None):
+            genai_mock.GenerativeModel.side_effect = lambda name: MagicMock(model_name=f"models/{name}")
+            a = llm_pool.get_model('gemini-2.5-pro', api_key='k1')
+            assert llm_pool.get_model('gemini-2.5-pro', api_key='k1') is a
+            assert genai_mock.configure.call_count == 1
+            assert llm_pool.get_model('gemini-2.5-pro', api_key='k2') is not a  # 換 key 重建
+        with pytest.raises(Exception):
+            llm_pool.get_model('gemini-2.5-pro', api_key='')
+
+        class FakeModel:
+            model_name = 'models/gemini-2.5-flash'
+            def __init__(self):
+                self.inflight = self.peak = 0
+            async def generate_content_async(self, prompt, generation_config=None, request_options=None):
+                self.inflight += 1
+                self.peak = max(self.peak, self.inflight)
+                await asyncio.sleep(0.01)
+                self.inflight -= 1
+                if prompt == 'bad':
+                    raise ValueError("400")
+                return MagicMock(text=prompt.upper(), usage_metadata=MagicMock(total_token_count=5))
+
+        model = FakeModel()
+        with patch.object(llm_pool, 'settings', MagicMock(LLM_ASYNC_CONCURRENCY=3, LLM_MAX_ATTEMPTS=2,
+                                                          LLM_DEADLINE_SECONDS=60, LLM_ATTEMPT_TIMEOUT_SECONDS=30,
+                                                          LLM_HEDGE_PERCENTILE=0)), \
+                patch.object(llm_pool, 'get_response_cache', return_value=None):
+            results = llm_pool.generate_many([(model, f"p{i}") for i in range(8)] + [(model, 'bad')])
+        assert [r.text for r in results[:8]] == [f"P{i}" for i in range(8)]  # 順序不變
+        assert isinstance(results[8], ValueError)  # 不可重試的錯誤直接回傳
+        assert 1 < model.peak <= 3  # 同時在飛, 但不超過上限
+
+        # 同一個 process 連續兩次 generate_many: client 綁在第一個 event loop 上, 不能每次換新的 loop
+        class LoopBoundModel:
+            model_name = 'models/gemini-2.5-flash'
+            loop = None
+            async def generate_content_async(self, prompt, generation_config=None, request_options=None):
+                loop = asyncio.get_running_loop()
+                if self.loop is None:
+                    self.loop = loop
+                if self.loop is not loop:
+                    raise RuntimeError("Event loop is closed" if self.loop.is_closed() else "bound to a different loop")
+                return MagicMock(text=prompt, usage_metadata=MagicMock(total_token_count=1))
+
+        bound = LoopBoundModel()
+        with patch.object(llm_pool, 'get_response_cache', return_value=None):
+            for _ in range(2):
+                results = llm_pool.generate_many([(bound, 'a'), (bound, 'b')])
+                assert [getattr(r, 'text', r) for r in results] == ['a', 'b']
+
+        # async 呼叫也經過 AIMD slot: 429 讓上限減半, slot 都有歸還
+        from agent_core.utils.rate_limiter import RateLimiter
+        class ThrottledModel:
+            model_name = 'models/gemini-2.5-flash'
+            async def generate_content_async(self, prompt, generation_config=None, request_options=None):
+                if prompt == 'busy':
+                    raise api_exceptions.TooManyRequests("429")
+                return MagicMock(text=prompt, usage_metadata=MagicMock(total_token_count=1))
+
+        limiter = RateLimiter({}, aimd_initial=8)
+        with patch.object(llm_pool, 'get_rate_limiter', return_value=limiter), \
+                patch.object(llm_pool, 'get_response_cache', return_value=None), \
+                patch.object(llm_pool, 'settings', MagicMock(LLM_ASYNC_CONCURRENCY=3, LLM_MAX_ATTEMPTS=1,
+                                                              LLM_DEADLINE_SECONDS=60, LLM_ATTEMPT_TIMEOUT_SECONDS=30,
+                                                              LLM_HEDGE_PERCENTILE=0)):
+            results = llm_pool.generate_many([(ThrottledModel(), 'ok'), (ThrottledModel(), 'busy')])
+        assert results[0].text == 'ok' and isinstance(results[1], api_exceptions.TooManyRequests)
+        aimd = limiter.aimd('gemini-2.5-flash')
+        assert limiter.throttled == 1 and aimd.limit < 8 and aimd.inflight == 0
+
+        # async retry: 可重試的錯誤會等待後重試
+        calls, sleeps = [], []
+        async def flaky(timeout):
+            calls.append(timeout)
+            if len(calls) < 3:
+                raise api_exceptions.ServiceUnavailable("503")
+            return 'ok'
+        async def fake_sleep(seconds):
+            sleeps.append(seconds)
+        assert asyncio.run(call_with_retry_async(flaky, attempt_timeout=5, sleep=fake_sleep)) == 'ok'
+        assert len(calls) == 3 and len(sleeps) == 2
+
+    # --- 27. Streaming: 邊收邊解析, 每個檔案結束就交給 writer ---
+    def test_streaming_file_parser(self):
+        from agent_core.utils.llm_client import FileStreamParser, generate_with_retry
+
+        text = ("Plan first.\n"
+                "--- START OF FILE: a.py ---\nx = 1\n\ny = 2\n--- END OF FILE: a.py ---\n"
+                "Some prose between files.\n"
+                "--- START OF FILE: pkg/b.py ---\ndef f():\n    return 1\n--- END OF FILE: pkg/b.py ---\n"
+                "--- START OF FILE: c.py ---\nz = 3\n")  # 最後一個檔案沒有 END 標記
+        expected = {'a.py': "x = 1\n\ny = 2", 'pkg/b.py': "def f():\n    return 1", 'c.py': "z = 3"}
+        assert parse_llm_response(text) == expected
+
+        # 任意切塊 (標記被切開也一樣)
+        for size in (1, 3, 7, 50):
+            parser = FileStreamParser()
+            files = []
+            for i in range(0, len(text), size):
+                files += parser.feed(text[i:i + size])
+            assert 'c.py' not in dict(files)  # 還沒結束
+            files += parser.close()
+            assert dict(files) == expected
+
+        # generate_with_retry(stream): 第一個檔案在最後一個 chunk 之前就交出
+        chunks = [text[i:i + 20] for i in range(0, len(text), 20)]
+        received = []
+        class StreamingModel:
+            model_name = 'models/gemini-2.5-pro'
+            def generate_content(self, prompt, generation_config=None, request_options=None, stream=False):
+                assert stream
+                response = MagicMock(usage_metadata=MagicMock(total_token_count=10))
+                def chunk_iter():
+                    for n, piece in enumerate(chunks):
+                        received.append(('chunk', n))
+                        yield MagicMock(text=piece)
+                response.__iter__ = lambda self: chunk_iter()
+                response.text = text
+                return response
+        with patch('agent_core.utils.llm_client.get_response_cache', return_value=None):
+            generate_with_retry(StreamingModel(), "prompt", on_file=lambda p, c: received.append(('file', p)))
+        files = [item[1] for item in received if item[0] == 'file']
+        assert files == ['a.py', 'pkg/b.py', 'c.py']
+        assert received.index(('file', 'a.py')) < received.index(('chunk', len(chunks) - 1))
+
+    # --- 28. SEARCH/REPLACE edits: 只輸出要改的地方, 容忍空白差異 ---
+    def test_search_replace_edits(self):
+        from agent_core.utils.edit_blocks import apply_file_edit, parse_edit_blocks
+        from agent_core.utils.llm_client import build_prompt_for_attempt
+
+        original = "class A:\n    def f(self):\n        return 1\n\n    def g(self):\n        return 2\n"
+        content = ("<<<<<<< SEARCH\n    def f(self):\n        return 1\n=======\n    def f(self):\n        return 10\n>>>>>>> REPLACE\n"
+                   # 縮排錯了 + 行尾空白: 仍然套用, 並換成檔案的縮排
+                   "<<<<<<< SEARCH\ndef g(self):   \n    return 2\n=======\ndef g(self):\n    return 20\n>>>>>>> REPLACE\n"
+                   "<<<<<<< SEARCH\n    def missing(self):\n=======\n    pass\n>>>>>>> REPLACE\n"
+                   "<<<<<<< SEARCH\nclass A:\n=======\nclass B")  # 回應被截斷
+        new_text, failures = apply_file_edit(original, content)
+        assert new_text == original.replace("return 1", "return 10").replace("return 2", "return 20")
+        assert len(failures) == 2
+        assert failures[0].startswith("hunk 4: incomplete")
+        assert failures[1].startswith("hunk 3: SEARCH text not found") and 'def missing' in failures[1]
+
+        # 新檔案: 空的 SEARCH
+        assert apply_file_edit('', "<<<<<<< SEARCH\n=======\nx = 1\n>>>>>>> REPLACE") == ("x = 1", [])
+        assert apply_file_edit('y = 0\n', "<<<<<<< SEARCH\n=======\nx = 1\n>>>>>>> REPLACE")[1] == [
+            "hunk 1: empty SEARCH on an existing file"]
+
+        # 沒有 hunk: 整個檔案 (ELIDED 標記照舊還原)
+        assert parse_edit_blocks("x = 2") is None
+        assert apply_file_edit("a\nb\nc\n", "... [ELIDED lines 1-2] ...\nC") == ("a\nb\nC", [])
+
+        assert "<<<<<<< SEARCH" in build_prompt_for_attempt("doc", "ctx", [], edit_format='search_replace')
+        assert "<<<<<<< SEARCH" not in build_prompt_for_attempt("doc", "ctx", [], edit_format='whole')
+
+    # --- 29. Parallel edits: 先規劃, 再每個檔案各自同時生成 ---
+    def test_parallel_edit_generation(self):
+        import json
+        from agent_core.utils import llm_client
+
+        plan = {"files": [{"path": "a.py", "change": "add f"}, {"path": "b.py", "change": "call f"},
+                          {"path": "../x.py", "change": "bad"}, {"path": "a.py", "change": "dup"}]}
+        assert llm_client.parse_change_plan(json.dumps(plan)) == [("a.py", "add f"), ("b.py", "call f")]
+        assert llm_client.parse_change_plan("not json") == []
+
+        usage = lambda n: MagicMock(total_token_count=n, prompt_token_count=0,
+                                    candidates_token_count=0, cached_content_token_count=0)
+        plan_response = MagicMock(text=json.dumps(plan), usage_metadata=usage(5))
+        file_responses = [
+            MagicMock(text="--- START OF FILE: a.py ---\ndef f(): pass\n--- END OF FILE: a.py ---", usage_metadata=usage(10)),
+            RuntimeError("boom"),  # 單一檔案失敗不影響其他檔案
+        ]
+        with patch.object(llm_client, 'generate_with_retry', return_value=plan_response), \
+                patch.object(llm_client, 'generate_many', return_value=file_responses) as many:
+            merged = llm_client.generate_parallel_edits(MagicMock(), "doc", "ctx", [])
+        prompts = [request[1] for request in many.call_args[0][0]]
+        assert len(prompts) == 2 and "`a.py`" in prompts[0] and "`b.py`" in prompts[1]
+        common = os.path.commonprefix(prompts)
+        assert "**CHANGE PLAN" in common  # 共同的部分在前面
+        assert parse_llm_response(merged.text) == {"a.py": "def f(): pass"}
+        assert merged.usage_metadata.total_token_count == 15
+
+        # 每個檔案都失敗: 不算整個 task 失敗, 交回給一般的單次呼叫
+        with patch.object(llm_client, 'generate_with_retry', return_value=plan_response), \
+                patch.object(llm_client, 'generate_many', return_value=[RuntimeError("Event loop is closed")] * 2):
+            assert llm_client.generate_parallel_edits(MagicMock(), "doc", "ctx", []) is None
+
+        # 只有一個檔案: 交回給一般的單次呼叫
+        single = MagicMock(text=json.dumps({"files": [{"path": "a.py", "change": "add f"}]}))
+        with patch.object(llm_client, 'generate_with_retry', return_value=single):
+            assert llm_client.generate_parallel_edits(MagicMock(), "doc", "ctx", []) is None
+
+    # --- 30. Candidates: 同時產生多個 patch, 去重, 平行測試, 第一個通過就結束 ---
+    def test_parallel_candidates(self):
+        import threading
+        import time
+        from agent_core.utils.candidates import race_candidates, best_candidate, candidate_patch
+        from agent_core.utils.docker_runner import reap_runner_containers
+
+        ws = tempfile.mkdtemp()
+        with open(os.path.join(ws, 'a.py'), 'w') as f: f.write("x = 1\n")
+        block = lambda value: f"--- START OF FILE: a.py ---\nx = {value}\n--- END OF FILE: a.py ---"
+        responses = {0: block(2), 1: "no files here", 2: block(2), 3: block(3)}
+
+        diff, errors = candidate_patch(ws, {'a.py': "x = 2"})
+        assert "-x = 1" in diff and "+x = 2" in diff and errors == []
+        assert open(os.path.join(ws, 'a.py')).read() == "x = 1\n"  # 工作區不變
+
+        tested, cancelled = [], threading.Event()
+        def sample(index):
+            time.sleep(0.02 * index)
+            return responses[index]
+        def test(candidate, cancel):
+            tested.append(candidate.index)
+            if '+x = 3' in candidate.patch:
+                return 1, 1, 1, 1, "ok"
+            # 慢的候選: 等到被取消
+            if cancel.wait(5): cancelled.set()
+            return 0, 1, 1, 1, "killed"
+
+        started = time.monotonic()
+        candidates = race_candidates(ws, 4, sample, test)
+        assert time.monotonic() - started < 2  # 不等慢的測試跑完
+        statuses = {c.index: c.status for c in candidates}
+        assert statuses[3] == 'PASSED' and statuses[2] == 'DUPLICATE' and statuses[1] == 'APPLY_FAILED'
+        assert statuses[0] == 'CANCELLED' and cancelled.wait(2)
+        assert sorted(tested) == [0, 3]
+        assert best_candidate(candidates).index == 3
+        shutil.rmtree(ws)
+
+        # 平行的 container 名稱帶候選編號, reaper 一樣認得
+        with patch('agent_core.utils.docker_runner.client') as mock_client:
+            live = MagicMock()
+            live.name = f"runner_6_{int(time.time()) - 3600}_2"
+            mock_client.containers.list.return_value = [live]
+            assert reap_runner_containers(lambda task_id: task_id == '6') == []
+
+    # --- 31. Model cascade: 先用便宜的 model, 失敗才升級 ---
+    @patch('agent_core.tasks.connection')
+    @patch('agent_core.tasks.run_tests_in_docker')
+    @patch('agent_core.tasks.workspace_diff')
+    @patch('agent_core.tasks.lease_workspace')
+    @patch('agent_core.tasks.get_relevant_files')
+    @patch('agent_core.tasks.get_file_contexts')
+    @patch('agent_core.tasks.generate_with_retry')
+    @patch('agent_core.tasks.get_model')
+    def test_model_cascade(self, mock_get_model, mock_generate, mock_contexts, mock_get_files, mock_lease,
+                           mock_diff, mock_run_docker, mock_connection):
+        from agent_core.models import EvaluationAttempt
+        from agent_core.utils.model_cascade import plan_cascade
+
+        # 歷史紀錄: flash 在這個 repo 常失敗就直接跳過
+        assert plan_cascade('coder', 'test/repo') == ['gemini-2.5-flash', 'gemini-2.5-pro']
+        for n in range(5):
+            EvaluationAttempt.objects.create(task=self.task, attempt_number=n, status='TEST_FAILED',
+                                             model_name='gemini-2.5-flash')
+        assert plan_cascade('coder', 'test/repo') == ['gemini-2.5-pro']
+        assert plan_cascade('coder', 'other/repo') == ['gemini-2.5-flash', 'gemini-2.5-pro']
+        EvaluationAttempt.objects.all().delete()
+
+        test_dir = tempfile.mkdtemp()
+        git('init', '-q', cwd=test_dir)  # 升級前要 reset 工作區
+        mock_lease.return_value = test_dir
+        mock_get_model.side_effect = lambda name, api_key=None: MagicMock(model_name=f"models/{name}")
+        # 便宜的 retrieval model 找不到檔案時才問下一個
+        mock_get_files.side_effect = [[], ["file1.py"]]
+        mock_contexts.return_value = "context content"
+        broken = MagicMock(text="--- START OF FILE: file1.py ---\ndef f(:\n--- END OF FILE: file1.py ---\n")
+        fixed = MagicMock(text="--- START OF FILE: file1.py ---\ndef f(): pass\n--- END OF FILE: file1.py ---\n")
+        mock_generate.side_effect = lambda model, prompt, **kwargs: broken if 'flash' in model.model_name else fixed
+        mock_diff.return_value = "diff --git a/file1.py b/file1.py\n+def f(): pass"
+        mock_run_docker.return_value = (1, 1, 1, 1, "Tests Passed")
+        try:
+            with patch('agent_core.tasks.settings', MagicMock(GEMINI_API_KEY="fake-key", LLM_CANDIDATES=1,
+                                                              LLM_PARALLEL_EDITS=False, RETRIEVAL_NEIGHBOURS=0)):
+                process_evaluation_task(self.task.id)
+        finally:
+            shutil.rmtree(test_dir, ignore_errors=True)
+
+        self.task.refresh_from_db()
+        assert self.task.status == 'COMPLETED'
+        assert [c.args[0].model_name for c in mock_get_files.call_args_list] == [
+            'models/gemini-2.5-flash', 'models/gemini-2.5-pro']
+        attempts = list(EvaluationAttempt.objects.filter(task=self.task).values_list('model_name', 'status'))
+        assert attempts == [('gemini-2.5-flash', 'TEST_FAILED'), ('gemini-2.5-pro', 'PASSED')]
+        # 語法錯誤在本機就擋下, 不用開 container
+        assert mock_run_docker.call_count == 1
+
+        # 便宜的 model 呼叫直接失敗 (重試用完): 換 pro, 不讓整個 task 失敗
+        EvaluationAttempt.objects.all().delete()
+        self.task.status = 'PENDING'
+        self.task.save()
+        test_dir = tempfile.mkdtemp()
+        git('init', '-q', cwd=test_dir)
+        mock_lease.return_value = test_dir
+        mock_get_files.side_effect = None
+        mock_get_files.return_value = ["file1.py"]
+        def generate(model, prompt, **kwargs):
+            if 'flash' in model.model_name:
+                raise Exception("503 Service Unavailable")
+            return fixed
+        mock_generate.side_effect = generate
+        try:
+            with patch('agent_core.tasks.settings', MagicMock(GEMINI_API_KEY="fake-key", LLM_CANDIDATES=1,
+                                                              LLM_PARALLEL_EDITS=False, RETRIEVAL_NEIGHBOURS=0)):
+                process_evaluation_task(self.task.id)
+        finally:
+            shutil.rmtree(test_dir, ignore_errors=True)
+        self.task.refresh_from_db()
+        assert self.task.status == 'COMPLETED'
+        assert list(EvaluationAttempt.objects.filter(task=self.task).values_list('model_name', 'status')) == [
+            ('gemini-2.5-pro', 'PASSED')]
+
+    # --- 32. Log condenser: retry 只帶失敗的測試, 例外與相關 traceback ---
+    def test_log_condenser(self):
+        from agent_core.utils.log_condenser import condense_attempt, condense_patch, condense_test_output, fit_history
+
+        patch_text = ("diff --git a/lib/mod.py b/lib/mod.py\nindex 1..2 100644\n--- a/lib/mod.py\n+++ b/lib/mod.py\n"
+                      "@@ -1,3 +1,3 @@\n def f():\n-    return 1\n+    return g()\n     pass\n")
+        noise = "\n".join(f"tests/test_other.py::test_{n} PASSED" for n in range(2000))
+        output = (
+            "EDITS NOT APPLIED:\nlib/other.py: hunk 2: SEARCH text not found\n\n"
+            "Running F2P...\n" + noise + "\n"
+            "    def test_f():\n>       assert f() == 2\n\n"
+            "lib/mod.py:3: in f\n    return g()\n"
+            "E   NameError: name 'g' is not defined\n"
+            "/usr/lib/python3/site-packages/_pytest/python.py:194: in pytest_pyfunc_call\n"
+            "FAILED tests/test_mod.py::test_f - NameError: name 'g' is not defined\n"
+            "FAILED tests/test_mod.py::test_h - NameError: name 'g' is not defined\n"
+            "========= 2 failed, 2000 passed in 3.2s =========\n"
+            "Running P2P...\n"
+            "======================================================================\n"
+            "ERROR: test_view (app.tests.ViewTests)\n"
+            "Traceback (most recent call last):\n"
+            '  File "/root/repo/lib/mod.py", line 3, in f\n'
+            "    return g()\n"
+            "NameError: name 'g' is not defined\n"
+        )
+        condensed = condense_test_output(output, ['lib/mod.py'])
+        assert "lib/other.py: hunk 2: SEARCH text not found" in condensed
+        assert "- tests/test_mod.py::test_f: NameError: name 'g' is not defined" in condensed
+        assert "- app.tests.ViewTests.test_view" in condensed
+        assert "NameError: name 'g' is not defined (x2)" in condensed
+        assert "lib/mod.py:3 in f" in condensed and "/root/repo/lib/mod.py:3 in f: return g()" in condensed
+        assert "_pytest" not in condensed and "test_other" not in condensed
+        assert "2 failed, 2000 passed" in condensed
+        assert len(condensed) < len(output) / 50
+
+        entry = condense_attempt(1, patch_text, output)
+        assert "+    return g()" in entry and " def f():" not in entry and "index 1..2" not in entry
+        assert "(identical to attempt 1)" in condense_attempt(2, patch_text, output, previous_patch=patch_text)
+        # 空白行不算修改; 檔名要對齊 `/`: xmod.py 不是 mod.py
+        assert condense_patch("@@ -1,2 +1,3 @@\n x\n\n+y\n") == "@@ -1,2 +1,3 @@\n+y"
+        assert "TRACEBACK FRAMES" not in condense_test_output("lib/xmod.py:3: in f\nE   NameError: g", ['mod.py'])
+        # 沒有可辨認的內容: 留最後幾行
+        assert condense_test_output("Docker client unavailable", []) == "LOG TAIL:\nDocker client unavailable"
+
+        history = [f"ATTEMPT {n} FAILED.\n" + "word " * 500 for n in (1, 2, 3)]
+        fitted = fit_history(history, 1200)
+        assert fitted[0] == "ATTEMPT 1 FAILED. (details omitted)" and fitted[2] == history[2]
+
+    # --- 33. Context cache: 固定的 prompt 前綴只上傳一次 ---
+    def test_context_cache_reuses_prefix(self):
+        from agent_core.utils.context_cache import ContextCache, LocalContextBackend, LocalCachedModel
+        from agent_core.utils.llm_client import build_prompt_parts, with_cached_prefix
+
+        now = [1000.0]
+        clock = lambda: now[0]
+        backend = LocalContextBackend(clock)
+        cache = ContextCache(backend, ttl=3600, min_tokens=100, clock=clock)
+        model = MagicMock(model_name='models/gemini-2.5-flash')
+        prefix = "instructions\n" + "def f(): return 1\n" * 200
+
+        # 同一個前綴: 只建立一次, 之後重複使用
+        first = cache.model_for(model, prefix)
+        second = cache.model_for(model, prefix)
+        assert isinstance(first, LocalCachedModel) and first._cached_content == second._cached_content
+        assert backend.created == 1
+        first.generate_content("suffix")
+        model.generate_content.assert_called_with(prefix + "suffix")
+        # 不同前綴 / 太短的前綴
+        assert cache.model_for(model, prefix + "x")._cached_content != first._cached_content
+        assert cache.model_for(model, "short") is None
+        assert backend.created == 2
+
+        # 過了 TTL 一半: 延長, 不重建
+        now[0] += 2000
+        assert cache.model_for(model, prefix)._cached_content == first._cached_content
+        assert cache.stats()['extensions'] == 1 and backend.created == 2
+        # 過期: 重建
+        now[0] += 4000
+        assert cache.model_for(model, prefix)._cached_content != first._cached_content
+        assert backend.created == 3
+
+        # 另一個 worker (新的 ContextCache) 用 display name 找到同一份
+        other = ContextCache(backend, ttl=3600, min_tokens=100, clock=clock)
+        assert other.model_for(model, prefix)._cached_content == cache.model_for(model, prefix)._cached_content
+        assert backend.created == 3
+
+        # backend 失敗: None, 一段時間內不再嘗試
+        broken = MagicMock()
+        broken.find.side_effect = RuntimeError("quota")
+        failing = ContextCache(broken, ttl=3600, min_tokens=100, clock=clock)
+        assert failing.model_for(model, prefix) is None
+        assert failing.model_for(model, prefix) is None
+        assert broken.find.call_count == 1
+
+        # 重試時前綴不變, 歷史只在後綴
+        context = "--- START OF FILE: a.py ---\n" + "x = 1\n" * 300 + "--- END OF FILE: a.py ---\n"
+        prefix1, suffix1 = build_prompt_parts("doc", context, [])
+        prefix2, suffix2 = build_prompt_parts("doc", context, ["ATTEMPT 1 FAILED.\nboom"])
+        assert prefix1 == prefix2 and context in prefix1
+        assert "ATTEMPT 1 FAILED" in suffix2 and "doc" in suffix1
+
+        with patch('agent_core.utils.llm_client.get_context_cache', return_value=cache):
+            target, prompt = with_cached_prefix(model, prefix1, suffix1, reused=True)
+            assert isinstance(target, LocalCachedModel) and prompt == suffix1
+            # 只送一次的前綴不註冊
+            created = backend.created
+            assert with_cached_prefix(model, prefix1 + "y", suffix1) == (model, prefix1 + "y" + suffix1)
+            assert backend.created == created
+        with patch('agent_core.utils.llm_client.get_context_cache', return_value=None):
+            assert with_cached_prefix(model, prefix1, suffix1, reused=True) == (model, prefix1 + suffix1)
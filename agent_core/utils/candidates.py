@@ -0,0 +1,122 @@
+# agent_core/utils/candidates.py
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .workspace import read_workspace_file
+from .overlay import unified_git_diff
+from .edit_blocks import apply_file_edit
+from .llm_client import parse_llm_response
+
+logger = logging.getLogger(__name__)
+
+_read_lock = threading.Lock()  # sparse workspaces fetch missing files on read
+
+
+class Candidate:
+    """One sampled response and what became of it."""
+
+    def __init__(self, index: int):
+        self.index = index
+        # CANCELLED / GENERATION_FAILED / APPLY_FAILED / DUPLICATE / TEST_FAILED / PASSED
+        self.status = 'CANCELLED'
+        self.raw_response = ''
+        self.patch = ''
+        self.apply_errors = []
+        self.duplicate_of = None
+        self.results = None  # (f2p passed, f2p total, p2p passed, p2p total)
+        self.test_output = ''
+
+    def score(self) -> tuple:
+        if self.results is None:
+            return (-1, -1)
+        return (self.results[0], self.results[2])
+
+
+def tests_passed(f2p_passed: int, f2p_total: int, p2p_passed: int, p2p_total: int) -> bool:
+    ft_pass = (f2p_passed == f2p_total) if f2p_total > 0 else False
+    rt_pass = (p2p_passed == p2p_total) if p2p_total > 0 else True
+    return ft_pass and rt_pass
+
+
+def candidate_patch(workspace_path: str, modified_files: dict[str, str]) -> tuple[str, list[str]]:
+    """
+    The patch a response would produce, computed in memory so candidates never
+    touch the workspace. Returns (patch, failed hunk messages).
+    """
+    parts, errors = [], []
+    for file_path, content in sorted(modified_files.items()):
+        if '..' in file_path: continue
+        with _read_lock:
+            original = read_workspace_file(workspace_path, file_path)
+        new_content, failures = apply_file_edit(original or '', content)
+        errors.extend(f"{file_path}: {failure}" for failure in failures)
+        parts.append(unified_git_diff(file_path, original, new_content))
+    return "".join(parts).replace('\r\n', '\n'), errors
+
+
+def race_candidates(workspace_path: str, count: int, sample, test, max_workers: int | None = None) -> list[Candidate]:
+    """
+    Sample `count` responses concurrently (`sample(index)` -> response text),
+    drop those whose patch duplicates an earlier one, and test the rest as soon
+    as they are ready (`test(candidate, cancel)` -> run_tests_in_docker tuple).
+    The first candidate passing F2P and P2P wins: `cancel` is set for the
+    others and the call returns without waiting for them. Candidates still
+    running at that point are reported as CANCELLED.
+    """
+    cancel = threading.Event()
+    seen, seen_lock = {}, threading.Lock()
+
+    def run(candidate: Candidate) -> Candidate:
+        try:
+            candidate.raw_response = sample(candidate.index)
+        except Exception as e:
+            candidate.status, candidate.test_output = 'GENERATION_FAILED', str(e)
+            return candidate
+        if cancel.is_set():
+            return candidate
+        candidate.patch, candidate.apply_errors = candidate_patch(workspace_path, parse_llm_response(candidate.raw_response))
+        if not candidate.patch.strip():
+            candidate.status = 'APPLY_FAILED'
+            return candidate
+        with seen_lock:
+            candidate.duplicate_of = seen.setdefault(candidate.patch, candidate.index)
+        if candidate.duplicate_of != candidate.index:
+            candidate.status = 'DUPLICATE'
+            return candidate
+        candidate.duplicate_of = None
+        if cancel.is_set():
+            return candidate
+        *results, candidate.test_output = test(candidate, cancel)
+        if cancel.is_set() and not tests_passed(*results):
+            return candidate  # killed by another candidate's success
+        candidate.results = tuple(results)
+        candidate.status = 'PASSED' if tests_passed(*results) else 'TEST_FAILED'
+        return candidate
+
+    candidates = [Candidate(i) for i in range(count)]
+    finished = set()
+    executor = ThreadPoolExecutor(max_workers=max_workers or count, thread_name_prefix='nocode-candidate')
+    try:
+        for future in as_completed([executor.submit(run, c) for c in candidates]):
+            try:
+                candidate = future.result()
+            except Exception as e:
+                logger.warning(f"Candidate failed: {e}")
+                continue
+            finished.add(candidate.index)
+            if candidate.status == 'PASSED':
+                logger.info(f"Candidate {candidate.index} passed, cancelling the others")
+                break
+    finally:
+        cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+    return [c if c.index in finished else Candidate(c.index) for c in candidates]
+
+
+def best_candidate(candidates: list[Candidate]) -> Candidate | None:
+    """A passing candidate, else the tested one passing the most tests, else one that produced no patch."""
+    tested = [c for c in candidates if c.status in ('PASSED', 'TEST_FAILED')]
+    if tested:
+        return max(tested, key=lambda c: (c.status == 'PASSED', c.score()))
+    return next((c for c in candidates if c.status == 'APPLY_FAILED'), None)
@@ -0,0 +1,189 @@
+# agent_core/utils/content_cache.py
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+from django.conf import settings
+
+from .context_packer import count_tokens
+
+logger = logging.getLogger(__name__)
+
+_LOAD_STRIPES = 64
+
+
+class CachedContent(NamedTuple):
+    text: str  # decoded, LF-normalized
+    tokens: int
+
+
+def content_key(repo: str, commit: str, file_path: str) -> str:
+    return f"{repo}@{commit}:{file_path}"
+
+
+def _digest(key: str) -> str:
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class DiskStore:
+    """Second level shared by the worker processes of one host."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        digest = _digest(key)
+        return os.path.join(self.root, digest[:2], f"{digest}.json")
+
+    def get(self, key: str) -> CachedContent | None:
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return CachedContent(*json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def set(self, key: str, value: CachedContent):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(list(value), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Content cache write failed for {key}: {e}")
+
+
+class RedisStore:
+    """Second level shared by every worker using the same Redis."""
+
+    def __init__(self, url: str, ttl: int = 7 * 24 * 3600):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key: str) -> CachedContent | None:
+        try:
+            raw = self.client.get(f"nocode:content:{_digest(key)}")
+            return CachedContent(*json.loads(raw)) if raw else None
+        except Exception as e:
+            logger.warning(f"Content cache read failed for {key}: {e}")
+            return None
+
+    def set(self, key: str, value: CachedContent):
+        try:
+            self.client.set(f"nocode:content:{_digest(key)}", json.dumps(list(value)), ex=self.ttl)
+        except Exception as e:
+            logger.warning(f"Content cache write failed for {key}: {e}")
+
+
+def make_store(spec: str):
+    """'' -> memory only, 'redis://...' -> RedisStore, anything else is a DiskStore directory."""
+    if not spec:
+        return None
+    if spec.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(spec)
+    return DiskStore(spec)
+
+
+class ContentCache:
+    """
+    Process-wide LRU of decoded file contents and their token counts, keyed by
+    (repo, commit, path) and bounded in bytes. Concurrent loads of the same key
+    (e.g. greenlets of the gevent worker) wait for a single read.
+    """
+
+    def __init__(self, max_bytes: int, store=None):
+        self.max_bytes = max_bytes
+        self.store = store
+        self._entries: OrderedDict[str, CachedContent] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._load_locks = [threading.Lock() for _ in range(_LOAD_STRIPES)]
+        self.hits = self.misses = self.store_hits = self.evictions = 0
+
+    def _get(self, key: str) -> CachedContent | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def put(self, key: str, value: CachedContent):
+        size = len(value.text)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.text)
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.text)
+                self.evictions += 1
+
+    def get_or_load(self, key: str, loader) -> CachedContent | None:
+        """Cached content for `key`; on a miss `loader()` returns the raw text (or None)."""
+        value = self._get(key)
+        if value is not None:
+            return value
+
+        with self._load_locks[hash(key) % _LOAD_STRIPES]:
+            # loaded meanwhile by whoever held the lock
+            value = self._get(key)
+            if value is not None:
+                return value
+            value = self.store.get(key) if self.store else None
+            with self._lock:
+                self.misses += 1
+                self.store_hits += value is not None
+            if value is None:
+                text = loader()
+                if text is None:
+                    return None
+                text = text.replace('\r\n', '\n')
+                value = CachedContent(text, count_tokens(text))
+                if self.store:
+                    self.store.set(key, value)
+            self.put(key, value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'store_hits': self.store_hits,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_content_cache() -> ContentCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ContentCache(
+                getattr(settings, 'CONTENT_CACHE_MAX_BYTES', 256 * 1024 ** 2),
+                make_store(getattr(settings, 'CONTENT_CACHE_BACKEND', '')),
+            )
+        return _cache
@@ -0,0 +1,186 @@
+# agent_core/utils/context_cache.py
+import time
+import hashlib
+import logging
+import threading
+import datetime
+from collections import defaultdict
+from django.conf import settings
+
+from .context_packer import count_tokens
+
+logger = logging.getLogger(__name__)
+
+FAILURE_BACKOFF_SECONDS = 600  # after a failed create, the prefix is sent inline this long
+
+
+class GeminiContextBackend:
+    """Prefixes registered as Gemini cached contents (google.generativeai.caching)."""
+
+    def find(self, display_name: str):
+        """An unexpired cache created by any worker under this display name, or None."""
+        from google.generativeai import caching
+        for cached in caching.CachedContent.list(page_size=100):
+            if cached.display_name == display_name:
+                return cached, cached.expire_time.timestamp()
+        return None
+
+    def create(self, model_name: str, display_name: str, prefix: str, ttl: int):
+        from google.generativeai import caching
+        cached = caching.CachedContent.create(model=model_name, display_name=display_name, contents=[prefix],
+                                              ttl=datetime.timedelta(seconds=ttl))
+        return cached, cached.expire_time.timestamp()
+
+    def extend(self, handle, ttl: int) -> float:
+        handle.update(ttl=datetime.timedelta(seconds=ttl))
+        return handle.expire_time.timestamp()
+
+    def model(self, base_model, handle):
+        from google import generativeai as genai
+        return genai.GenerativeModel.from_cached_content(handle, generation_config=getattr(base_model, '_generation_config', None))
+
+
+class LocalCachedModel:
+    """What GenerativeModel.from_cached_content gives, for the local stand-in: the prefix is prepended here."""
+
+    def __init__(self, base_model, name: str, prefix: str):
+        self.base_model = base_model
+        self.model_name = base_model.model_name
+        self._generation_config = getattr(base_model, '_generation_config', None)
+        self._system_instruction = getattr(base_model, '_system_instruction', None)
+        self._cached_content = name
+        self.prefix = prefix
+
+    def generate_content(self, prompt, **kwargs):
+        return self.base_model.generate_content(self.prefix + prompt, **kwargs)
+
+    async def generate_content_async(self, prompt, **kwargs):
+        return await self.base_model.generate_content_async(self.prefix + prompt, **kwargs)
+
+
+class LocalContextBackend:
+    """In-process stand-in with the provider's semantics (TTL, lookup by display name), for tests and offline runs."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._caches = {}  # display name -> [name, prefix, expires at]
+        self._lock = threading.Lock()
+        self.created = 0
+
+    def find(self, display_name: str):
+        with self._lock:
+            entry = self._caches.get(display_name)
+            if entry is None or entry[2] <= self.clock():
+                return None
+            return entry[0], entry[2]
+
+    def create(self, model_name: str, display_name: str, prefix: str, ttl: int):
+        with self._lock:
+            self.created += 1
+            name = f"cachedContents/local-{self.created}"
+            self._caches[display_name] = [name, prefix, self.clock() + ttl]
+            return name, self._caches[display_name][2]
+
+    def extend(self, handle, ttl: int) -> float:
+        with self._lock:
+            for entry in self._caches.values():
+                if entry[0] == handle:
+                    entry[2] = self.clock() + ttl
+                    return entry[2]
+        raise KeyError(handle)
+
+    def model(self, base_model, handle):
+        with self._lock:
+            prefix = next(entry[1] for entry in self._caches.values() if entry[0] == handle)
+        return LocalCachedModel(base_model, handle, prefix)
+
+
+class ContextCache:
+    """
+    Registers stable prompt prefixes (instructions + repo context) with the
+    provider once per (model, prefix) and hands out models bound to them, so
+    attempts, candidates and tasks sharing a prefix only send their suffix.
+    Entries expire after `ttl` seconds without use; use within the second
+    half of the TTL extends it.
+    """
+
+    def __init__(self, backend, ttl: int = 3600, min_tokens: int = 4096, clock=time.time):
+        self.backend = backend
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.clock = clock
+        self._entries = {}  # key -> [handle, expires at]
+        self._failed = {}   # key -> retry after
+        self._lock = threading.Lock()
+        self._key_locks = defaultdict(threading.Lock)
+        self.uses = self.creates = self.extensions = 0
+
+    def model_for(self, model, prefix: str):
+        """A model with `prefix` cached as its context, or None (prefix too small, or the cache unavailable)."""
+        model_name = getattr(model, 'model_name', None)
+        if not isinstance(model_name, str) or count_tokens(prefix) < self.min_tokens:
+            return None
+        key = hashlib.sha256(f"{model_name}\0{prefix}".encode('utf-8')).hexdigest()
+        with self._lock:
+            if self._failed.get(key, 0) > self.clock():
+                return None
+            key_lock = self._key_locks[key]
+
+        with key_lock:
+            try:
+                handle = self._handle(key, model_name, prefix)
+                return self.backend.model(model, handle)
+            except Exception as e:
+                logger.warning(f"Context cache unavailable for {model_name}, sending the prefix inline: {e}")
+                with self._lock:
+                    self._entries.pop(key, None)
+                    self._failed[key] = self.clock() + FAILURE_BACKOFF_SECONDS
+                return None
+
+    def _handle(self, key: str, model_name: str, prefix: str):
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[1] - now < 60:
+            entry = None  # (nearly) expired on the provider side
+        if entry is None:
+            display_name = f"nocode-{key[:32]}"
+            found = self.backend.find(display_name)
+            if found is not None and found[1] - now >= 60:
+                entry = list(found)
+            else:
+                entry = list(self.backend.create(model_name, display_name, prefix, self.ttl))
+                with self._lock:
+                    self.creates += 1
+                logger.info(f"Cached a {count_tokens(prefix)}-token prompt prefix for {model_name}")
+        elif entry[1] - now < self.ttl / 2:
+            entry[1] = self.backend.extend(entry[0], self.ttl)
+            with self._lock:
+                self.extensions += 1
+        with self._lock:
+            self._entries[key] = entry
+            self.uses += 1
+        return entry[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'uses': self.uses, 'creates': self.creates,
+                    'extensions': self.extensions}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_context_cache() -> ContextCache | None:
+    """Process-wide context cache per LLM_CONTEXT_CACHE ('gemini', 'local', or '' = off)."""
+    global _cache
+    backend_name = getattr(settings, 'LLM_CONTEXT_CACHE', 'gemini')
+    if not backend_name:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            backend = LocalContextBackend() if backend_name == 'local' else GeminiContextBackend()
+            _cache = ContextCache(backend, ttl=getattr(settings, 'LLM_CONTEXT_CACHE_TTL_SECONDS', 3600),
+                                  min_tokens=getattr(settings, 'LLM_CONTEXT_CACHE_MIN_TOKENS', 4096))
+        return _cache
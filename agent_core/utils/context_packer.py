@@ -0,0 +1,215 @@
+# agent_core/utils/context_packer.py
+import re
+import ast
+import hashlib
+import warnings
+
+from .lexical_index import tokenize
+
+# Local stand-in for the Gemini tokenizer: short letter runs, digit groups and
+# single punctuation marks. Tracks the real count within ~10-15% on source code.
+_TOKEN = re.compile(r'[A-Za-z]{1,6}|\d{1,3}|[^\sA-Za-z\d]')
+_IDENTIFIER = re.compile(r'[A-Za-z_]\w*')
+
+ELISION = "... [ELIDED lines {start}-{end}] ..."
+ELISION_RE = re.compile(r'^([ \t]*)\.\.\. \[ELIDED lines (\d+)-(\d+)\] \.\.\.[ \t]*$', re.MULTILINE)
+
+MIN_SLICE_TOKENS = 300  # a file that cannot get at least this much is dropped instead
+BLOCK_MIN_LINES = 8
+MIN_ELIDED_LINES = 6  # function bodies shorter than this are cheaper to keep than to elide
+
+
+def count_tokens(text: str) -> int:
+    return len(_TOKEN.findall(text))
+
+
+_token_counts = {}  # content digest -> token count
+_TOKEN_COUNTS_MAX = 65536
+
+
+def cached_token_count(text: str) -> int:
+    """count_tokens memoized by content digest (the same files recur across attempts and tasks)."""
+    key = hashlib.sha1(text.encode('utf-8', 'replace')).digest()
+    count = _token_counts.get(key)
+    if count is None:
+        if len(_token_counts) >= _TOKEN_COUNTS_MAX:
+            _token_counts.clear()
+        count = _token_counts[key] = count_tokens(text)
+    return count
+
+
+def file_block(file_path: str, content: str) -> str:
+    return f"--- START OF FILE: {file_path} ---\n{content}\n--- END OF FILE: {file_path} ---\n"
+
+
+def split_blocks(content: str) -> list[tuple[int, int]]:
+    """
+    0-based [start, end) line ranges of top-level blocks: a new block starts at
+    an unindented line after a blank line, once the current block is long enough.
+    """
+    lines = content.split('\n')
+    blocks, start = [], 0
+    for i in range(1, len(lines)):
+        line = lines[i]
+        if (line and not line[0].isspace() and not lines[i - 1].strip()
+                and i - start >= BLOCK_MIN_LINES):
+            blocks.append((start, i))
+            start = i
+    blocks.append((start, len(lines)))
+    return blocks
+
+
+def _indent_of(lines: list[str], start: int, end: int) -> str:
+    for line in lines[start:end]:
+        if line.strip():
+            return line[:len(line) - len(line.lstrip())]
+    return ''
+
+
+def render_slice(lines: list[str], keep: list[tuple[int, int]]) -> str:
+    """
+    Kept line ranges in file order, with an ELIDED marker (1-based, inclusive,
+    indented like the code it replaces) for every gap.
+    """
+    out, pos = [], 0
+    for start, end in sorted(keep) + [(len(lines), len(lines))]:
+        if start > pos:
+            out.append(_indent_of(lines, pos, start) + ELISION.format(start=pos + 1, end=start))
+        out.extend(lines[start:end])
+        pos = max(pos, end)
+    return '\n'.join(out)
+
+
+def _complement(elided: list[tuple[int, int]], n_lines: int) -> list[tuple[int, int]]:
+    keep, pos = [], 0
+    for start, end in sorted(elided):
+        if start > pos:
+            keep.append((pos, start))
+        pos = max(pos, end)
+    if pos < n_lines:
+        keep.append((pos, n_lines))
+    return keep
+
+
+def symbol_keep_ranges(content: str, query_names: set[str]) -> list[tuple[int, int]] | None:
+    """
+    0-based [start, end) line ranges of a Python file to keep when slicing by
+    symbol: everything except the bodies of functions and methods whose name is
+    not among `query_names`. Their signatures and docstrings stay. None if the
+    file does not parse or nothing would be elided.
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            tree = ast.parse(content)
+    except (SyntaxError, ValueError, RecursionError):
+        return None
+
+    elided = []
+
+    def visit(body):
+        for node in body:
+            if isinstance(node, ast.ClassDef):
+                visit(node.body)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                if node.name.lower() in query_names:
+                    continue
+                first = node.body[0]
+                has_doc = isinstance(first, ast.Expr) and isinstance(getattr(first, 'value', None), ast.Constant) \
+                    and isinstance(first.value.value, str)
+                start = first.end_lineno if has_doc else first.lineno - 1
+                if first.lineno > node.lineno and node.end_lineno - start >= MIN_ELIDED_LINES:
+                    elided.append((start, node.end_lineno))
+
+    visit(tree.body)
+    if not elided:
+        return None
+    return _complement(elided, len(content.split('\n')))
+
+
+def _intersect(block: tuple[int, int], keep: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    return [(max(block[0], s), min(block[1], e)) for s, e in keep if s < block[1] and e > block[0]]
+
+
+def slice_to_budget(content: str, query_terms: set[str], budget: int,
+                    keep: list[tuple[int, int]] | None = None) -> str | None:
+    """
+    The file's header block plus its blocks sharing the most terms with the
+    query, within `budget` tokens. With `keep` (a symbol slice), only those
+    lines of each block count. None if not even the header fits.
+    """
+    lines = content.split('\n')
+    keep = keep or [(0, len(lines))]
+    blocks = [_intersect(block, keep) for block in split_blocks(content)]
+    texts = ['\n'.join('\n'.join(lines[s:e]) for s, e in parts) for parts in blocks]
+    costs = [count_tokens(text) + 12 * len(parts) for text, parts in zip(texts, blocks)]
+    if costs[0] > budget:
+        return None
+
+    def score(i):
+        return len(query_terms.intersection(tokenize(texts[i])))
+
+    chosen, used = list(blocks[0]), costs[0]
+    for i in sorted(range(1, len(blocks)), key=lambda i: (-score(i), i)):
+        if blocks[i] and used + costs[i] + 12 <= budget:  # 12 ~ one elision marker
+            chosen += blocks[i]
+            used += costs[i] + 12
+    return render_slice(lines, chosen)
+
+
+def pack_files(files: list[tuple[str, str]], budget: int, query: str = '',
+               slice_min_tokens: int | None = None, token_counts: dict[str, int] | None = None) -> list[str]:
+    """
+    Fit ranked (path, content) pairs into a token budget. Python files above
+    `slice_min_tokens` are first reduced to a symbol slice (see
+    symbol_keep_ranges). Files are taken whole in rank order while they fit;
+    the ones that do not are then cut to their query-relevant blocks, sharing
+    what is left of the budget in rank order. `token_counts` may carry known
+    counts of whole files.
+    """
+    token_counts = token_counts or {}
+    query_terms = set(tokenize(query))
+    # whole identifiers only: `bar_label` must not keep `bar` too
+    query_names = {name.lower() for name in _IDENTIFIER.findall(query)}
+    whole, deferred, used = {}, [], 0
+    for file_path, content in files:
+        keep = None
+        tokens = token_counts.get(file_path) or cached_token_count(content)
+        if slice_min_tokens is not None and file_path.endswith('.py') and tokens > slice_min_tokens:
+            keep = symbol_keep_ranges(content, query_names)
+        text = render_slice(content.split('\n'), keep) if keep else content
+        cost = (count_tokens(text) if keep else tokens) + 20
+        if used + cost <= budget:
+            whole[file_path] = text
+            used += cost
+        else:
+            deferred.append((file_path, content, keep))
+
+    sliced = {}
+    for n, (file_path, content, keep) in enumerate(deferred):
+        share = (budget - used) // (len(deferred) - n)
+        if share < MIN_SLICE_TOKENS:
+            print(f"Skipping {file_path} due to context limit.")
+            continue
+        part = slice_to_budget(content, query_terms, share - 20, keep)
+        if part is None:
+            print(f"Skipping {file_path} due to context limit.")
+            continue
+        sliced[file_path] = part
+        used += count_tokens(part) + 20
+
+    # keep retrieval order in the prompt
+    return [file_block(p, whole.get(p, sliced.get(p))) for p, _ in files if p in whole or p in sliced]
+
+
+def restore_elisions(original: str, content: str) -> str:
+    """Put back the original lines for every ELIDED marker the model left in a file."""
+    if '[ELIDED lines' not in content:
+        return content
+    lines = original.replace('\r\n', '\n').split('\n')
+
+    def expand(match):
+        start, end = int(match.group(2)), int(match.group(3))
+        return '\n'.join(lines[start - 1:end])
+
+    return ELISION_RE.sub(expand, content)
@@ -5,6 +5,7 @@ import re
 import tarfile
 import io
 import os
+import threading
 from agent_core.constants import MAP_REPO_TO_CONFIG
 
 
@@ -49,11 +50,25 @@ def _write_to_container(container, content: str, path: str):
         print(f"ERROR: Failed to write file to container {path}: {e}")
         raise
 
-def run_tests_in_docker(task_id, repo, version, base_commit, feature_patch, feature_test_patch, f2p_test_names, p2p_test_names):
+def _kill_when_cancelled(container, cancel, done):
+    """Watcher thread: remove the container as soon as `cancel` is set, which aborts the running exec."""
+    while not done.wait(1.0):
+        if cancel.is_set():
+            try: container.remove(force=True)
+            except Exception: pass
+            return
+
+def run_tests_in_docker(task_id, repo, version, base_commit, feature_patch, feature_test_patch, f2p_test_names, p2p_test_names,
+                        cancel=None, candidate=None):
+    """
+    `cancel` (threading.Event) aborts the run early; `candidate` tells apart
+    the containers of one task tested in parallel.
+    """
     if not client: return 0, 0, 0, 0, "Docker client unavailable"
     
     log = []
     container = None
+    done = threading.Event()
     try:
         cfg_map = MAP_REPO_TO_CONFIG.get(repo)
         if not cfg_map: return 0, 0, 0, 0, f"No config for {repo}"
@@ -66,10 +81,13 @@ def run_tests_in_docker(task_id, repo, version, base_commit, feature_patch, feat
 
         repo_name = repo.split('/')[-1]
         image = f"fb_{repo_name}:dev"
-        cname = f"runner_{task_id}_{int(time.time())}"
+        cname = f"runner_{task_id}_{int(time.time())}" + (f"_{candidate}" if candidate is not None else "")
         
+        if cancel is not None and cancel.is_set(): return 0, 0, 0, 0, "Cancelled"
         print(f"[{task_id}] Starting Docker: {image}")
         container = client.containers.run(image, name=cname, detach=True, tty=True, command="tail -f /dev/null")
+        if cancel is not None:
+            threading.Thread(target=_kill_when_cancelled, args=(container, cancel, done), daemon=True).start()
         
         wdir = f"/root/{repo_name}"
         container.exec_run("git clean -fdx", workdir=wdir)
@@ -156,6 +174,30 @@ def run_tests_in_docker(task_id, repo, version, base_commit, feature_patch, feat
     except Exception as e:
         return 0, 0, 0, 0, str(e)
     finally:
+        done.set()
         if container: 
             try: container.remove(force=True) 
-            except: pass
\ No newline at end of file
+            except: pass
+
+def reap_runner_containers(is_task_running, grace_seconds: float = 300) -> list[str]:
+    """
+    Remove `runner_<task_id>_<ts>[_<candidate>]` containers left behind by crashed workers,
+    i.e. whose task is no longer RUNNING and which are older than `grace_seconds`.
+    """
+    if not client: return []
+
+    reaped = []
+    now = time.time()
+    for container in client.containers.list(all=True, filters={'name': 'runner_'}):
+        m = re.match(r"runner_(.+?)_(\d+)(?:_\d+)?$", container.name)
+        if not m:
+            continue
+        task_id, started = m.group(1), int(m.group(2))
+        if is_task_running(task_id) or now - started < grace_seconds:
+            continue
+        try:
+            container.remove(force=True)
+            reaped.append(container.name)
+        except Exception as e:
+            print(f"Warning: failed to remove container {container.name}: {e}")
+    return reaped
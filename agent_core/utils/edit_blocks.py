@@ -0,0 +1,135 @@
+# agent_core/utils/edit_blocks.py
+import re
+
+from .context_packer import restore_elisions
+
+SEARCH_MARK = re.compile(r'^<{5,9} ?SEARCH\s*$')
+DIVIDER_MARK = re.compile(r'^={5,9}\s*$')
+REPLACE_MARK = re.compile(r'^>{5,9} ?REPLACE\s*$')
+
+EDIT_FORMAT_HELP = (
+    "--- START OF FILE: path/to/file1.py ---\n"
+    "<<<<<<< SEARCH\n(exact lines copied from the original file)\n=======\n(the lines that replace them)\n>>>>>>> REPLACE\n"
+    "--- END OF FILE: path/to/file1.py ---\n"
+)
+
+
+def parse_edit_blocks(content: str) -> tuple[list[tuple[list[str], list[str]]], list[str]] | None:
+    """
+    SEARCH / REPLACE hunks of one file block as (search lines, replace lines),
+    plus errors for hunks cut off by a truncated response. None if the block
+    holds no hunks at all (a full file).
+    """
+    hunks, errors = [], []
+    state, search, replace = None, [], []
+    for line in content.split('\n'):
+        if SEARCH_MARK.match(line):
+            if state is not None:
+                errors.append(f"hunk {len(hunks) + 1}: SEARCH without a matching REPLACE")
+            state, search, replace = 'search', [], []
+        elif state == 'search' and DIVIDER_MARK.match(line):
+            state = 'replace'
+        elif state == 'replace' and REPLACE_MARK.match(line):
+            hunks.append((search, replace))
+            state = None
+        elif state == 'search':
+            search.append(line)
+        elif state == 'replace':
+            replace.append(line)
+    if state is not None:
+        errors.append(f"hunk {len(hunks) + 1}: incomplete (response truncated?), not applied")
+    if not hunks and not errors:
+        return None
+    return hunks, errors
+
+
+def _indent(line: str) -> str:
+    return line[:len(line) - len(line.lstrip())]
+
+
+def _trim_blank(lines: list[str]) -> tuple[int, int]:
+    start, end = 0, len(lines)
+    while start < end and not lines[start].strip():
+        start += 1
+    while end > start and not lines[end - 1].strip():
+        end -= 1
+    return start, end
+
+
+def _find(haystack: list[str], needle: list[str], start: int) -> int:
+    """First index >= start (else anywhere) where `needle` occurs in `haystack`; -1 if nowhere."""
+    if not needle:
+        return -1
+    first, size = needle[0], len(needle)
+    for lo, hi in ((start, len(haystack)), (0, start)):
+        for i in range(lo, min(hi, len(haystack) - size + 1)):
+            if haystack[i] == first and haystack[i:i + size] == needle:
+                return i
+    return -1
+
+
+def _locate(lines: list[str], search: list[str], cursor: int):
+    """
+    Where `search` sits in `lines`, trying exact, then trailing-whitespace
+    insensitive, then indentation insensitive (blank edge lines ignored)
+    matching. Returns (start, end, search start, search end, reindent) or None.
+    """
+    at = _find(lines, search, cursor)
+    if at >= 0:
+        return at, at + len(search), 0, len(search), False
+    rstripped = [l.rstrip() for l in lines]
+    at = _find(rstripped, [l.rstrip() for l in search], cursor)
+    if at >= 0:
+        return at, at + len(search), 0, len(search), False
+    s0, s1 = _trim_blank(search)
+    at = _find([l.strip() for l in lines], [l.strip() for l in search[s0:s1]], cursor)
+    if at >= 0:
+        return at, at + s1 - s0, s0, s1, True
+    return None
+
+
+def apply_edits(original: str, hunks: list[tuple[list[str], list[str]]]) -> tuple[str, list[str]]:
+    """
+    Apply SEARCH / REPLACE hunks in order. Each hunk is anchored at its first
+    match after the previous one (else anywhere in the file). Returns the new
+    text and a message per hunk that could not be applied.
+    """
+    lines = original.replace('\r\n', '\n').split('\n')
+    failures, cursor = [], 0
+    for number, (search, replace) in enumerate(hunks, 1):
+        if not any(l.strip() for l in search):
+            if any(l.strip() for l in lines):
+                failures.append(f"hunk {number}: empty SEARCH on an existing file")
+                continue
+            lines, cursor = list(replace), len(replace)
+            continue
+        found = _locate(lines, search, cursor)
+        if found is None:
+            first = next(l for l in search if l.strip()).strip()
+            failures.append(f"hunk {number}: SEARCH text not found (starting with {first[:80]!r})")
+            continue
+        start, end, s0, s1, reindent = found
+        new = list(replace)
+        if reindent:
+            # the model got the indentation wrong: shift the replacement onto the file's
+            r0, r1 = _trim_blank(replace)
+            new = replace[r0:r1]
+            old_indent, file_indent = _indent(search[s0]), _indent(lines[start])
+            new = [file_indent + l[len(old_indent):] if l.startswith(old_indent) and l.strip() else l for l in new]
+        lines[start:end] = new
+        cursor = start + len(new)
+    return '\n'.join(lines), failures
+
+
+def apply_file_edit(original: str, content: str) -> tuple[str, list[str]]:
+    """
+    New text of a file from the model's block for it: SEARCH / REPLACE hunks
+    applied to `original`, or a full file with its ELIDED markers restored.
+    Returns (new text, failed hunk messages).
+    """
+    parsed = parse_edit_blocks(content)
+    if parsed is None:
+        return restore_elisions(original, content), []
+    hunks, errors = parsed
+    new_text, failures = apply_edits(original, hunks)
+    return new_text, errors + failures
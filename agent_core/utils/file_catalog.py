@@ -0,0 +1,110 @@
+# agent_core/utils/file_catalog.py
+import os
+import re
+import json
+import functools
+import subprocess
+import threading
+import time
+from typing import NamedTuple
+
+from .workspace import get_workspace_info
+
+CATALOG_FILE = 'nocode_catalog.json'
+CATALOG_VERSION = 1
+
+# paths that are almost never the place to implement a feature
+VENDORED_PATTERNS = re.compile(
+    r'(^|/)(vendor|vendored|_vendor|third_party|thirdparty|extern|externals|node_modules|'
+    r'\.venv|venv|site-packages|_build|build|dist|\.tox)/'
+    r'|\.min\.(js|css)$|_pb2(_grpc)?\.py$|\.map$'
+)
+
+
+class FileEntry(NamedTuple):
+    path: str
+    size: int
+    ext: str
+    blob: str
+    vendored: bool
+
+
+def _git(args, cwd, stdin=None):
+    return subprocess.run(
+        ['git', *args], cwd=cwd, input=stdin,
+        capture_output=True, text=True, encoding='utf-8', errors='replace'
+    ).stdout
+
+
+def _attr_flagged(snapshot_path: str, paths: list[str]) -> set[str]:
+    """Paths marked linguist-vendored / linguist-generated in .gitattributes."""
+    out = _git(['check-attr', '-z', '--stdin', 'linguist-vendored', 'linguist-generated'], snapshot_path, '\0'.join(paths))
+    fields = out.split('\0')
+    flagged = set()
+    # -z output: path NUL attribute NUL value NUL ...
+    for i in range(0, len(fields) - 2, 3):
+        if fields[i + 2] in ('set', 'true'):
+            flagged.add(fields[i])
+    return flagged
+
+
+def build_catalog(snapshot_path: str) -> list[FileEntry]:
+    entries = []
+    listing = _git(['ls-tree', '-r', '-l', '-z', 'HEAD'], snapshot_path)
+    for record in filter(None, listing.split('\0')):
+        meta, _, path = record.partition('\t')
+        parts = meta.split()
+        if len(parts) != 4 or parts[1] != 'blob':
+            continue  # submodules
+        size = int(parts[3]) if parts[3].isdigit() else 0
+        entries.append((path, size, os.path.splitext(path)[1].lower(), parts[2]))
+
+    paths = [e[0] for e in entries]
+    # tracked files that match an ignore rule are usually committed build output
+    ignored = set(filter(None, _git(['ls-files', '-z', '-ci', '--exclude-standard'], snapshot_path).split('\0')))
+    flagged = _attr_flagged(snapshot_path, paths) if paths else set()
+
+    return [
+        FileEntry(path, size, ext, blob, bool(path in ignored or path in flagged or VENDORED_PATTERNS.search(path)))
+        for path, size, ext, blob in entries
+    ]
+
+
+@functools.lru_cache(maxsize=32)
+def _load_catalog(snapshot_path: str) -> tuple[FileEntry, ...]:
+    catalog_path = os.path.join(snapshot_path, '.git', CATALOG_FILE)
+    try:
+        with open(catalog_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') == CATALOG_VERSION:
+            return tuple(FileEntry(*row) for row in data['files'])
+    except (OSError, ValueError, TypeError):
+        pass
+
+    entries = build_catalog(snapshot_path)
+    # unique per process and thread / greenlet: gevent workers share a pid
+    tmp_path = f"{catalog_path}.{os.getpid()}_{threading.get_ident()}_{int(time.time() * 1000)}"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': CATALOG_VERSION, 'files': [list(e) for e in entries]}, f)
+        os.replace(tmp_path, catalog_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return tuple(entries)
+
+
+def load_catalog(snapshot_path: str) -> list[FileEntry]:
+    """
+    File listing of a snapshot (built once from git metadata, then read from
+    .git/nocode_catalog.json and memoized per process).
+    """
+    return list(_load_catalog(snapshot_path))
+
+
+def catalog_for_workspace(workspace_path: str) -> list[FileEntry] | None:
+    """Catalog of the workspace's snapshot, or None for non-snapshot workspaces (e.g. custom repos)."""
+    info = get_workspace_info(workspace_path)
+    if not info:
+        return None
+    return load_catalog(info['snapshot'])
@@ -0,0 +1,110 @@
+# agent_core/utils/import_graph.py
+import re
+import posixpath
+import functools
+
+from .workspace import get_workspace_info
+from .symbol_index import load_symbol_index
+
+# tests import everything and are not where a feature gets implemented
+TEST_PATH = re.compile(r'(^|/)(tests?|testing)/|(^|/)(test_[^/]*|[^/]*_tests?|conftest)\.py$')
+
+
+def module_names(paths) -> dict[str, str]:
+    """
+    Dotted module name of every Python file. The package root is the highest
+    directory chain carrying __init__.py, so src/ and lib/ layouts resolve too.
+    """
+    path_set = set(paths)
+    names = {}
+    for path in paths:
+        *dirs, stem = path[:-3].split('/')
+        k = len(dirs)
+        while k > 0 and '/'.join(dirs[:k]) + '/__init__.py' in path_set:
+            k -= 1
+        names[path] = '.'.join(dirs[k:] + ([] if stem == '__init__' else [stem]))
+    return names
+
+
+class ImportGraph:
+    def __init__(self, index):
+        paths = list(index.files)
+        self.module_of = module_names(paths)
+        self.path_of = {}
+        for path, name in self.module_of.items():
+            self.path_of.setdefault(name, path)
+
+        self.imports = {path: set() for path in paths}
+        self.importers = {path: set() for path in paths}
+        for path in paths:
+            for level, module, names in index.imports(path):
+                for target in self._resolve(path, level, module, names):
+                    if target != path:
+                        self.imports[path].add(target)
+                        self.importers[target].add(path)
+
+    def _resolve(self, path: str, level: int, module: str, names: list[str]):
+        if level:
+            package = self.module_of[path].split('.')
+            if not path.endswith('__init__.py'):
+                package.pop()
+            base = package[:len(package) - level + 1]
+            module = '.'.join(base + ([module] if module else []))
+        targets = []
+        for name in names:
+            # `from pkg import submodule`
+            sub = self.path_of.get(f"{module}.{name}" if module else name)
+            if sub:
+                targets.append(sub)
+        if targets:
+            return targets
+        parts = module.split('.')
+        while parts:
+            # `import a.b.c` where only a.b is part of the repo still counts as a.b
+            hit = self.path_of.get('.'.join(parts))
+            if hit:
+                targets.append(hit)
+                break
+            parts.pop()
+        return targets
+
+    def fan_in(self, path: str) -> int:
+        return len(self.importers.get(path, ()))
+
+    def neighbours(self, paths: list[str], limit: int) -> list[str]:
+        """
+        First-degree neighbours of `paths` (imports, importers and the package
+        __init__ that may re-export them), most connected to the selection first,
+        then by fan-in.
+        """
+        selected = set(paths)
+        links = {}
+        for path in paths:
+            related = self.imports.get(path, set()) | self.importers.get(path, set())
+            package_init = posixpath.join(posixpath.dirname(path), '__init__.py')
+            if package_init in self.imports:
+                related.add(package_init)
+            for other in related:
+                if other not in selected and not TEST_PATH.search(other):
+                    links[other] = links.get(other, 0) + 1
+        ranked = sorted(links, key=lambda p: (-links[p], -self.fan_in(p), p))
+        return ranked[:limit]
+
+
+@functools.lru_cache(maxsize=16)
+def load_import_graph(snapshot_path: str) -> ImportGraph:
+    """Module import graph of a snapshot, from the imports recorded in its symbol index."""
+    return ImportGraph(load_symbol_index(snapshot_path))
+
+
+def expand_related_files(workspace_path: str, files: list[str], limit: int) -> list[str]:
+    """`files` followed by up to `limit` of their import-graph neighbours."""
+    info = get_workspace_info(workspace_path)
+    if not info or limit <= 0 or not files:
+        return files
+    try:
+        graph = load_import_graph(info['snapshot'])
+    except Exception as e:
+        print(f"Warning: import graph unavailable for {info['snapshot']}: {e}")
+        return files
+    return files + graph.neighbours([f for f in files if f.endswith('.py')], limit)
@@ -0,0 +1,130 @@
+# agent_core/utils/lexical_index.py
+import os
+import re
+import json
+import math
+import hashlib
+import functools
+import threading
+import time
+from collections import Counter
+
+INDEX_FILE = 'nocode_bm25.json'
+INDEX_VERSION = 1
+MAX_FILE_BYTES = 1_000_000
+PATH_WEIGHT = 3  # path tokens count as if they appeared this many times
+
+_WORD = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_SUBWORD = re.compile(r'[A-Z]+(?=[A-Z][a-z]|\d|$)|[A-Z]?[a-z]+|[A-Z]+|\d+')
+_SIGNATURE = re.compile(r'^(class|def|async def)\s+(\w+)', re.MULTILINE)
+
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have if in into is it its not of on or so that the their then
+there these this to was were when which will with you your can should would may also such use used using
+def class self cls return import none true false pass else elif try except finally raise while lambda
+yield global nonlocal assert del async await py
+""".split())
+
+
+def tokenize(text: str):
+    """Lower-case identifiers plus their snake_case / camelCase parts, minus stopwords."""
+    for word in _WORD.findall(text):
+        lowered = word.lower()
+        if len(lowered) < 2 or lowered in STOPWORDS:
+            continue
+        yield lowered
+        parts = [p.lower() for chunk in word.split('_') for p in _SUBWORD.findall(chunk)]
+        if len(parts) > 1:
+            for part in parts:
+                if len(part) > 1 and part not in STOPWORDS:
+                    yield part
+
+
+def extract_signatures(content: str, limit: int = 8) -> list[str]:
+    """Top-level class / function names of a Python file, for compact prompt listings."""
+    names = [f"{kind.split()[-1]} {name}" for kind, name in _SIGNATURE.findall(content)]
+    return names[:limit]
+
+
+class LexicalIndex:
+    """BM25 inverted index over the identifiers, docstrings, comments and path tokens of a snapshot."""
+
+    def __init__(self, docs: list, postings: dict):
+        self.docs = docs  # [path, length, signatures]
+        self.postings = postings  # term -> [[doc index, term frequency], ...]
+        self.avgdl = (sum(d[1] for d in docs) / len(docs)) if docs else 0.0
+        self._by_path = {d[0]: d for d in docs}
+
+    @classmethod
+    def build(cls, snapshot_path: str, paths: list[str]) -> 'LexicalIndex':
+        docs, postings = [], {}
+        for path in paths:
+            full_path = os.path.join(snapshot_path, path)
+            try:
+                if os.path.getsize(full_path) > MAX_FILE_BYTES:
+                    continue
+                with open(full_path, 'r', encoding='utf-8', errors='replace') as f:
+                    content = f.read()
+            except OSError:
+                continue
+
+            counts = Counter(tokenize(content))
+            for token in tokenize(path.replace('/', ' ').replace('.', ' ')):
+                counts[token] += PATH_WEIGHT
+            doc_id = len(docs)
+            docs.append([path, sum(counts.values()), extract_signatures(content) if path.endswith('.py') else []])
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append([doc_id, tf])
+        return cls(docs, postings)
+
+    def search(self, query: str, top_k: int, k1: float = 1.5, b: float = 0.75) -> list[tuple[str, float]]:
+        n_docs = len(self.docs)
+        if not n_docs:
+            return []
+        scores = Counter()
+        for term in set(tokenize(query)):
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = math.log(1 + (n_docs - len(plist) + 0.5) / (len(plist) + 0.5))
+            for doc_id, tf in plist:
+                dl = self.docs[doc_id][1]
+                scores[doc_id] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / (self.avgdl or 1)))
+        return [(self.docs[doc_id][0], round(score, 4)) for doc_id, score in scores.most_common(top_k)]
+
+    def signatures(self, path: str) -> list[str]:
+        doc = self._by_path.get(path)
+        return doc[2] if doc else []
+
+
+def _paths_digest(paths) -> str:
+    return hashlib.sha1('\n'.join(paths).encode('utf-8')).hexdigest()
+
+
+@functools.lru_cache(maxsize=16)
+def load_lexical_index(snapshot_path: str, paths: tuple[str, ...]) -> LexicalIndex:
+    """
+    BM25 index of `paths` in a snapshot. Built once and stored in the
+    snapshot's .git; rebuilt only if the indexed file set changes.
+    """
+    index_path = os.path.join(snapshot_path, '.git', INDEX_FILE)
+    digest = _paths_digest(paths)
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') == INDEX_VERSION and data.get('paths') == digest:
+            return LexicalIndex(data['docs'], data['postings'])
+    except (OSError, ValueError):
+        pass
+
+    index = LexicalIndex.build(snapshot_path, list(paths))
+    # unique per process and thread / greenlet: gevent workers share a pid
+    tmp_path = f"{index_path}.{os.getpid()}_{threading.get_ident()}_{int(time.time() * 1000)}"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'paths': digest, 'docs': index.docs, 'postings': index.postings}, f)
+        os.replace(tmp_path, index_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return index
@@ -0,0 +1,255 @@
+# agent_core/utils/llm_cache.py
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import dataclasses
+from collections import OrderedDict
+from types import SimpleNamespace
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+USAGE_FIELDS = ('prompt_token_count', 'candidates_token_count', 'total_token_count', 'cached_content_token_count')
+
+
+class CachedResponse:
+    """Stand-in for a GenerateContentResponse: what the tasks read from one (.text, .usage_metadata)."""
+
+    def __init__(self, text: str, usage: dict | None = None, cached: bool = True):
+        self.text = text
+        self.usage = usage or {}
+        self.usage_metadata = SimpleNamespace(**{f: self.usage.get(f, 0) for f in USAGE_FIELDS})
+        self.cached = cached
+
+    @classmethod
+    def from_response(cls, response) -> 'CachedResponse | None':
+        try:
+            text = response.text
+        except Exception:
+            return None  # blocked / empty candidates: never cached
+        if not isinstance(text, str) or not text:
+            return None
+        meta = getattr(response, 'usage_metadata', None)
+        usage = {f: getattr(meta, f, 0) for f in USAGE_FIELDS} if meta is not None else {}
+        usage = {f: v for f, v in usage.items() if isinstance(v, int)}
+        return cls(text, usage)
+
+    def to_json(self) -> str:
+        return json.dumps({'text': self.text, 'usage': self.usage})
+
+    @classmethod
+    def from_json(cls, raw) -> 'CachedResponse':
+        data = json.loads(raw)
+        return cls(data['text'], data.get('usage'))
+
+
+def _jsonable(value):
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        value = dataclasses.asdict(value)
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items() if v is not None}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return repr(value)
+
+
+def response_key(model, prompt, generation_config=None) -> str | None:
+    """sha256 over (model name, model + call generation config, system instruction, cached content, prompt); None if uncacheable."""
+    model_name = getattr(model, 'model_name', None)
+    if not isinstance(model_name, str):
+        return None
+    payload = {
+        'model': model_name,
+        'model_config': _jsonable(getattr(model, '_generation_config', None)),
+        'system': _jsonable(getattr(model, '_system_instruction', None)),
+        # models bound to provider cached content: the cached prefix is part of the prompt
+        'cached_content': _jsonable(getattr(model, '_cached_content', None)),
+        'config': _jsonable(generation_config),
+        'prompt': _jsonable(prompt),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class DiskTier:
+    """One JSON file per response; expired by mtime, oldest files evicted above `max_bytes`."""
+
+    def __init__(self, root: str, ttl: int, max_bytes: int):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._writes = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> CachedResponse | None:
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return CachedResponse.from_json(f.read())
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def set(self, key: str, value: CachedResponse):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(value.to_json())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"LLM cache write failed: {e}")
+            return
+        self._writes += 1
+        if self._writes % 50 == 0:
+            self.prune()
+
+    def prune(self):
+        """Drop expired entries, then the oldest ones until the tier is under max_bytes."""
+        now = time.time()
+        entries, total = [], 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if now - st.st_mtime > self.ttl:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+class RedisTier:
+    """Shared by all workers; TTL per key, size eviction is left to Redis' maxmemory policy."""
+
+    def __init__(self, url: str, ttl: int):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key: str) -> CachedResponse | None:
+        try:
+            raw = self.client.get(f"nocode:llm:{key}")
+            return CachedResponse.from_json(raw) if raw else None
+        except Exception as e:
+            logger.warning(f"LLM cache read failed: {e}")
+            return None
+
+    def set(self, key: str, value: CachedResponse):
+        try:
+            self.client.set(f"nocode:llm:{key}", value.to_json(), ex=self.ttl)
+        except Exception as e:
+            logger.warning(f"LLM cache write failed: {e}")
+
+
+class ResponseCache:
+    """In-memory LRU (with TTL) in front of an optional disk / Redis tier."""
+
+    def __init__(self, max_entries: int, ttl: int, tier=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.tier = tier
+        self._entries: OrderedDict[str, tuple[float, CachedResponse]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.tier_hits = self.misses = self.stores = 0
+        self.saved_tokens = 0
+
+    def get(self, key: str) -> CachedResponse | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved_tokens += entry[1].usage.get('total_token_count', 0)
+                return entry[1]
+            self._entries.pop(key, None)
+
+        value = self.tier.get(key) if self.tier else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.tier_hits += 1
+            self.saved_tokens += value.usage.get('total_token_count', 0)
+        self._remember(key, value)
+        return value
+
+    def _remember(self, key: str, value: CachedResponse):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, key: str, value: CachedResponse):
+        self._remember(key, value)
+        if self.tier:
+            self.tier.set(key, value)
+        with self._lock:
+            self.stores += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.tier_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'tier_hits': self.tier_hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'saved_tokens': self.saved_tokens,
+                'hit_rate': round((self.hits + self.tier_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def make_tier(spec: str, ttl: int, max_bytes: int):
+    """'' -> memory only, 'redis://...' -> RedisTier, anything else is a DiskTier directory."""
+    if not spec:
+        return None
+    if spec.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisTier(spec, ttl)
+    return DiskTier(spec, ttl, max_bytes)
+
+
+def get_response_cache() -> ResponseCache | None:
+    """Process-wide response cache, or None when LLM_CACHE_ENABLED is off."""
+    global _cache
+    if not getattr(settings, 'LLM_CACHE_ENABLED', True):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            ttl = getattr(settings, 'LLM_CACHE_TTL_SECONDS', 7 * 24 * 3600)
+            _cache = ResponseCache(
+                getattr(settings, 'LLM_CACHE_MEMORY_ENTRIES', 256),
+                ttl,
+                make_tier(getattr(settings, 'LLM_CACHE_BACKEND', ''), ttl,
+                          getattr(settings, 'LLM_CACHE_MAX_BYTES', 1024 ** 3)),
+            )
+        return _cache
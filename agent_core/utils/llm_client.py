@@ -1,48 +1,279 @@
 # agent_core/utils/llm_client.py
-import os
 import json
 import re
 import logging
+from django.conf import settings
 from google.generativeai.types import GenerationConfig
 
+from .workspace import list_workspace_files, get_workspace_info
+from .file_catalog import catalog_for_workspace
+from .lexical_index import load_lexical_index
+from .symbol_index import load_symbol_index
+from .repo_summary import directory_summary, in_directories
+from .llm_cache import get_response_cache, response_key, CachedResponse, USAGE_FIELDS
+from .llm_retry import call_with_retry
+from .rate_limiter import get_rate_limiter
+from .llm_pool import generate_many
+from .context_cache import get_context_cache
+from .context_packer import count_tokens, file_block
+from .edit_blocks import EDIT_FORMAT_HELP
+from .log_condenser import fit_history
+
+SOURCE_EXTENSIONS = ('.py', '.html', '.css', '.js', '.c', '.cpp', '.h')
+
 logger = logging.getLogger(__name__)
 
-def generate_with_retry(model, prompt, generation_config=None):
+def _chunk_text(chunk) -> str:
+    try:
+        return chunk.text or ''
+    except ValueError:
+        return ''  # chunk without parts (e.g. the final one carrying only the finish reason)
+
+def generate_with_retry(model, prompt, generation_config=None, use_cache=True, on_file=None):
     """
-    直接呼叫 API
+    呼叫 API: retries 429 / 5xx / timeouts with jittered exponential backoff
+    (honouring server retry hints) within LLM_DEADLINE_SECONDS, optionally
+    hedging slow calls. Identical (model, config, prompt) calls are answered
+    from the response cache unless use_cache=False.
+
+    With `on_file(path, content)`, the response is streamed (LLM_STREAMING) and
+    each `--- START OF FILE` block is handed over as soon as it closes. A
+    failed stream is retried from scratch, so the callback may see a file
+    again; callers reconcile with parse_llm_response(response.text).
     """
-    return model.generate_content(prompt, generation_config=generation_config)
+    cache = get_response_cache() if use_cache else None
+    key = response_key(model, prompt, generation_config) if cache else None
+    if key:
+        cached = cache.get(key)
+        if cached is not None:
+            logger.info(f"LLM cache hit for {model.model_name} ({cache.stats()['hit_rate']:.0%} hit rate)")
+            if on_file is not None:
+                for file_path, content in parse_llm_response(cached.text).items():
+                    on_file(file_path, content)
+            return cached
+
+    model_name = getattr(model, 'model_name', '')
+    model_name = model_name if isinstance(model_name, str) else ''
+    limiter = get_rate_limiter()
+    estimated_tokens = count_tokens(prompt) if isinstance(prompt, str) else 0
+    stream = on_file is not None and getattr(settings, 'LLM_STREAMING', True)
+
+    def attempt(timeout):
+        # shared RPM / TPM quota + adaptive concurrency, per model
+        with limiter.slot(model_name, estimated_tokens) as record_usage:
+            if not stream:
+                response = model.generate_content(
+                    prompt, generation_config=generation_config, request_options={'timeout': timeout})
+                record_usage(response)
+                return response
+            response = model.generate_content(
+                prompt, generation_config=generation_config, request_options={'timeout': timeout}, stream=True)
+            parser = FileStreamParser()
+            for chunk in response:
+                for file_path, content in parser.feed(_chunk_text(chunk)):
+                    on_file(file_path, content)
+            for file_path, content in parser.close():
+                on_file(file_path, content)
+            record_usage(response)
+            return response
+
+    response = call_with_retry(
+        attempt,
+        key=model_name,
+        max_attempts=getattr(settings, 'LLM_MAX_ATTEMPTS', 5),
+        deadline=getattr(settings, 'LLM_DEADLINE_SECONDS', 600),
+        attempt_timeout=getattr(settings, 'LLM_ATTEMPT_TIMEOUT_SECONDS', 300),
+        # two concurrent streams would deliver every file twice
+        hedge_percentile=0 if stream else getattr(settings, 'LLM_HEDGE_PERCENTILE', 0),
+    )
+    if on_file is not None and not stream:
+        for file_path, content in parse_llm_response(response.text).items():
+            on_file(file_path, content)
+    if key:
+        entry = CachedResponse.from_response(response)
+        if entry is not None:
+            cache.put(key, entry)
+    return response
+
+_START_OF_FILE = re.compile(r'--- START OF FILE: (.*?) ---')
+_END_OF_FILE = re.compile(r'--- END OF FILE: .*? ---')
+
+class FileStreamParser:
+    """
+    Incremental `--- START OF FILE: path ---` / `--- END OF FILE: path ---`
+    parser: feed() it text as it arrives and it returns the (path, content) of
+    every file that closed in that piece. Each character is scanned once.
+    """
+
+    def __init__(self):
+        self._partial = []  # pieces of the current, unfinished line
+        self._path = None
+        self._lines = []
+
+    def feed(self, text: str) -> list[tuple[str, str]]:
+        if '\n' not in text:
+            self._partial.append(text)
+            return []
+        lines = (''.join(self._partial) + text).split('\n')
+        self._partial = [lines.pop()]
+        done = []
+        for line in lines:
+            self._line(line, done)
+        return done
+
+    def close(self) -> list[tuple[str, str]]:
+        """End of the response: a last file without its END marker still counts."""
+        done = []
+        tail = ''.join(self._partial)
+        self._partial = []
+        if tail:
+            self._line(tail, done)
+        self._finish(done)
+        return done
+
+    def _line(self, line: str, done: list):
+        start = _START_OF_FILE.search(line)
+        if start and not line[start.end():].strip():
+            if self._path is not None:
+                self._lines.append(line[:start.start()])
+            self._finish(done)
+            self._path = start.group(1).strip()
+            return
+        if self._path is None:
+            return  # prose between files
+        end = _END_OF_FILE.search(line)
+        if end:
+            self._lines.append(line[:end.start()])
+            self._finish(done)
+            return
+        self._lines.append(line)
+
+    def _finish(self, done: list):
+        if self._path is not None:
+            content = '\n'.join(self._lines).strip()
+            if self._path and content:
+                done.append((self._path, content))
+        self._path = None
+        self._lines = []
 
 def parse_llm_response(raw_response_text: str) -> dict[str, str]:
-    modified_files = {}
-    file_chunks = re.split(r'--- START OF FILE: (.*?) ---\n', raw_response_text)
-    if len(file_chunks) < 2:
-        return modified_files
-    for i in range(1, len(file_chunks), 2):
-        file_path = file_chunks[i].strip()
-        content = re.sub(r'--- END OF FILE: .*? ---', '', file_chunks[i+1], flags=re.DOTALL).strip()
-        if file_path and content:
-            modified_files[file_path] = content
-    return modified_files
+    parser = FileStreamParser()
+    return dict(parser.feed(raw_response_text) + parser.close())
+
+def _rank_candidates(doc_change: str, workspace_path: str, all_files: list[str], top_k: int,
+                     within: list[str] | None = None) -> list[str] | None:
+    """
+    BM25 pre-ranking against the snapshot's lexical index: the top-K files
+    (of `within` if given), each followed by a few of its class / def names.
+    None when unavailable.
+    """
+    pool = within if within is not None else all_files
+    info = get_workspace_info(workspace_path)
+    if not info or top_k <= 0 or (within is None and len(all_files) <= top_k):
+        return None
+    try:
+        index = load_lexical_index(info['snapshot'], tuple(all_files))
+    except Exception as e:
+        logger.warning(f"Lexical index unavailable for {info['snapshot']}: {e}")
+        return None
+    if len(pool) <= top_k:
+        ranked = pool
+    else:
+        allowed = set(pool)
+        ranked = [p for p, _ in index.search(doc_change, len(all_files)) if p in allowed][:top_k]
+    lines = []
+    for path in ranked:
+        signatures = index.signatures(path)
+        lines.append(f"{path}: {', '.join(signatures)}" if signatures else path)
+    return lines or None
+
+def _select_directories(model, doc_change: str, workspace_path: str, all_files: list[str]) -> list[str] | None:
+    """
+    First stage for very large repos: the model picks directories from a
+    compact tree summary. Returns the files under them, or None.
+    """
+    info = get_workspace_info(workspace_path)
+    symbols = None
+    if info:
+        try:
+            symbols = load_symbol_index(info['snapshot'])
+        except Exception as e:
+            logger.warning(f"Symbol index unavailable for {info['snapshot']}: {e}")
+    summary = directory_summary(all_files, symbols, max_dirs=getattr(settings, 'RETRIEVAL_SUMMARY_DIRS', 300))
+
+    prompt = (
+        f"You are a tech lead. Identify where in the repository this documentation change must be implemented.\n"
+        f"**DOC CHANGE:**\n{doc_change}\n\n"
+        f"**DIRECTORIES (file count: main classes / functions):**\n" + "\n".join(summary) + "\n\n"
+        f"**INSTRUCTIONS:**\n"
+        "1. Pick the few directories that contain the code to modify.\n"
+        "2. Return JSON: {\"directories\": [\"path/to/package/\"]}\n"
+    )
+    try:
+        response = generate_with_retry(
+            model,
+            prompt,
+            generation_config=GenerationConfig(response_mime_type="application/json")
+        )
+        directories = [d for d in json.loads(response.text).get("directories", []) if isinstance(d, str)]
+    except Exception as e:
+        print(f"Error in directory selection: {e}")
+        return None
+    subset = [f for f in all_files if in_directories(f, directories)]
+    logger.info(f"Directory stage picked {directories} ({len(subset)} of {len(all_files)} files)")
+    return subset or None
+
+def _resolve_symbols(doc_change: str, workspace_path: str, all_files: list[str]) -> list[str]:
+    """Files defining the classes / functions named in the doc change (e.g. `Axes.bar_label`)."""
+    info = get_workspace_info(workspace_path)
+    if not info:
+        return []
+    try:
+        index = load_symbol_index(info['snapshot'])
+    except Exception as e:
+        logger.warning(f"Symbol index unavailable for {info['snapshot']}: {e}")
+        return []
+    known = set(all_files)
+    return [f for f in index.resolve(doc_change) if f in known]
 
 def get_relevant_files(model, doc_change: str, workspace_path: str) -> list[str]:
-    all_files = []
-    for root, dirs, files in os.walk(workspace_path):
-        if '.git' in dirs: dirs.remove('.git')
-        if '.venv' in dirs: dirs.remove('.venv')
-        if 'venv' in dirs: dirs.remove('venv')
-        for file in files:
-            if file.endswith(('.py', '.html', '.css', '.js', '.c', '.cpp', '.h')):
-                rel_path = os.path.relpath(os.path.join(root, file), workspace_path)
-                all_files.append(rel_path.replace('\\', '/'))
+    catalog = catalog_for_workspace(workspace_path)
+    if catalog is not None:
+        # persistent per-commit listing, no directory walk
+        all_files = [e.path for e in catalog if e.ext in SOURCE_EXTENSIONS and not e.vendored]
+    else:
+        all_files = [f for f in list_workspace_files(workspace_path) if f.endswith(SOURCE_EXTENSIONS)]
     
     if not all_files: return []
 
+    # definitions of symbols the doc change names are taken as-is
+    defining_files = _resolve_symbols(doc_change, workspace_path, all_files)
+
+    # huge repos: pick directories from a tree summary first, then files inside them
+    subset = None
+    if len(all_files) > getattr(settings, 'RETRIEVAL_HIERARCHY_THRESHOLD', 5000):
+        subset = _select_directories(model, doc_change, workspace_path, all_files)
+    pool = subset or all_files
+
+    top_k = getattr(settings, 'RETRIEVAL_TOP_K', 200)
+    candidates = _rank_candidates(doc_change, workspace_path, all_files, top_k, within=subset)
+    if candidates:
+        files_section = (
+            f"**CANDIDATE FILES (top {len(candidates)} of {len(pool)} by lexical match with the doc change):**\n"
+            + "\n".join(candidates) + "\n"
+        )
+    else:
+        files_section = f"**FILES:**\n{', '.join(pool[:3000])}\n(Total {len(pool)} files)\n"
+    if defining_files:
+        files_section = (
+            f"**ALREADY SELECTED (they define symbols named in the doc change):**\n{', '.join(defining_files)}\n\n"
+            + files_section
+        )
+
     prompt = (
         f"You are a tech lead. Identify the files needed to implement this documentation change.\n"
         f"**DOC CHANGE:**\n{doc_change}\n\n"
-        f"**FILES:**\n{', '.join(all_files[:3000])}\n"
-        f"(Total {len(all_files)} files)\n\n"
+        f"{files_section}\n"
         f"**INSTRUCTIONS:**\n"
         "1. Identify the CORE files that need modification.\n"
         "2. Return JSON: {{\"files\": [\"path/to/core.py\"]}}\n"
@@ -57,45 +288,180 @@ def get_relevant_files(model, doc_change: str, workspace_path: str) -> list[str]
         )
         data = json.loads(response.text)
         llm_files = data.get("files", [])
-        valid_files = [f for f in llm_files if f in all_files]
-        return valid_files
+        known = set(all_files)
+        valid_files = [f for f in llm_files if f in known]
+        return list(dict.fromkeys(defining_files + valid_files))
     except Exception as e:
         print(f"Error in file finding: {e}")
-        return []
+        return defining_files
+
+def build_prompt_parts(doc_change: str, context_content_str: str, history: list[str],
+                       edit_format: str | None = None) -> tuple[str, str]:
+    """
+    (prefix, suffix) of the coder prompt. The prefix holds the instructions and
+    the file contents only, so it is identical for every attempt, candidate and
+    task that works on the same files and can be cached by the provider; the
+    doc change and failed attempts follow in the suffix.
+    """
+    # edit_format: 'search_replace' (SEARCH / REPLACE hunks per file) or 'whole' (full file contents)
+    edit_format = edit_format or getattr(settings, 'LLM_EDIT_FORMAT', 'search_replace')
+    if edit_format == 'whole':
+        elided_rule = ("4.  **Keep ELIDED Markers:** Lines shown as `... [ELIDED lines A-B] ...` were left out of the context; "
+                       "copy such a marker unchanged where you do not modify that part and it will be restored.\n")
+        output_rule = "Response MUST ONLY contain full file contents using the delimiter format."
+        output_format = "--- START OF FILE: path/to/file1.py ---\n(content)\n--- END OF FILE: path/to/file1.py ---\n"
+    else:
+        elided_rule = ("4.  **Anchor on Shown Lines:** Lines shown as `... [ELIDED lines A-B] ...` were left out of the context; "
+                       "never put such a marker in a SEARCH section.\n")
+        output_rule = ("Response MUST ONLY contain SEARCH/REPLACE edits using the delimiter format, one block per file. "
+                       "Each SEARCH section copies a few consecutive lines of the original file exactly (enough to be unique) "
+                       "and hunks are applied in order. To create a new file, leave its SEARCH section empty.")
+        output_format = EDIT_FORMAT_HELP
 
-def build_prompt_for_attempt(doc_change: str, context_content_str: str, history: list[str]) -> str:
-    # (此函數保持不變)
     safety_checklist = (
         "**CRITICAL SAFETY CHECKLIST:**\n"
         "1.  **Verify APIs:** Before calling a method, verify it exists in the class definition.\n"
         "2.  **Do NOT Change Signatures:** Keep arguments/return types unless necessary.\n"
         "3.  **Check Imports:** Do not remove necessary imports.\n"
+        f"{elided_rule}"
+    )
+
+    prefix = (
+        f"You are an expert AI software engineer. You implement features described by documentation changes "
+        f"in the repository files below.\n\n"
+        f"{safety_checklist}\n"
+        f"**INSTRUCTIONS:**\n"
+        f"1. {output_rule}\n"
+        "2. DO NOT modify test files.\n\n"
+        "**FORMAT:**\n"
+        f"{output_format}\n"
+        f"**ORIGINAL FILE CONTENTS:**\n{context_content_str}\n\n"
     )
 
     if not history:
-        return (
-            f"You are an expert AI software engineer. Implement a feature based on a documentation change.\n\n"
+        suffix = (
             f"**DOCUMENTATION CHANGE:**\n{doc_change}\n\n"
-            f"**ORIGINAL FILE CONTENTS:**\n{context_content_str}\n\n"
-            f"{safety_checklist}\n"
-            f"**INSTRUCTIONS:**\n"
-            "1. Read files and implement the change.\n"
-            "2. Response MUST ONLY contain full file contents using the delimiter format.\n"
-            "3. DO NOT modify test files.\n\n"
-            "**FORMAT:**\n"
-            "--- START OF FILE: path/to/file1.py ---\n(content)\n--- END OF FILE: path/to/file1.py ---\n"
+            "**YOUR TASK:**\n"
+            "Read the files above and implement the documentation change.\n"
         )
-    
-    history_str = "\n\n".join(history)
-    return (
-        f"You are an expert AI software engineer. Previous attempt failed.\n\n"
-        f"**ORIGINAL DOC CHANGE:**\n{doc_change}\n\n"
-        f"**ORIGINAL FILES:**\n{context_content_str}\n\n"
+        return prefix, suffix
+
+    # older attempts shrink to a line once the newer ones use up the budget
+    history_str = "\n\n".join(fit_history(history, getattr(settings, 'RETRY_HISTORY_TOKEN_BUDGET', 6000)))
+    suffix = (
+        f"**DOCUMENTATION CHANGE:**\n{doc_change}\n\n"
         f"**PREVIOUS FAILED ATTEMPTS:**\n{history_str}\n\n"
-        f"{safety_checklist}\n"
-        f"**YOUR TASK:**\n"
-        "Analyze errors (AttributeError, ImportError, etc.) and Fix the Logic.\n"
-        "Provide full file contents.\n"
-        "**FORMAT:**\n"
-        "--- START OF FILE: path/to/file1.py ---\n(content)\n--- END OF FILE: path/to/file1.py ---\n"
-    )
\ No newline at end of file
+        "**YOUR TASK:**\n"
+        "Previous attempt failed. Analyze errors (AttributeError, ImportError, etc.) and Fix the Logic.\n"
+    )
+    return prefix, suffix
+
+def build_prompt_for_attempt(doc_change: str, context_content_str: str, history: list[str],
+                             edit_format: str | None = None) -> str:
+    return "".join(build_prompt_parts(doc_change, context_content_str, history, edit_format))
+
+def with_cached_prefix(model, prefix: str, suffix: str, reused: bool = False) -> tuple:
+    """
+    (model, prompt) to send for a (prefix, suffix) prompt: a model bound to the
+    prefix as provider cached content plus the suffix when the prefix is big
+    enough (LLM_CONTEXT_CACHE), else the model and the whole prompt.
+    Registering a prefix costs calls and storage, so only prefixes the caller
+    will send again (`reused`) are cached; the others always go inline.
+    """
+    cache = get_context_cache() if reused else None
+    cached_model = cache.model_for(model, prefix) if cache else None
+    if cached_model is None:
+        return model, prefix + suffix
+    return cached_model, suffix
+
+def build_plan_prompt(doc_change: str, context_content_str: str, history: list[str]) -> str:
+    history = fit_history(history, getattr(settings, 'RETRY_HISTORY_TOKEN_BUDGET', 6000))
+    history_str = ("**PREVIOUS FAILED ATTEMPTS:**\n" + "\n\n".join(history) + "\n\n") if history else ""
+    return (
+        f"You are a tech lead. Plan the implementation of this documentation change, file by file.\n\n"
+        f"**DOCUMENTATION CHANGE:**\n{doc_change}\n\n"
+        f"**ORIGINAL FILE CONTENTS:**\n{context_content_str}\n\n"
+        f"{history_str}"
+        f"**INSTRUCTIONS:**\n"
+        "1. List every file that must change (or be created), test files excluded.\n"
+        "2. For each, describe its change precisely, naming the functions, classes and arguments "
+        "other files rely on: each file will be edited separately, following only this plan.\n"
+        "3. Return JSON: {\"files\": [{\"path\": \"path/to/file1.py\", \"change\": \"...\"}]}\n"
+    )
+
+def parse_change_plan(raw_response_text: str) -> list[tuple[str, str]]:
+    """(path, change) pairs of a planning response, in order, one per file."""
+    try:
+        entries = json.loads(raw_response_text).get("files", [])
+    except (ValueError, AttributeError):
+        return []
+    plan = {}
+    for entry in entries:
+        if not isinstance(entry, dict): continue
+        path, change = entry.get("path"), entry.get("change")
+        if isinstance(path, str) and path.strip() and '..' not in path and isinstance(change, str):
+            plan.setdefault(path.strip(), change.strip())
+    return list(plan.items())
+
+def build_file_prompt(doc_change: str, context_content_str: str, history: list[str],
+                      plan: list[tuple[str, str]], file_path: str) -> tuple[str, str]:
+    # (prefix, suffix): the shared part comes first, the file-specific part last
+    plan_str = "\n".join(f"- {path}: {change}" for path, change in plan)
+    change = dict(plan)[file_path]
+    prefix, suffix = build_prompt_parts(doc_change, context_content_str, history)
+    return prefix, (
+        suffix
+        + f"\n**CHANGE PLAN (the other files are edited separately, following the same plan):**\n{plan_str}\n\n"
+        f"**YOUR PART:** Output ONLY the block for `{file_path}`: {change}\n"
+    )
+
+def _usage(response) -> dict:
+    meta = getattr(response, 'usage_metadata', None)
+    usage = {f: getattr(meta, f, 0) for f in USAGE_FIELDS} if meta is not None else {}
+    return {f: v for f, v in usage.items() if isinstance(v, int)}
+
+def generate_parallel_edits(model, doc_change: str, context_content_str: str, history: list[str]):
+    """
+    A short planning call, then one concurrent call per planned file, merged
+    into a single response in the usual delimiter format (.text with the plan
+    and every file block, .usage_metadata summed). None when the plan has
+    fewer than two files, or when planning or every file call fails, so the
+    caller makes one regular call.
+    """
+    try:
+        plan_response = generate_with_retry(
+            model,
+            build_plan_prompt(doc_change, context_content_str, history),
+            generation_config=GenerationConfig(response_mime_type="application/json")
+        )
+        plan = parse_change_plan(plan_response.text)
+    except Exception as e:
+        logger.warning(f"Change planning failed, generating all files in one call: {e}")
+        return None
+    if len(plan) < 2:
+        return None
+
+    logger.info(f"Generating {len(plan)} files concurrently")
+    # the prefix is the same for every file: cached once, then only the suffixes are sent
+    results = generate_many([
+        with_cached_prefix(model, *build_file_prompt(doc_change, context_content_str, history, plan, path), reused=True)
+        for path, _ in plan
+    ])
+    usage = _usage(plan_response)
+    blocks = []
+    for (path, _), result in zip(plan, results):
+        if isinstance(result, BaseException):
+            logger.warning(f"Edit generation for {path} failed: {result}")
+            continue
+        for field, value in _usage(result).items():
+            usage[field] = usage.get(field, 0) + value
+        content = parse_llm_response(result.text).get(path)
+        if content is None:
+            logger.warning(f"Edit generation for {path} returned no block for it")
+            continue
+        blocks.append(file_block(path, content))
+    if not blocks:
+        logger.warning("Parallel edit generation produced no file, generating all files in one call")
+        return None
+    plan_str = "\n".join(f"- {path}: {change}" for path, change in plan)
+    return CachedResponse(f"PLAN:\n{plan_str}\n\n" + "".join(blocks), usage, cached=False)
@@ -0,0 +1,137 @@
+# agent_core/utils/llm_pool.py
+import os
+import asyncio
+import logging
+import threading
+import weakref
+from django.conf import settings
+from google import generativeai as genai
+
+from .llm_cache import get_response_cache, response_key, CachedResponse
+from .llm_retry import call_with_retry_async
+from .rate_limiter import get_rate_limiter
+from .context_packer import count_tokens
+
+logger = logging.getLogger(__name__)
+
+_models: dict[str, genai.GenerativeModel] = {}
+_configured_key = None
+_lock = threading.Lock()
+# event loop -> {model name: Semaphore}; asyncio primitives belong to one loop
+_semaphores = weakref.WeakKeyDictionary()
+# (loop, pid): the loop all sync callers share; a forked child starts its own
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_model(model_name: str, api_key: str | None = None) -> genai.GenerativeModel:
+    """
+    Long-lived GenerativeModel per model name, shared by every task of the
+    process. genai.configure runs once (again only if the API key changes).
+    """
+    global _configured_key
+    api_key = api_key or settings.GEMINI_API_KEY
+    with _lock:
+        if not api_key:
+            raise Exception("Gemini client not configured.")
+        if _configured_key != api_key:
+            genai.configure(api_key=api_key)
+            _configured_key = api_key
+            _models.clear()
+        model = _models.get(model_name)
+        if model is None:
+            model = _models[model_name] = genai.GenerativeModel(model_name)
+        return model
+
+
+def _semaphore(model_name: str) -> asyncio.Semaphore:
+    per_loop = _semaphores.setdefault(asyncio.get_running_loop(), {})
+    if model_name not in per_loop:
+        per_loop[model_name] = asyncio.Semaphore(getattr(settings, 'LLM_ASYNC_CONCURRENCY', 16))
+    return per_loop[model_name]
+
+
+async def generate_async(model, prompt, generation_config=None, use_cache=True):
+    """
+    Awaitable generate_with_retry: same response cache, shared quota buckets,
+    AIMD concurrency limit and retry rules, with at most LLM_ASYNC_CONCURRENCY
+    calls in flight per model and event loop. `model` is a GenerativeModel or a model name.
+    """
+    if isinstance(model, str):
+        model = get_model(model)
+    model_name = getattr(model, 'model_name', '')
+    model_name = model_name if isinstance(model_name, str) else ''
+
+    cache = get_response_cache() if use_cache else None
+    key = response_key(model, prompt, generation_config) if cache else None
+    if key:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    limiter = get_rate_limiter()
+    estimated_tokens = count_tokens(prompt) if isinstance(prompt, str) else 0
+
+    async def attempt(timeout):
+        # same quota buckets and AIMD limit as the sync path, so bursts and 429s are seen there too
+        async with limiter.slot_async(model_name, estimated_tokens) as record_usage:
+            response = await model.generate_content_async(
+                prompt, generation_config=generation_config, request_options={'timeout': timeout})
+            record_usage(response)
+            return response
+
+    async with _semaphore(model_name):
+        response = await call_with_retry_async(
+            attempt,
+            key=model_name,
+            max_attempts=getattr(settings, 'LLM_MAX_ATTEMPTS', 5),
+            deadline=getattr(settings, 'LLM_DEADLINE_SECONDS', 600),
+            attempt_timeout=getattr(settings, 'LLM_ATTEMPT_TIMEOUT_SECONDS', 300),
+            hedge_percentile=getattr(settings, 'LLM_HEDGE_PERCENTILE', 0),
+        )
+    if key:
+        entry = CachedResponse.from_response(response)
+        if entry is not None:
+            cache.put(key, entry)
+    return response
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    """
+    The process's event loop, running in a daemon thread. The genai async
+    client (and its grpc.aio channel) binds to the first loop it is used on,
+    so every call has to go through the same, never closed, loop.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop[1] != os.getpid() or _loop[0].is_closed():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='nocode-llm-loop', daemon=True).start()
+            _loop = (loop, os.getpid())
+        return _loop[0]
+
+
+def run_async(coro):
+    """
+    Run a coroutine from synchronous code (Celery tasks) on the shared
+    background loop and wait for its result. Under the gevent pool the wait
+    is cooperative, so other greenlets keep running.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run_coroutine_threadsafe(coro, _background_loop()).result()
+    coro.close()
+    raise RuntimeError("run_async() called from a running event loop; await the coroutine instead")
+
+
+def generate_many(requests: list[tuple], return_exceptions: bool = True) -> list:
+    """
+    Keep many LLM calls in flight from one worker: each request is a tuple of
+    generate_async arguments (model, prompt[, generation_config]). Results come
+    back in order; failures are returned as exceptions unless told otherwise.
+    """
+    async def gather():
+        return await asyncio.gather(*(generate_async(*request) for request in requests),
+                                    return_exceptions=return_exceptions)
+    return run_async(gather())
@@ -0,0 +1,198 @@
+# agent_core/utils/llm_retry.py
+import re
+import time
+import asyncio
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from google.api_core import exceptions as api_exceptions
+
+logger = logging.getLogger(__name__)
+
+# 429 / 5xx / timeouts: worth another try. Anything else (400, 403, safety blocks) is not.
+RETRYABLE = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.InternalServerError,
+    api_exceptions.BadGateway,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.Aborted,
+    ConnectionError,
+    TimeoutError,
+)
+
+_RETRY_IN = re.compile(r'retry in ([\d.]+)\s*(ms|s)\b', re.IGNORECASE)
+_RETRY_DELAY = re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)(?:\s*nanos:\s*(\d+))?')
+
+
+class DeadlineExhausted(Exception):
+    """The call (including retries) did not finish before its deadline."""
+
+
+def retry_hint(exc: Exception) -> float | None:
+    """Server-suggested wait in seconds (google.rpc.RetryInfo or a 'retry in Ns' message), if any."""
+    for detail in getattr(exc, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None and hasattr(delay, 'seconds'):
+            return delay.seconds + getattr(delay, 'nanos', 0) / 1e9
+    text = str(exc)
+    match = _RETRY_DELAY.search(text)
+    if match:
+        return int(match.group(1)) + int(match.group(2) or 0) / 1e9
+    match = _RETRY_IN.search(text)
+    if match:
+        value = float(match.group(1))
+        return value / 1000 if match.group(2).lower() == 'ms' else value
+    return None
+
+
+def backoff_delay(attempt: int, base: float, cap: float, hint: float | None = None) -> float:
+    """Exponential backoff with equal jitter; never shorter than the server's hint."""
+    ceiling = min(cap, base * (2 ** attempt))
+    delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+    return max(delay, hint or 0.0)
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies per model, for the hedging threshold."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, key: str, pct: float) -> float | None:
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+latencies = LatencyTracker()
+_hedge_executor = None
+_hedge_lock = threading.Lock()
+
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+    with _hedge_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='nocode-llm')
+        return _hedge_executor
+
+
+def _hedged(call, timeout: float, hedge_after: float | None):
+    """
+    Run `call(timeout)`; if it has not returned after `hedge_after` seconds,
+    fire a duplicate and take whichever succeeds first. The loser keeps
+    running in the background and its result is dropped.
+    """
+    if hedge_after is None or hedge_after >= timeout:
+        return call(timeout)
+
+    executor = _get_hedge_executor()
+    started = time.monotonic()
+    futures = [executor.submit(call, timeout)]
+    done, _ = wait(futures, timeout=hedge_after)
+    if not done:
+        logger.info(f"LLM call slower than {hedge_after:.1f}s, sending a hedged request")
+        futures.append(executor.submit(call, max(1.0, timeout - (time.monotonic() - started))))
+
+    pending, error = set(futures), None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call_with_retry(call, *, key: str = '', max_attempts: int = 5, deadline: float = 600.0,
+                    attempt_timeout: float = 300.0, base_delay: float = 2.0, max_delay: float = 60.0,
+                    hedge_percentile: float = 0.0, sleep=time.sleep):
+    """
+    `call(timeout)` with jittered exponential backoff on retryable errors,
+    honouring server retry hints, within an overall `deadline` (seconds). With
+    `hedge_percentile` > 0, a duplicate request is fired once an attempt runs
+    longer than that percentile of recent latencies for `key`.
+    """
+    started = time.monotonic()
+    for attempt in range(max_attempts):
+        remaining = deadline - (time.monotonic() - started)
+        if remaining <= 0:
+            raise DeadlineExhausted(f"LLM call exceeded its {deadline:.0f}s deadline")
+        hedge_after = latencies.percentile(key, hedge_percentile) if hedge_percentile else None
+        t0 = time.monotonic()
+        try:
+            result = _hedged(call, min(attempt_timeout, remaining), hedge_after)
+            latencies.record(key, time.monotonic() - t0)
+            return result
+        except RETRYABLE as e:
+            if attempt == max_attempts - 1:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay, retry_hint(e))
+            if time.monotonic() - started + delay >= deadline:
+                raise
+            logger.warning(f"LLM call failed ({type(e).__name__}: {e}); retry {attempt + 1}/{max_attempts - 1} in {delay:.1f}s")
+            sleep(delay)
+
+
+async def _hedged_async(call, timeout: float, hedge_after: float | None):
+    """asyncio version of _hedged: the slower request is cancelled once one succeeds."""
+    if hedge_after is None or hedge_after >= timeout:
+        return await asyncio.wait_for(call(timeout), timeout)
+
+    tasks = [asyncio.ensure_future(asyncio.wait_for(call(timeout), timeout))]
+    done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+    if not done:
+        logger.info(f"LLM call slower than {hedge_after:.1f}s, sending a hedged request")
+        tasks.append(asyncio.ensure_future(asyncio.wait_for(call(timeout), max(1.0, timeout - hedge_after))))
+
+    pending, error = set(tasks), None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call_with_retry_async(call, *, key: str = '', max_attempts: int = 5, deadline: float = 600.0,
+                                attempt_timeout: float = 300.0, base_delay: float = 2.0, max_delay: float = 60.0,
+                                hedge_percentile: float = 0.0, sleep=asyncio.sleep):
+    """call_with_retry for coroutines: `await call(timeout)`, same backoff, deadline and hedging rules."""
+    started = time.monotonic()
+    for attempt in range(max_attempts):
+        remaining = deadline - (time.monotonic() - started)
+        if remaining <= 0:
+            raise DeadlineExhausted(f"LLM call exceeded its {deadline:.0f}s deadline")
+        hedge_after = latencies.percentile(key, hedge_percentile) if hedge_percentile else None
+        t0 = time.monotonic()
+        try:
+            result = await _hedged_async(call, min(attempt_timeout, remaining), hedge_after)
+            latencies.record(key, time.monotonic() - t0)
+            return result
+        except RETRYABLE as e:
+            if attempt == max_attempts - 1:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay, retry_hint(e))
+            if time.monotonic() - started + delay >= deadline:
+                raise
+            logger.warning(f"LLM call failed ({type(e).__name__}: {e}); retry {attempt + 1}/{max_attempts - 1} in {delay:.1f}s")
+            await sleep(delay)
@@ -0,0 +1,126 @@
+# agent_core/utils/log_condenser.py
+import re
+from collections import Counter
+
+from .context_packer import count_tokens
+
+_PATCH_FILE = re.compile(r'^diff --git a/(\S+) b/')
+_PYTEST_RESULT = re.compile(r'^(?:FAILED|ERROR) (\S+::\S+)(?: - (.*))?$')
+_DJANGO_RESULT = re.compile(r'^(?:FAIL|ERROR): (\w+) \(([\w.]+)\)')
+_PY_FRAME = re.compile(r'^\s*File "([^"]+)", line (\d+), in (.+)$')
+_PYTEST_FRAME = re.compile(r'^([\w/.\-]+\.py):(\d+): (?:in )?(\S+)')
+_EXCEPTION = re.compile(r'^(?:E\s+)?((?:[A-Za-z_]\w*\.)*[A-Za-z_]\w*(?:Error|Exception|Exit|Failure))(?::\s*(.*))?$')
+_SUMMARY = re.compile(r'^(?:=+ .*\b(?:passed|failed|error)\b.* =+|Ran \d+ tests? in .*|FAILED \(.*\)|OK)$')
+# short blocks the task puts in front of the test output, kept as they are
+_VERBATIM_HEADERS = ('EDITS NOT APPLIED:', 'GENERATED FILES DO NOT COMPILE:')
+
+MAX_TESTS = 20
+MAX_EXCEPTIONS = 10
+MAX_FRAMES = 15
+MAX_VERBATIM_LINES = 20
+FALLBACK_TAIL_LINES = 30
+
+
+def patch_files(patch: str) -> list[str]:
+    return list(dict.fromkeys(m.group(1) for m in map(_PATCH_FILE.match, patch.split('\n')) if m))
+
+
+def condense_test_output(output: str, edited_files: list[str]) -> str:
+    """
+    The part of a test run a retry needs: failing test IDs, distinct
+    exceptions, and traceback frames that point into the edited files. Falls
+    back to the tail of the log when none of these can be found.
+    """
+    lines = output.split('\n')
+    verbatim, tests, exceptions, frames, summary = [], {}, Counter(), [], []
+    block = None
+    for i, line in enumerate(lines):
+        if block is not None:
+            if line.strip() and len(block) < MAX_VERBATIM_LINES:
+                block.append(line)
+                continue
+            if line.strip():
+                continue
+            verbatim.extend(block + [''])
+            block = None
+            continue
+        stripped = line.strip()
+        if stripped in _VERBATIM_HEADERS:
+            block = [stripped]
+            continue
+        m = _PYTEST_RESULT.match(stripped)
+        if m:
+            tests.setdefault(m.group(1), (m.group(2) or '')[:200])
+            continue
+        m = _DJANGO_RESULT.match(stripped)
+        if m:
+            tests.setdefault(f"{m.group(2)}.{m.group(1)}", '')
+            continue
+        m = _EXCEPTION.match(stripped)
+        if m:
+            exceptions[f"{m.group(1)}: {(m.group(2) or '').strip()[:200]}".rstrip(': ')] += 1
+            continue
+        m = _PY_FRAME.match(line) or _PYTEST_FRAME.match(stripped)
+        if m and any(m.group(1) == f or m.group(1).endswith('/' + f) for f in edited_files):
+            code = lines[i + 1].strip() if _PY_FRAME.match(line) and i + 1 < len(lines) else ''
+            frame = f"{m.group(1)}:{m.group(2)} in {m.group(3)}" + (f": {code}" if code else '')
+            if frame not in frames:
+                frames.append(frame)
+            continue
+        if _SUMMARY.match(stripped):
+            summary.append(stripped)
+    if block is not None:
+        verbatim.extend(block + [''])
+
+    parts = list(verbatim)
+    if tests:
+        parts.append(f"FAILING TESTS ({len(tests)}):")
+        parts += [f"- {t}" + (f": {msg}" if msg else '') for t, msg in list(tests.items())[:MAX_TESTS]]
+        if len(tests) > MAX_TESTS:
+            parts.append(f"- ... {len(tests) - MAX_TESTS} more")
+    if exceptions:
+        parts.append("EXCEPTIONS:")
+        parts += [f"- {e}" + (f" (x{n})" if n > 1 else '') for e, n in exceptions.most_common(MAX_EXCEPTIONS)]
+    if frames:
+        parts.append("TRACEBACK FRAMES IN EDITED FILES:")
+        parts += [f"- {f}" for f in frames[:MAX_FRAMES]]
+    if summary:
+        parts.append("SUMMARY: " + " | ".join(summary[-4:]))
+    if not (tests or exceptions or frames):
+        tail = [l for l in lines if l.strip()][-FALLBACK_TAIL_LINES:]
+        parts += ["LOG TAIL:"] + tail
+    return '\n'.join(parts).strip()
+
+
+def condense_patch(patch: str, max_lines: int = 200) -> str:
+    """Hunk headers and changed lines only: the unchanged lines are in the file contents already."""
+    kept = []
+    for line in patch.split('\n'):
+        if line.startswith(('diff --git', '@@')) or (line.startswith(('+', '-')) and not line.startswith(('+++', '---'))):
+            kept.append(line)
+    if len(kept) > max_lines:
+        kept = kept[:max_lines] + [f"... {len(kept) - max_lines} more changed lines"]
+    return '\n'.join(kept)
+
+
+def condense_attempt(attempt_num: int, patch: str, test_output: str, previous_patch: str | None = None) -> str:
+    """History entry for a failed attempt, for the retry prompt."""
+    if previous_patch is not None and patch.strip() == previous_patch.strip():
+        patch_str = f"(identical to attempt {attempt_num - 1})"
+    else:
+        patch_str = condense_patch(patch) or "(empty)"
+    errors = condense_test_output(test_output, patch_files(patch))
+    return f"ATTEMPT {attempt_num} FAILED.\nPATCH (changed lines only):\n{patch_str}\nERRORS:\n{errors}"
+
+
+def fit_history(history: list[str], budget: int) -> list[str]:
+    """Newest entries first get the `budget` tokens; older ones that do not fit keep their first line."""
+    fitted, used = [], 0
+    for entry in reversed(history):
+        tokens = count_tokens(entry)
+        if used + tokens > budget and fitted:
+            entry = entry.split('\n', 1)[0] + " (details omitted)"
+            tokens = count_tokens(entry)
+        fitted.append(entry)
+        used += tokens
+    return fitted[::-1]
@@ -0,0 +1,54 @@
+# agent_core/utils/model_cascade.py
+import logging
+from django.conf import settings
+from django.db.models import Count, Q
+
+from ..models import EvaluationAttempt
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CASCADES = {
+    'retrieval': 'gemini-2.5-flash,gemini-2.5-pro',
+    'coder': 'gemini-2.5-flash,gemini-2.5-pro',
+}
+
+
+def cascade_models(stage: str) -> list[str]:
+    """Models of a stage ('retrieval' / 'coder'), cheapest first, from LLM_CASCADE_<STAGE>."""
+    spec = getattr(settings, f'LLM_CASCADE_{stage.upper()}', DEFAULT_CASCADES[stage])
+    return [name.strip() for name in spec.split(',') if name.strip()]
+
+
+def repo_success_rates(repo: str, model_names: list[str]) -> dict[str, tuple[int, int]]:
+    """model name -> (passed attempts, attempts) over past attempts on `repo`."""
+    rows = (EvaluationAttempt.objects
+            .filter(task__repo=repo, model_name__in=model_names)
+            .values('model_name')
+            .annotate(total=Count('id'), passed=Count('id', filter=Q(status='PASSED'))))
+    return {row['model_name']: (row['passed'], row['total']) for row in rows}
+
+
+def plan_cascade(stage: str, repo: str | None) -> list[str]:
+    """
+    Models to try in order for `repo`. A cheap model that has been tried at
+    least LLM_CASCADE_MIN_SAMPLES times on this repo and passed less than
+    LLM_CASCADE_MIN_SUCCESS of them is skipped; the strongest is always kept.
+    """
+    models = cascade_models(stage)
+    if not repo or len(models) < 2:
+        return models
+    min_samples = getattr(settings, 'LLM_CASCADE_MIN_SAMPLES', 5)
+    min_success = getattr(settings, 'LLM_CASCADE_MIN_SUCCESS', 0.3)
+    try:
+        rates = repo_success_rates(repo, models[:-1])
+    except Exception as e:
+        logger.warning(f"Cascade history unavailable for {repo}: {e}")
+        return models
+    start = 0
+    while start < len(models) - 1:
+        passed, total = rates.get(models[start], (0, 0))
+        if total < min_samples or passed / total >= min_success:
+            break
+        logger.info(f"Skipping {models[start]} on {repo}: {passed}/{total} attempts passed")
+        start += 1
+    return models[start:]
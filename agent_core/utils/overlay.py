@@ -0,0 +1,96 @@
+# agent_core/utils/overlay.py
+import os
+import difflib
+import threading
+
+
+def unified_git_diff(file_path: str, old: str | None, new: str | None) -> str:
+    """
+    Build a `git diff`-compatible patch for one file. `old` / `new` are None
+    when the file does not exist on that side.
+    """
+    if old == new:
+        return ""
+
+    a_lines = (old or "").splitlines(keepends=True)
+    b_lines = (new or "").splitlines(keepends=True)
+    header = [f"diff --git a/{file_path} b/{file_path}\n"]
+    if old is None:
+        header.append("new file mode 100644\n")
+    elif new is None:
+        header.append("deleted file mode 100644\n")
+    from_file = f"a/{file_path}" if old is not None else "/dev/null"
+    to_file = f"b/{file_path}" if new is not None else "/dev/null"
+
+    out = []
+    for line in difflib.unified_diff(a_lines, b_lines, from_file, to_file, n=3):
+        if line.endswith('\n'):
+            out.append(line)
+        else:
+            # last line without newline, as git marks it
+            out.append(line + "\n\\ No newline at end of file\n")
+    if not out:
+        return ""
+    return "".join(header + out)
+
+
+class OverlayWorkspace:
+    """
+    Workspace whose base is a read-only snapshot and whose edits live in memory.
+    Reading falls through to the snapshot; the patch is computed in-process,
+    so no git subprocess is needed per attempt. Several overlays (attempts,
+    candidates) can share one snapshot without copying it.
+    """
+
+    def __init__(self, snapshot_path: str, tracked_files, edits: dict | None = None):
+        self.snapshot_path = snapshot_path
+        self._tracked = tracked_files  # set of paths in the base commit
+        self._edits = dict(edits or {})  # path -> new content (None = deleted)
+        self._lock = threading.Lock()
+
+    def list_files(self) -> list[str]:
+        with self._lock:
+            edits = dict(self._edits)
+        files = [p for p in self._tracked if edits.get(p, '') is not None]
+        files.extend(p for p, content in edits.items() if content is not None and p not in self._tracked)
+        return sorted(files)
+
+    def read_base(self, file_path: str) -> str | None:
+        if file_path not in self._tracked:
+            return None
+        full_path = os.path.join(self.snapshot_path, file_path)
+        if not os.path.isfile(full_path):
+            return None
+        with open(full_path, 'r', encoding='utf-8', errors='replace', newline='') as f:
+            return f.read()
+
+    def read(self, file_path: str) -> str | None:
+        file_path = file_path.replace('\\', '/')
+        with self._lock:
+            if file_path in self._edits:
+                return self._edits[file_path]
+        return self.read_base(file_path)
+
+    def write(self, file_path: str, content: str):
+        with self._lock:
+            self._edits[file_path.replace('\\', '/')] = content.replace('\r\n', '\n')
+
+    def reset(self):
+        with self._lock:
+            self._edits.clear()
+
+    @property
+    def touched(self) -> list[str]:
+        with self._lock:
+            return sorted(self._edits)
+
+    def diff(self) -> str:
+        with self._lock:
+            edits = sorted(self._edits.items())
+        parts = [unified_git_diff(path, self.read_base(path), content) for path, content in edits]
+        return "".join(parts).replace('\r\n', '\n')
+
+    def fork(self) -> 'OverlayWorkspace':
+        """New overlay on the same base, starting from the current edits."""
+        with self._lock:
+            return OverlayWorkspace(self.snapshot_path, self._tracked, self._edits)
@@ -0,0 +1,258 @@
+# agent_core/utils/rate_limiter.py
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from django.conf import settings
+from google.api_core import exceptions as api_exceptions
+
+logger = logging.getLogger(__name__)
+
+REDIS_RETRY_SECONDS = 30  # after a Redis error, use the in-process buckets this long
+
+# KEYS[1] bucket; ARGV: refill per second, capacity, amount, force (1 = always debit)
+# returns the seconds to wait before `amount` is available (0 = taken)
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local amount = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if ARGV[4] == '1' or tokens >= math.min(amount, capacity) then
+  tokens = math.min(capacity, tokens - amount)
+else
+  wait = (math.min(amount, capacity) - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) * 2 + 60)
+return tostring(wait)
+"""
+
+
+def parse_limits(spec: str) -> dict[str, tuple[int, int]]:
+    """'gemini-2.5-flash=1000/1000000,gemini-2.5-pro=150/2000000' -> {model: (RPM, TPM)}; 0 = unlimited."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        model, _, values = item.partition('=')
+        rpm, _, tpm = values.partition('/')
+        limits[model.strip()] = (int(rpm or 0), int(tpm or 0))
+    return limits
+
+
+def short_model_name(model_name: str) -> str:
+    return model_name.rsplit('/', 1)[-1]
+
+
+class LocalBucket:
+    """Per-process token bucket with the same semantics as the Redis script."""
+
+    def __init__(self, per_minute: int, clock=time.monotonic):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.clock = clock
+        self.ts = clock()
+        self._lock = threading.Lock()
+
+    def take(self, amount: float, force: bool = False) -> float:
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.ts) * self.rate)
+            self.ts = now
+            needed = min(amount, self.capacity)
+            if force or self.tokens >= needed:
+                self.tokens = min(self.capacity, self.tokens - amount)
+                return 0.0
+            return (needed - self.tokens) / self.rate
+
+
+class AIMDLimiter:
+    """
+    Adaptive in-flight limit: +1 per window of successful calls, halved on a
+    429, shrunk by 10% when a call is slower than `latency_target`.
+    """
+
+    def __init__(self, initial: float = 4, minimum: float = 1, maximum: float = 64, latency_target: float | None = None):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.inflight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.inflight >= max(self.minimum, int(self.limit)):
+                self._cond.wait()
+            self.inflight += 1
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.inflight >= max(self.minimum, int(self.limit)):
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self, throttled: bool = False, latency: float | None = None):
+        with self._cond:
+            self.inflight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif latency is not None and self.latency_target and latency > self.latency_target:
+                self.limit = max(self.minimum, self.limit * 0.9)
+            elif latency is not None:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class RateLimiter:
+    """
+    Cluster-wide requests-per-minute and tokens-per-minute buckets per model
+    (in Redis when configured, in-process otherwise or while Redis is down),
+    plus a per-process AIMD concurrency limit.
+    """
+
+    def __init__(self, limits: dict[str, tuple[int, int]], redis_url: str = '', aimd_initial: float = 4,
+                 aimd_max: float = 64, latency_target: float | None = None, sleep=time.sleep, clock=time.monotonic):
+        self.limits = limits
+        self.sleep = sleep
+        self.clock = clock
+        self.aimd_initial = aimd_initial
+        self.aimd_max = aimd_max
+        self.latency_target = latency_target
+        self._local: dict[str, LocalBucket] = {}
+        self._aimd: dict[str, AIMDLimiter] = {}
+        self._lock = threading.Lock()
+        self._redis = None
+        self._script = None
+        self._redis_down_until = 0.0
+        if redis_url:
+            try:
+                import redis
+                from redis.backoff import NoBackoff
+                from redis.retry import Retry
+                # fail fast: the in-process buckets take over while Redis is down
+                self._redis = redis.Redis.from_url(redis_url, socket_timeout=2, socket_connect_timeout=2,
+                                                   retry=Retry(NoBackoff(), 0))
+                self._script = self._redis.register_script(_TAKE_SCRIPT)
+            except Exception as e:
+                logger.warning(f"Rate limiter: Redis unavailable ({e}), using in-process buckets")
+        self.throttled = self.waited_seconds = 0
+
+    def aimd(self, model: str) -> AIMDLimiter:
+        with self._lock:
+            if model not in self._aimd:
+                self._aimd[model] = AIMDLimiter(self.aimd_initial, maximum=self.aimd_max, latency_target=self.latency_target)
+            return self._aimd[model]
+
+    def _take(self, model: str, kind: str, per_minute: int, amount: float, force: bool = False) -> float:
+        if self._script is not None and time.monotonic() >= self._redis_down_until:
+            try:
+                return float(self._script(keys=[f"nocode:ratelimit:{model}:{kind}"],
+                                          args=[per_minute / 60.0, per_minute, amount, '1' if force else '0']))
+            except Exception as e:
+                logger.warning(f"Rate limiter: Redis error ({e}), using in-process buckets for {REDIS_RETRY_SECONDS}s")
+                self._redis_down_until = time.monotonic() + REDIS_RETRY_SECONDS
+        with self._lock:
+            bucket = self._local.get(f"{model}:{kind}")
+            if bucket is None:
+                bucket = self._local[f"{model}:{kind}"] = LocalBucket(per_minute, self.clock)
+        return bucket.take(amount, force)
+
+    def wait_for_quota(self, model: str, tokens: int):
+        rpm, tpm = self.limits.get(model, (0, 0))
+        for kind, per_minute, amount in (('requests', rpm, 1), ('tokens', tpm, tokens)):
+            if not per_minute:
+                continue
+            while True:
+                wait = self._take(model, kind, per_minute, amount)
+                if wait <= 0:
+                    break
+                self.waited_seconds += wait
+                self.sleep(min(wait, 5.0))
+
+    def settle(self, model: str, estimated: int, actual: int):
+        """Correct the token bucket once the real usage of a call is known."""
+        tpm = self.limits.get(model, (0, 0))[1]
+        if tpm and actual and actual != estimated:
+            self._take(model, 'tokens', tpm, actual - estimated, force=True)
+
+    def _recorder(self, model: str, estimated_tokens: int):
+        def record(response):
+            meta = getattr(response, 'usage_metadata', None)
+            actual = getattr(meta, 'total_token_count', 0) if meta is not None else 0
+            if isinstance(actual, int):
+                self.settle(model, estimated_tokens, actual)
+        return record
+
+    @contextmanager
+    def slot(self, model_name: str, estimated_tokens: int):
+        """
+        Hold quota and a concurrency slot for one call. Yields a callback that
+        takes the response, to settle its real token usage.
+        """
+        model = short_model_name(model_name)
+        self.wait_for_quota(model, estimated_tokens)
+        limiter = self.aimd(model)
+        limiter.acquire()
+        started = time.monotonic()
+        try:
+            yield self._recorder(model, estimated_tokens)
+        except (api_exceptions.TooManyRequests, api_exceptions.ResourceExhausted):
+            self.throttled += 1
+            limiter.release(throttled=True)
+            raise
+        except Exception:
+            limiter.release()
+            raise
+        else:
+            limiter.release(latency=time.monotonic() - started)
+
+    @asynccontextmanager
+    async def slot_async(self, model_name: str, estimated_tokens: int, poll: float = 0.05):
+        """
+        slot() for coroutines: the quota wait runs in a thread and the
+        concurrency slot is polled, so the event loop never blocks. A
+        cancelled call (hedging, timeouts) gives its slot back.
+        """
+        model = short_model_name(model_name)
+        await asyncio.to_thread(self.wait_for_quota, model, estimated_tokens)
+        limiter = self.aimd(model)
+        while not limiter.try_acquire():
+            await asyncio.sleep(poll)
+        started = time.monotonic()
+        try:
+            yield self._recorder(model, estimated_tokens)
+        except (api_exceptions.TooManyRequests, api_exceptions.ResourceExhausted):
+            self.throttled += 1
+            limiter.release(throttled=True)
+            raise
+        except BaseException:
+            limiter.release()
+            raise
+        else:
+            limiter.release(latency=time.monotonic() - started)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter(
+                parse_limits(getattr(settings, 'LLM_RATE_LIMITS', '')),
+                getattr(settings, 'LLM_RATE_LIMIT_REDIS_URL', ''),
+                aimd_initial=getattr(settings, 'LLM_CONCURRENCY_INITIAL', 4),
+                aimd_max=getattr(settings, 'LLM_CONCURRENCY_MAX', 64),
+                latency_target=getattr(settings, 'LLM_LATENCY_TARGET_SECONDS', None) or None,
+            )
+        return _limiter
@@ -0,0 +1,115 @@
+# agent_core/utils/reclaimer.py
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+from .workspace import SNAPSHOT_ROOT, TRASH_DIR, workspace_roots, forget_workspace, read_workspace_owner, onerror
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _make_executor(workers: int):
+    # under the gevent worker pool `threading` is patched into greenlets, and a
+    # blocking rmtree would stall every other task: use gevent's native threads
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+            return NativeThreadPoolExecutor(max_workers=workers)
+    except ImportError:
+        pass
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='nocode-reclaim')
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = _make_executor(getattr(settings, 'WORKSPACE_RECLAIM_WORKERS', 2))
+        return _executor
+
+
+def _remove_tree(path: str):
+    try:
+        shutil.rmtree(path, onerror=onerror)
+    except Exception as e:
+        print(f"Warning: failed to delete {path}: {e}")
+
+
+def discard_workspace(workspace_path: str):
+    """
+    Delete a workspace off the critical path. The directory is first renamed
+    into the trash so its name is free immediately; the actual rmtree runs on
+    a small bounded thread pool. Returns the Future of the deletion (or None).
+    """
+    forget_workspace(workspace_path)
+    if not workspace_path or not os.path.exists(workspace_path):
+        return None
+
+    target = workspace_path
+    try:
+        # trash lives next to the workspace (same tier), so the rename never copies
+        trash_root = os.path.join(os.path.dirname(workspace_path), TRASH_DIR)
+        os.makedirs(trash_root, exist_ok=True)
+        target = os.path.join(trash_root, f"{os.path.basename(workspace_path)}_{time.time_ns()}")
+        os.rename(workspace_path, target)
+    except OSError:
+        target = workspace_path
+
+    return _get_executor().submit(_remove_tree, target)
+
+
+def _age(path: str, now: float) -> float:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 0.0
+    # a rename into the trash only updates ctime
+    return now - max(st.st_mtime, st.st_ctime)
+
+
+def _subdirs(root: str):
+    if not os.path.isdir(root):
+        return []
+    with os.scandir(root) as it:
+        return [e.path for e in it if e.is_dir(follow_symlinks=False)]
+
+
+def reap_orphaned_workspaces(is_task_running, stale_seconds: float, grace_seconds: float = 300) -> list[str]:
+    """
+    Find workspaces leaked by crashed or killed workers and schedule their deletion:
+      - workspaces owned by a task that is no longer RUNNING (after `grace_seconds`),
+      - idle pooled / unowned workspaces untouched for `stale_seconds`,
+      - leftovers in the trash and half-built snapshots.
+    `is_task_running(task_id)` decides whether an owner is still alive.
+    """
+    now = time.time()
+    reaped = []
+
+    roots = workspace_roots()
+    leftovers = [p for root in roots for p in _subdirs(os.path.join(root, TRASH_DIR))]
+    leftovers += [p for p in _subdirs(SNAPSHOT_ROOT) if os.path.basename(p).startswith('.tmp_')]
+    for path in leftovers:
+        if _age(path, now) >= stale_seconds:
+            _get_executor().submit(_remove_tree, path)
+            reaped.append(path)
+
+    for path in (p for root in roots for p in _subdirs(root)):
+        if os.path.basename(path).startswith('_'):
+            continue
+        owner = read_workspace_owner(path)
+        if owner and owner.get('task_id') is not None:
+            if is_task_running(owner['task_id']) or now - owner.get('since', now) < grace_seconds:
+                continue
+        else:
+            since = owner.get('since', now) if owner else now - _age(path, now)
+            if now - since < stale_seconds:
+                continue
+        discard_workspace(path)
+        reaped.append(path)
+
+    return reaped
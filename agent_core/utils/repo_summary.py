@@ -0,0 +1,51 @@
+# agent_core/utils/repo_summary.py
+from collections import defaultdict
+
+MAX_DEPTH = 6
+ROOT_DIR = '.'
+
+
+def dir_at(file_path: str, depth: int) -> str:
+    """Directory of `file_path` cut to at most `depth` levels ('.' for top-level files)."""
+    return '/'.join(file_path.split('/')[:-1][:depth]) or ROOT_DIR
+
+
+def in_directories(file_path: str, directories: list[str]) -> bool:
+    for directory in directories:
+        directory = directory.strip().rstrip('/')
+        if directory == ROOT_DIR and '/' not in file_path:
+            return True
+        if directory and directory != ROOT_DIR and file_path.startswith(directory + '/'):
+            return True
+    return False
+
+
+def directory_summary(files: list[str], symbol_index=None, max_dirs: int = 300, max_symbols: int = 5) -> list[str]:
+    """
+    Compact tree of the repo for the first retrieval stage: one line per
+    directory, at the deepest level that still fits in `max_dirs` lines, with
+    its file count and a few public top-level classes / functions.
+    """
+    depth = 1
+    for d in range(2, MAX_DEPTH + 1):
+        if len({dir_at(f, d) for f in files}) > max_dirs:
+            break
+        depth = d
+
+    groups = defaultdict(list)
+    for f in files:
+        groups[dir_at(f, depth)].append(f)
+
+    lines = []
+    for directory in sorted(groups):
+        members = groups[directory]
+        names = []
+        if symbol_index is not None:
+            symbols = [s for f in sorted(members) for s in symbol_index.symbols(f)
+                       if s[1] in ('class', 'function') and not s[0].startswith('_')]
+            # classes first, they say most about what a package is for
+            symbols.sort(key=lambda s: s[1] != 'class')
+            names = list(dict.fromkeys(s[0] for s in symbols))[:max_symbols]
+        label = directory if directory == ROOT_DIR else f"{directory}/"
+        lines.append(f"{label} ({len(members)} files)" + (f": {', '.join(names)}" if names else ""))
+    return lines
@@ -0,0 +1,301 @@
+# agent_core/utils/snapshots.py
+import os
+import json
+import functools
+import shutil
+import subprocess
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ioctl number of FICLONE (copy-on-write clone on btrfs / xfs / overlayfs)
+FICLONE = 0x40049409
+
+SNAPSHOT_MARKER = 'nocode_snapshot.json'
+# copy of the snapshot index with the skip-worktree bit set on every entry,
+# used by sparse workspaces that only hold a few of the files on disk
+SPARSE_INDEX = 'index.sparse'
+
+# Git settings that let a workspace reuse the snapshot index as-is:
+# hardlinked or reflinked files keep size + mtime, but not inode / ctime.
+SNAPSHOT_GIT_CONFIG = {
+    'core.checkStat': 'minimal',
+    'core.trustctime': 'false',
+    'user.email': 'agent@test.com',
+    'user.name': 'Agent',
+}
+
+_build_locks = {}
+_build_locks_guard = threading.Lock()
+
+
+def snapshot_key(repo_slug: str, base_commit: str | None) -> str:
+    commit = (base_commit or 'HEAD')[:12]
+    return f"{repo_slug.replace('/', '__')}@{commit}"
+
+
+def _git(args, cwd, check=False):
+    return subprocess.run(['git', *args], cwd=cwd, capture_output=True, text=True, encoding='utf-8', check=check)
+
+
+def _key_lock(key: str) -> threading.Lock:
+    with _build_locks_guard:
+        return _build_locks.setdefault(key, threading.Lock())
+
+
+def read_snapshot_info(snapshot_path: str) -> dict:
+    marker = os.path.join(snapshot_path, '.git', SNAPSHOT_MARKER)
+    try:
+        with open(marker, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_snapshot(snapshot_root: str, repo_slug: str, source_path: str, base_commit: str | None = None) -> str | None:
+    """
+    Return the path of the read-only snapshot of `source_path` at `base_commit`,
+    building it on first use. Returns None when the source codebase is missing;
+    raises IOError when `base_commit` is not in the source clone.
+    """
+    if not os.path.exists(source_path):
+        return None
+
+    key = snapshot_key(repo_slug, base_commit)
+    snapshot_path = os.path.join(snapshot_root, key)
+    if read_snapshot_info(snapshot_path):
+        return snapshot_path
+
+    with _key_lock(key):
+        # another greenlet / worker may have finished it while we waited
+        if read_snapshot_info(snapshot_path):
+            return snapshot_path
+
+        os.makedirs(snapshot_root, exist_ok=True)
+        tmp_path = os.path.join(snapshot_root, f".tmp_{key}_{os.getpid()}_{int(time.time() * 1000)}")
+        try:
+            _build_snapshot(tmp_path, repo_slug, source_path, base_commit)
+            try:
+                os.rename(tmp_path, snapshot_path)
+            except OSError:
+                # lost the race against another process: keep the existing one
+                if not read_snapshot_info(snapshot_path):
+                    raise
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+    return snapshot_path
+
+
+def _build_snapshot(tmp_path: str, repo_slug: str, source_path: str, base_commit: str | None):
+    print(f"Building snapshot of {repo_slug} at {base_commit or 'HEAD'}...")
+    checked_out = False
+
+    if os.path.isdir(os.path.join(source_path, '.git')):
+        # share the object store of the dataset clone instead of copying it
+        res = _git(['clone', '--shared', '--no-checkout', '-q', source_path, tmp_path], cwd=None)
+        if res.returncode == 0:
+            target = base_commit or 'HEAD'
+            res = _git(['checkout', '-q', '--detach', target], cwd=tmp_path)
+            if res.returncode != 0 and base_commit:
+                # a tree at another commit would be stored (and indexed) under this commit's key
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise IOError(f"Commit {base_commit} not found in {source_path}: {res.stderr.strip()}")
+            checked_out = res.returncode == 0
+        if not checked_out:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    if not checked_out:
+        # plain directory: import it once as a single commit
+        shutil.copytree(source_path, tmp_path, ignore=shutil.ignore_patterns('.git'))
+        _git(['init', '-q'], cwd=tmp_path)
+        _git(['add', '.'], cwd=tmp_path)
+        _git(['-c', 'user.email=agent@test.com', '-c', 'user.name=Agent', 'commit', '-q', '-m', 'Initial'], cwd=tmp_path)
+
+    for name, value in SNAPSHOT_GIT_CONFIG.items():
+        _git(['config', name, value], cwd=tmp_path)
+
+    head = _git(['rev-parse', 'HEAD'], cwd=tmp_path).stdout.strip()
+    file_count = 0
+    total_bytes = 0
+    for entry in _iter_tree(tmp_path):
+        if entry.is_file(follow_symlinks=False):
+            file_count += 1
+            total_bytes += entry.stat(follow_symlinks=False).st_size
+
+    info = {
+        'repo': repo_slug,
+        'base_commit': base_commit,
+        'head': head,
+        'files': file_count,
+        'bytes': total_bytes,
+        'built_at': time.time(),
+    }
+    # written last: its presence marks the snapshot as complete
+    with open(os.path.join(tmp_path, '.git', SNAPSHOT_MARKER), 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+
+
+def _iter_tree(root: str):
+    """Yield DirEntry objects below root (directories included), skipping the top-level .git."""
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        with os.scandir(current) as it:
+            for entry in it:
+                if current == root and entry.name == '.git':
+                    continue
+                yield entry
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+
+
+def _reflink(src: str, dst: str):
+    if fcntl is None:
+        raise OSError("reflink not supported on this platform")
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+    shutil.copystat(src, dst)
+
+
+def _copy(src: str, dst: str):
+    shutil.copy2(src, dst)
+
+
+_LINKERS = {
+    'reflink': _reflink,
+    'hardlink': os.link,
+    'copy': _copy,
+}
+
+
+def _pick_link_mode(src: str, dst: str) -> str:
+    for mode in ('reflink', 'hardlink'):
+        try:
+            _LINKERS[mode](src, dst)
+            return mode
+        except OSError:
+            continue
+    _copy(src, dst)
+    return 'copy'
+
+
+def materialize_snapshot(snapshot_path: str, dest: str, sparse: bool = False) -> str:
+    """
+    Populate `dest` from a snapshot using copy-on-write clones (reflink), falling
+    back to hardlinks and finally to plain copies. Hardlinked files share their
+    inode with the snapshot, so workspace writes must go through
+    `write_workspace_file`, which replaces files instead of writing in place.
+    Returns the link mode that was used.
+
+    With `sparse=True` only the .git is created; files are fetched on demand
+    with `materialize_file`.
+    """
+    os.makedirs(dest, exist_ok=True)
+    if sparse:
+        _init_workspace_git(snapshot_path, dest, sparse=True)
+        return 'sparse'
+
+    mode = None
+
+    for entry in _iter_tree(snapshot_path):
+        src = entry.path
+        dst = os.path.join(dest, os.path.relpath(src, snapshot_path))
+        if entry.is_symlink():
+            os.symlink(os.readlink(src), dst)
+        elif entry.is_dir(follow_symlinks=False):
+            os.makedirs(dst, exist_ok=True)
+        else:
+            if mode is None:
+                mode = _pick_link_mode(src, dst)
+                continue
+            try:
+                _LINKERS[mode](src, dst)
+            except OSError:
+                _copy(src, dst)
+
+    _init_workspace_git(snapshot_path, dest)
+    return mode or 'copy'
+
+
+def materialize_file(snapshot_path: str, dest: str, file_path: str) -> bool:
+    """Link a single tracked file of the snapshot into `dest`. Returns False if the snapshot has no such file."""
+    src = os.path.join(snapshot_path, file_path)
+    if not os.path.lexists(src) or os.path.isdir(src) or file_path.split('/')[0] == '.git':
+        return False
+    dst = os.path.join(dest, file_path)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+    else:
+        _pick_link_mode(src, dst)
+    return True
+
+
+@functools.lru_cache(maxsize=64)
+def _snapshot_files(snapshot_path: str) -> tuple[str, ...]:
+    # snapshots never change once built, so the listing can be cached
+    res = _git(['ls-files', '-z'], cwd=snapshot_path)
+    return tuple(p for p in res.stdout.split('\0') if p)
+
+
+def list_snapshot_files(snapshot_path: str) -> list[str]:
+    return list(_snapshot_files(snapshot_path))
+
+
+def ensure_sparse_index(snapshot_path: str) -> str:
+    git_dir = os.path.join(os.path.abspath(snapshot_path), '.git')
+    sparse_index = os.path.join(git_dir, SPARSE_INDEX)
+    if os.path.exists(sparse_index):
+        return sparse_index
+
+    # keep the stat data of the full index so files linked in later match it
+    # unique per process and thread / greenlet: gevent workers share a pid
+    tmp_index = f"{sparse_index}.{os.getpid()}_{threading.get_ident()}_{int(time.time() * 1000)}"
+    try:
+        shutil.copy2(os.path.join(git_dir, 'index'), tmp_index)
+        files = '\0'.join(list_snapshot_files(snapshot_path))
+        subprocess.run(
+            ['git', 'update-index', '--skip-worktree', '-z', '--stdin'],
+            cwd=snapshot_path, input=files, capture_output=True, text=True, encoding='utf-8',
+            env={**os.environ, 'GIT_INDEX_FILE': tmp_index}, check=True
+        )
+        os.replace(tmp_index, sparse_index)
+    finally:
+        if os.path.exists(tmp_index):
+            os.remove(tmp_index)
+    return sparse_index
+
+
+def _init_workspace_git(snapshot_path: str, dest: str, sparse: bool = False):
+    """
+    Create a lightweight .git for the workspace: objects come from the snapshot
+    through alternates and the snapshot index is reused, so no `git add` is needed.
+    """
+    src_git = os.path.join(snapshot_path, '.git')
+    git_dir = os.path.join(dest, '.git')
+    os.makedirs(os.path.join(git_dir, 'objects', 'info'), exist_ok=True)
+    os.makedirs(os.path.join(git_dir, 'refs', 'heads'), exist_ok=True)
+    os.makedirs(os.path.join(git_dir, 'refs', 'tags'), exist_ok=True)
+
+    with open(os.path.join(git_dir, 'objects', 'info', 'alternates'), 'w', encoding='utf-8') as f:
+        f.write(os.path.join(os.path.abspath(src_git), 'objects') + '\n')
+
+    info = read_snapshot_info(snapshot_path)
+    with open(os.path.join(git_dir, 'HEAD'), 'w', encoding='utf-8') as f:
+        f.write(f"{info.get('head', '')}\n")
+
+    shutil.copy2(os.path.join(src_git, 'config'), os.path.join(git_dir, 'config'))
+    index = ensure_sparse_index(snapshot_path) if sparse else os.path.join(src_git, 'index')
+    if os.path.exists(index):
+        shutil.copy2(index, os.path.join(git_dir, 'index'))
@@ -0,0 +1,91 @@
+# agent_core/utils/storage_tiers.py
+import os
+import shutil
+import threading
+
+_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value: str) -> int | None:
+    """'512M' -> bytes. Empty / '0' / 'inf' mean no budget (None)."""
+    value = value.strip().upper().rstrip('B')
+    if not value or value in ('0', 'INF'):
+        return None
+    if value[-1] in _UNITS:
+        return int(float(value[:-1]) * _UNITS[value[-1]])
+    return int(value)
+
+
+class StorageTier:
+    def __init__(self, name: str, root: str, budget: int | None = None):
+        self.name = name
+        self.root = root
+        self.budget = budget
+        self.reserved = 0
+        self.placed = 0
+
+    def fits(self, size: int) -> bool:
+        if self.budget is not None and self.reserved + size > self.budget:
+            return False
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            return shutil.disk_usage(self.root).free > size
+        except OSError:
+            return False
+
+
+def parse_tiers(spec: str, default_root: str) -> list[StorageTier]:
+    """
+    Parse WORKSPACE_TIERS, e.g. "tmpfs=/dev/shm/nocode:2G,disk=/app/nocode_workspaces".
+    Tiers are tried in order; `default_root` (no budget) is always the last resort.
+    """
+    tiers = []
+    for i, item in enumerate(filter(None, (part.strip() for part in (spec or '').split(',')))):
+        name, _, rest = item.rpartition('=')
+        root, sep, budget = rest.rpartition(':')
+        if not sep or os.sep == '\\' and len(root) == 1:
+            # no budget given (or just a Windows drive letter)
+            root, budget = rest, ''
+        tiers.append(StorageTier(name or f'tier{i}', root, parse_size(budget)))
+    if not any(os.path.abspath(t.root) == os.path.abspath(default_root) for t in tiers):
+        tiers.append(StorageTier('disk', default_root))
+    return tiers
+
+
+class TierPlacer:
+    """
+    Places workspaces on the first tier whose byte budget still has room for the
+    workspace (sized from its repo snapshot), and keeps hit counters per tier.
+    """
+
+    def __init__(self, tiers: list[StorageTier]):
+        self.tiers = tiers
+        self._lock = threading.Lock()
+
+    def place(self, size: int) -> StorageTier:
+        with self._lock:
+            for tier in self.tiers:
+                if tier is self.tiers[-1] or tier.fits(size):
+                    tier.reserved += size
+                    tier.placed += 1
+                    return tier
+
+    def release(self, tier_name: str, size: int):
+        with self._lock:
+            for tier in self.tiers:
+                if tier.name == tier_name:
+                    tier.reserved = max(0, tier.reserved - size)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = sum(t.placed for t in self.tiers)
+            return {
+                t.name: {
+                    'root': t.root,
+                    'budget_bytes': t.budget,
+                    'reserved_bytes': t.reserved,
+                    'placed': t.placed,
+                    'hit_rate': round(t.placed / total, 4) if total else 0.0,
+                }
+                for t in self.tiers
+            }
@@ -0,0 +1,225 @@
+# agent_core/utils/symbol_index.py
+import os
+import re
+import ast
+import json
+import logging
+import functools
+import warnings
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+
+from .file_catalog import load_catalog
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'nocode_symbols.json'
+INDEX_VERSION = 2
+PARALLEL_MIN_FILES = 200  # below this, process start-up costs more than it saves
+MAX_DEFINING_FILES = 3  # a bare name defined in more files than this is too ambiguous to resolve
+
+# `Axes.bar_label`, xarray.DataArray.pad, ``PercentFormatter``
+_DOTTED = re.compile(r'\b[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)+\b')
+_QUOTED = re.compile(r'`+([A-Za-z_]\w*)(?:\(\))?`+')
+
+
+def _parse_tree(source: str) -> ast.Module:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # invalid escape sequences etc. in old sources
+        return ast.parse(source)
+
+
+def parse_imports(tree: ast.Module) -> list[list]:
+    """[level, module, imported names] for every import statement, anywhere in the file."""
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports += [[0, alias.name, []] for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            imports.append([node.level, node.module or '', [alias.name for alias in node.names]])
+    return imports
+
+
+def parse_symbols(source, imports: list | None = None) -> list[list]:
+    """
+    [qualname, kind, first line, last line] for classes, functions, methods and
+    module-level names. If given, `imports` is filled with parse_imports().
+    """
+    tree = source if isinstance(source, ast.Module) else _parse_tree(source)
+    if imports is not None:
+        imports += parse_imports(tree)
+
+    symbols = []
+
+    def visit(body, prefix):
+        for node in body:
+            if isinstance(node, ast.ClassDef):
+                symbols.append([prefix + node.name, 'class', node.lineno, node.end_lineno])
+                visit(node.body, f"{prefix}{node.name}.")
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                kind = 'method' if prefix else 'function'
+                symbols.append([prefix + node.name, kind, node.lineno, node.end_lineno])
+            elif not prefix and isinstance(node, (ast.Assign, ast.AnnAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                for target in targets:
+                    if isinstance(target, ast.Name):
+                        symbols.append([target.id, 'variable', node.lineno, node.end_lineno])
+
+    visit(tree.body, '')
+    return symbols
+
+
+def _parse_files(snapshot_path: str, paths: list[str]) -> list:
+    """(symbols, imports) per file."""
+    results = []
+    for path in paths:
+        imports = []
+        try:
+            with open(os.path.join(snapshot_path, path), 'r', encoding='utf-8', errors='replace') as f:
+                symbols = parse_symbols(f.read(), imports)
+        except (OSError, SyntaxError, ValueError, RecursionError):
+            symbols, imports = [], []
+        results.append((symbols, imports))
+    return results
+
+
+def _parse_parallel(snapshot_path: str, paths: list[str]) -> list:
+    workers = getattr(settings, 'SYMBOL_INDEX_WORKERS', 0) or os.cpu_count() or 1
+    if workers <= 1 or len(paths) < PARALLEL_MIN_FILES:
+        return _parse_files(snapshot_path, paths)
+
+    chunk = -(-len(paths) // (workers * 4))
+    chunks = [paths[i:i + chunk] for i in range(0, len(paths), chunk)]
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = pool.map(_parse_files, [snapshot_path] * len(chunks), chunks)
+            return [symbols for part in parts for symbols in part]
+    except Exception as e:
+        # e.g. daemonic prefork workers may not spawn children
+        logger.warning(f"Parallel symbol parsing unavailable ({e}), parsing serially")
+        return _parse_files(snapshot_path, paths)
+
+
+def _read_index(path: str) -> dict | None:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data if data.get('version') == INDEX_VERSION else None
+    except (OSError, ValueError):
+        return None
+
+
+def _previous_files(snapshot_path: str) -> dict:
+    """Per-file entries of the newest index built for another commit of the same repo."""
+    root, name = os.path.split(os.path.normpath(snapshot_path))
+    repo_key = name.rpartition('@')[0]
+    candidates = []
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.name != name and entry.name.rpartition('@')[0] == repo_key:
+                    index_path = os.path.join(entry.path, '.git', INDEX_FILE)
+                    if os.path.exists(index_path):
+                        candidates.append((os.path.getmtime(index_path), index_path))
+    except OSError:
+        return {}
+    for _, index_path in sorted(candidates, reverse=True):
+        data = _read_index(index_path)
+        if data:
+            return data['files']
+    return {}
+
+
+class SymbolIndex:
+    def __init__(self, files: dict):
+        # path -> {'blob': sha, 'symbols': [[qualname, kind, start, end], ...], 'imports': [[level, module, names], ...]}
+        self.files = files
+        self._by_qualname = {}
+        self._by_name = {}
+        for path, entry in files.items():
+            for qualname, kind, start, end in entry['symbols']:
+                self._by_qualname.setdefault(qualname, []).append((path, kind, start, end))
+                if kind != 'method':
+                    self._by_name.setdefault(qualname.rsplit('.', 1)[-1], set()).add(path)
+
+    def lookup(self, name: str) -> list[tuple]:
+        """(path, kind, first line, last line) of every definition of a qualified name."""
+        return list(self._by_qualname.get(name, ()))
+
+    def symbols(self, path: str) -> list[list]:
+        entry = self.files.get(path)
+        return entry['symbols'] if entry else []
+
+    def imports(self, path: str) -> list[list]:
+        entry = self.files.get(path)
+        return entry['imports'] if entry else []
+
+    def _resolve_dotted(self, dotted: str) -> list[str]:
+        parts = dotted.split('.')
+        # longest suffix that is a known qualname: `xarray.DataArray.pad` -> `DataArray.pad`
+        for i in range(len(parts) - 1):
+            hits = self._by_qualname.get('.'.join(parts[i:]))
+            if hits:
+                return [hit[0] for hit in hits]
+        # module path + top-level name: `matplotlib.ticker.PercentFormatter`
+        module = '/'.join(parts[:-1])
+        for path in sorted(self._by_name.get(parts[-1], ())):
+            stem = path[:-len('/__init__.py')] if path.endswith('/__init__.py') else path[:-3]
+            if stem == module or stem.endswith('/' + module):
+                return [path]
+        return []
+
+    def resolve(self, text: str) -> list[str]:
+        """Files defining the identifiers mentioned in a doc change, in order of mention."""
+        found = []
+        for dotted in _DOTTED.findall(text):
+            found += self._resolve_dotted(dotted)
+        for name in _QUOTED.findall(text):
+            paths = self._by_name.get(name, ())
+            if 0 < len(paths) <= MAX_DEFINING_FILES:
+                found += sorted(paths)
+        return list(dict.fromkeys(found))
+
+
+def build_symbol_index(snapshot_path: str) -> dict:
+    """
+    Parse every non-vendored Python file of a snapshot. Files whose blob is
+    unchanged since the index of another commit of the same repo are reused.
+    """
+    entries = [e for e in load_catalog(snapshot_path) if e.ext == '.py' and not e.vendored]
+    previous = _previous_files(snapshot_path)
+    files, todo = {}, []
+    for e in entries:
+        old = previous.get(e.path)
+        if old and old['blob'] == e.blob:
+            files[e.path] = old
+        else:
+            todo.append(e)
+
+    for e, (symbols, imports) in zip(todo, _parse_parallel(snapshot_path, [e.path for e in todo])):
+        files[e.path] = {'blob': e.blob, 'symbols': symbols, 'imports': imports}
+    logger.info(f"Symbol index for {snapshot_path}: parsed {len(todo)} files, reused {len(entries) - len(todo)}")
+    return files
+
+
+@functools.lru_cache(maxsize=16)
+def load_symbol_index(snapshot_path: str) -> SymbolIndex:
+    """Symbol index of a snapshot, persisted in its .git and memoized per process."""
+    index_path = os.path.join(snapshot_path, '.git', INDEX_FILE)
+    data = _read_index(index_path)
+    if data:
+        return SymbolIndex(data['files'])
+
+    files = build_symbol_index(snapshot_path)
+    # unique per process and thread / greenlet: gevent workers share a pid
+    tmp_path = f"{index_path}.{os.getpid()}_{threading.get_ident()}_{int(time.time() * 1000)}"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'files': files}, f)
+        os.replace(tmp_path, index_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return SymbolIndex(files)
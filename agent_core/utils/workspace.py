@@ -3,12 +3,37 @@ import os
 import shutil
 import subprocess
 import time
+import json
+import socket
 import stat
 from django.conf import settings
 
+from .snapshots import get_snapshot, materialize_snapshot, materialize_file, list_snapshot_files, read_snapshot_info
+from .overlay import OverlayWorkspace, unified_git_diff
+from .storage_tiers import TierPlacer, parse_tiers
+from .context_packer import pack_files
+from .content_cache import get_content_cache, content_key
+
 # root workspace directory
 ROOT_WORKSPACE = os.path.join(settings.BASE_DIR, 'nocode_workspaces')
 ORIGINAL_DATASET_ROOT = os.path.join(settings.BASE_DIR, 'NoCode-bench_Verified', 'data')
+# one read-only snapshot per (repo, base_commit), shared by all workspaces
+SNAPSHOT_ROOT = os.path.join(ROOT_WORKSPACE, '_snapshots')
+# workspaces waiting for background deletion (one per storage tier root)
+TRASH_DIR = '_trash'
+OWNER_MARKER = 'nocode_owner.json'
+
+# workspace path -> relative paths written since the last reset
+_touched_paths: dict[str, set[str]] = {}
+# workspace path -> {'snapshot', 'repo', 'base_commit', 'mode', 'unskip'} for snapshot-backed workspaces
+_workspaces: dict[str, dict] = {}
+# workspace id -> in-memory overlay (mode 'overlay': nothing exists on disk at that path)
+_overlays: dict[str, OverlayWorkspace] = {}
+# workspace path -> (tier name, reserved bytes)
+_placements: dict[str, tuple[str, int]] = {}
+_placer = None
+
+WORKSPACE_MODES = ('full', 'sparse', 'overlay')
 
 def onerror(func, path, exc_info):
     if not os.access(path, os.W_OK):
@@ -17,9 +42,7 @@ def onerror(func, path, exc_info):
     else:
         raise
 
-def setup_workspace(nocode_bench_id: str) -> str:
-    os.makedirs(ROOT_WORKSPACE, exist_ok=True)
-    
+def repo_slug_from_id(nocode_bench_id: str) -> str:
     # repository slug extraction
     if '__' in nocode_bench_id:
         owner = nocode_bench_id.split('__')[0]
@@ -37,26 +60,257 @@ def setup_workspace(nocode_bench_id: str) -> str:
             parts = nocode_bench_id.split('-')
             repo_slug = "-".join(parts[:-1])
 
-    original_repo_path = os.path.join(ORIGINAL_DATASET_ROOT, repo_slug.replace('/', os.sep))
+    return repo_slug
+
+def get_placer() -> TierPlacer:
+    """Storage tiers for workspaces from settings.WORKSPACE_TIERS, with ROOT_WORKSPACE as fallback."""
+    global _placer
+    if _placer is None:
+        _placer = TierPlacer(parse_tiers(getattr(settings, 'WORKSPACE_TIERS', ''), ROOT_WORKSPACE))
+    return _placer
+
+def workspace_roots() -> list[str]:
+    return [tier.root for tier in get_placer().tiers]
+
+def _place_workspace(nocode_bench_id: str, size: int) -> str:
+    tier = get_placer().place(size)
+    os.makedirs(tier.root, exist_ok=True)
     run_id = str(time.time()).replace('.', '')
-    temp_dir = os.path.join(ROOT_WORKSPACE, f'run_{nocode_bench_id.replace("/", "_")}_{run_id}')
-    
-    if not os.path.exists(original_repo_path):
+    temp_dir = os.path.join(tier.root, f'run_{nocode_bench_id.replace("/", "_")}_{run_id}')
+    _placements[temp_dir] = (tier.name, size)
+    return temp_dir
+
+def workspace_placement(workspace_path: str) -> dict:
+    """Where the workspace was placed, plus this worker's per-tier hit rates."""
+    tier_name, size = _placements.get(workspace_path, (None, 0))
+    info = _workspaces.get(workspace_path) or {}
+    return {
+        'tier': tier_name,
+        'bytes': size,
+        'mode': info.get('mode'),
+        'tiers': get_placer().stats(),
+    }
+
+def setup_workspace(nocode_bench_id: str, base_commit: str | None = None, mode: str | None = None) -> str:
+    """
+    Create a workspace for the task's repo at `base_commit` and return its path.
+    Modes (default: settings.WORKSPACE_MODE):
+      - full: every file is linked in from the snapshot.
+      - sparse: no file is put on disk up front; files are linked in from the
+        snapshot when read or written.
+      - overlay: nothing is put on disk; edits stay in memory on top of the
+        snapshot and the returned path is only an identifier.
+    All modes are used through the same functions below.
+    """
+    if mode is None:
+        mode = getattr(settings, 'WORKSPACE_MODE', 'full')
+    if mode not in WORKSPACE_MODES:
+        raise ValueError(f"Unknown workspace mode: {mode}")
+
+    repo_slug = repo_slug_from_id(nocode_bench_id)
+    original_repo_path = os.path.join(ORIGINAL_DATASET_ROOT, repo_slug.replace('/', os.sep))
+
+    snapshot_path = get_snapshot(SNAPSHOT_ROOT, repo_slug, original_repo_path, base_commit)
+    # only full workspaces hold the whole tree; sparse / overlay ones stay tiny
+    size = read_snapshot_info(snapshot_path).get('bytes', 0) if snapshot_path and mode == 'full' else 0
+    temp_dir = _place_workspace(nocode_bench_id, size)
+
+    if snapshot_path is None:
         print(f"CRITICAL: Codebase for {repo_slug} not found. Creating empty workspace.")
         os.makedirs(temp_dir, exist_ok=True)
-    else:
-        print(f"Copying codebase from {original_repo_path} to {temp_dir}...")
-        shutil.copytree(original_repo_path, temp_dir)
-
-    # Git Init
-    subprocess.run(['git', 'init'], cwd=temp_dir, capture_output=True, check=False)
-    subprocess.run(['git', 'config', 'user.email', 'agent@test.com'], cwd=temp_dir)
-    subprocess.run(['git', 'config', 'user.name', 'Agent'], cwd=temp_dir)
-    subprocess.run(['git', 'add', '.'], cwd=temp_dir, capture_output=True, check=False)
-    subprocess.run(['git', 'commit', '-m', 'Initial'], cwd=temp_dir, capture_output=True, check=False)
-    
+
+        # Git Init
+        subprocess.run(['git', 'init'], cwd=temp_dir, capture_output=True, check=False)
+        subprocess.run(['git', 'config', 'user.email', 'agent@test.com'], cwd=temp_dir)
+        subprocess.run(['git', 'config', 'user.name', 'Agent'], cwd=temp_dir)
+        subprocess.run(['git', 'commit', '--allow-empty', '-m', 'Initial'], cwd=temp_dir, capture_output=True, check=False)
+        return temp_dir
+
+    _workspaces[temp_dir] = {
+        'snapshot': snapshot_path,
+        'repo': repo_slug,
+        'base_commit': base_commit,
+        'mode': mode,
+        'unskip': set(),
+    }
+    if mode == 'overlay':
+        _overlays[temp_dir] = OverlayWorkspace(snapshot_path, frozenset(list_snapshot_files(snapshot_path)))
+        print(f"Created overlay of {repo_slug}@{base_commit or 'HEAD'} as {temp_dir}")
+        return temp_dir
+
+    # snapshot already carries a checked-out tree and a git index,
+    # so the workspace only needs links to it (no copy, no `git add`)
+    link_mode = materialize_snapshot(snapshot_path, temp_dir, sparse=(mode == 'sparse'))
+    print(f"Materialized {repo_slug}@{base_commit or 'HEAD'} into {temp_dir} ({link_mode})")
     return temp_dir
 
+def fork_workspace(workspace_path: str) -> str:
+    """
+    New overlay workspace on the same snapshot, starting from the current edits
+    of `workspace_path` (which must be an overlay). Nothing is copied.
+    """
+    overlay = _overlays[workspace_path]
+    fork_path = f"{workspace_path}_fork{str(time.time()).replace('.', '')}"
+    _workspaces[fork_path] = dict(_workspaces[workspace_path], unskip=set())
+    _overlays[fork_path] = overlay.fork()
+    return fork_path
+
+def get_workspace_info(workspace_path: str) -> dict | None:
+    return _workspaces.get(workspace_path)
+
+def workspace_exists(workspace_path: str) -> bool:
+    # overlays only exist in memory
+    return workspace_path in _overlays or os.path.isdir(workspace_path)
+
+def list_workspace_files(workspace_path: str) -> list[str]:
+    """Relative paths (with '/') of the files in the workspace."""
+    if workspace_path in _overlays:
+        return _overlays[workspace_path].list_files()
+    info = _workspaces.get(workspace_path)
+    if info and info['mode'] == 'sparse':
+        # the tree is not on disk: list it from git metadata
+        return list_snapshot_files(info['snapshot'])
+
+    all_files = []
+    for root, dirs, files in os.walk(workspace_path):
+        if '.git' in dirs: dirs.remove('.git')
+        if '.venv' in dirs: dirs.remove('.venv')
+        if 'venv' in dirs: dirs.remove('venv')
+        for file in files:
+            rel_path = os.path.relpath(os.path.join(root, file), workspace_path)
+            all_files.append(rel_path.replace('\\', '/'))
+    return all_files
+
+def _fetch_sparse_file(workspace_path: str, file_path: str) -> bool:
+    info = _workspaces.get(workspace_path)
+    if not info or info['mode'] != 'sparse':
+        return False
+    file_path = file_path.replace('\\', '/')
+    if materialize_file(info['snapshot'], workspace_path, file_path):
+        info['unskip'].add(file_path)
+        return True
+    return False
+
+def _flush_sparse(workspace_path: str):
+    """Clear the skip-worktree bit of files that are now on disk, so git sees them."""
+    info = _workspaces.get(workspace_path)
+    if not info or not info['unskip']:
+        return
+    tracked = [p for p in info['unskip'] if os.path.lexists(os.path.join(info['snapshot'], p))]
+    info['unskip'].clear()
+    if tracked:
+        subprocess.run(
+            ['git', 'update-index', '--no-skip-worktree', '-z', '--stdin'],
+            cwd=workspace_path, input='\0'.join(tracked), capture_output=True, text=True, encoding='utf-8'
+        )
+
+def read_workspace_file(workspace_path: str, file_path: str) -> str | None:
+    """Read a workspace file (fetching it from the snapshot in sparse mode). None if missing."""
+    if workspace_path in _overlays:
+        return _overlays[workspace_path].read(file_path)
+    full_path = os.path.join(workspace_path, file_path)
+    if not os.path.exists(full_path):
+        _fetch_sparse_file(workspace_path, file_path)
+    if not os.path.isfile(full_path):
+        return None
+    with open(full_path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+def workspace_diff(workspace_path: str) -> str:
+    """`git diff` of the workspace against its base commit, new files included, with LF endings."""
+    if workspace_path in _overlays:
+        # computed in-process against the snapshot, no git round trip
+        return _overlays[workspace_path].diff()
+    _flush_sparse(workspace_path)
+    res = subprocess.run(['git', 'diff'], cwd=workspace_path, capture_output=True, text=True, encoding='utf-8')
+    patch = res.stdout
+    # `git diff` leaves out untracked files: diff the ones written since the last reset in-process
+    touched = sorted(_touched_paths.get(workspace_path, ()))
+    if touched:
+        res = subprocess.run(['git', '--literal-pathspecs', 'ls-files', '-z', '--'] + touched,
+                             cwd=workspace_path, capture_output=True, text=True, encoding='utf-8')
+        tracked = set(p for p in res.stdout.split('\0') if p)
+        for file_path in touched:
+            full_path = os.path.join(workspace_path, file_path)
+            if file_path in tracked or not os.path.isfile(full_path):
+                continue
+            with open(full_path, 'r', encoding='utf-8', errors='replace') as f:
+                patch += unified_git_diff(file_path, None, f.read())
+    return patch.replace('\r\n', '\n')
+
+def write_workspace_file(workspace_path: str, file_path: str, content: str):
+    """
+    Write `content` to `file_path` inside the workspace with LF endings.
+    The file is replaced rather than rewritten in place, so hardlinks shared
+    with the snapshot are broken instead of modified.
+    """
+    if workspace_path in _overlays:
+        _overlays[workspace_path].write(file_path, content)
+        return
+    full_path = os.path.join(workspace_path, file_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    tmp_path = f"{full_path}.nocode_tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='\n') as f:
+        f.write(content.replace('\r\n', '\n'))
+    if os.path.exists(full_path):
+        shutil.copymode(full_path, tmp_path)
+    os.replace(tmp_path, full_path)
+    file_path = file_path.replace('\\', '/')
+    _touched_paths.setdefault(workspace_path, set()).add(file_path)
+    info = _workspaces.get(workspace_path)
+    if info and info['mode'] == 'sparse':
+        info['unskip'].add(file_path)
+
+def reset_workspace(workspace_path: str):
+    """
+    Return the workspace to HEAD. Equivalent to `git reset --hard` + `git clean -fdx`,
+    but scoped to the files written through `write_workspace_file` so the rest of
+    the tree is never stat-ed or rewritten.
+    """
+    if workspace_path in _overlays:
+        _overlays[workspace_path].reset()
+        return
+    touched = sorted(_touched_paths.pop(workspace_path, ()))
+    if not touched:
+        return
+    _flush_sparse(workspace_path)
+
+    git = ['git', '--literal-pathspecs']
+    res = subprocess.run(git + ['ls-files', '-z', '--'] + touched, cwd=workspace_path, capture_output=True, text=True, encoding='utf-8')
+    tracked = [p for p in res.stdout.split('\0') if p]
+    if tracked:
+        subprocess.run(git + ['checkout', '-q', 'HEAD', '--'] + tracked, cwd=workspace_path, capture_output=True, check=True)
+    untracked = [p for p in touched if p not in tracked]
+    if untracked:
+        subprocess.run(git + ['clean', '-fdxq', '--'] + untracked, cwd=workspace_path, capture_output=True, check=True)
+
+def forget_workspace(workspace_path: str):
+    _touched_paths.pop(workspace_path, None)
+    _workspaces.pop(workspace_path, None)
+    _overlays.pop(workspace_path, None)
+    placement = _placements.pop(workspace_path, None)
+    if placement:
+        get_placer().release(*placement)
+
+def mark_workspace_owner(workspace_path: str, task_id=None):
+    """
+    Record which task uses the workspace (None = idle in a pool), so the
+    reaper can tell leaked workspaces from live ones after a worker crash.
+    """
+    git_dir = os.path.join(workspace_path, '.git')
+    if not os.path.isdir(git_dir):
+        return
+    owner = {'task_id': task_id, 'host': socket.gethostname(), 'pid': os.getpid(), 'since': time.time()}
+    with open(os.path.join(git_dir, OWNER_MARKER), 'w', encoding='utf-8') as f:
+        json.dump(owner, f)
+
+def read_workspace_owner(workspace_path: str) -> dict | None:
+    try:
+        with open(os.path.join(workspace_path, '.git', OWNER_MARKER), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
 def setup_custom_workspace(github_url: str) -> str:
     os.makedirs(ROOT_WORKSPACE, exist_ok=True)
     run_id = str(time.time()).replace('.', '')
@@ -74,39 +328,47 @@ def setup_custom_workspace(github_url: str) -> str:
     except Exception as e:
         raise IOError(f"Failed to clone Git repo: {e}")
 
-def get_file_contexts(workspace_path: str, relevant_files: list[str], max_chars: int = 200000) -> str:
+def _content_cache_key(workspace_path: str, file_path: str) -> str | None:
+    """Shared cache key of a file still identical to its snapshot, else None."""
+    info = _workspaces.get(workspace_path)
+    if not info or file_path in _touched_paths.get(workspace_path, ()):
+        return None
+    overlay = _overlays.get(workspace_path)
+    if overlay and file_path in overlay.touched:
+        return None
+    return content_key(info['repo'], info['base_commit'] or os.path.basename(info['snapshot']), file_path)
+
+def get_file_contexts(workspace_path: str, relevant_files: list[str], max_tokens: int | None = None, query: str = '') -> str:
     """
-    read relevant files from the workspace and return their contents concatenated.
-    do not exceed max_chars in total.
+    read relevant files (ranked, most relevant first) from the workspace and pack
+    them into a budget of max_tokens model tokens. Large python modules keep full
+    bodies only for the functions `query` names; files that still do not fit are
+    reduced to the blocks that best match `query`. Omitted lines get ELIDED markers.
+    Unmodified snapshot files come from the shared content cache.
     """
-    parts = []
-    total_chars = 0
-    
+    if max_tokens is None:
+        max_tokens = getattr(settings, 'CONTEXT_TOKEN_BUDGET', 50000)
+    # large python modules: bodies of functions the doc change does not name are elided
+    slice_min_tokens = getattr(settings, 'CONTEXT_SLICE_MIN_TOKENS', 8000) or None
+
+    files, token_counts = [], {}
     for file_path in relevant_files:
-        full_path = os.path.join(workspace_path, file_path)
-        if os.path.exists(full_path):
-            try:
-                with open(full_path, 'r', encoding='utf-8', errors='replace') as f:
-                    content = f.read()
-                    
+        try:
+            key = _content_cache_key(workspace_path, file_path)
+            # in sparse workspaces reading also links the file in from the snapshot
+            load = lambda: read_workspace_file(workspace_path, file_path)
+            if key:
+                cached = get_content_cache().get_or_load(key, load)
+                if cached is None:
+                    continue
+                content, token_counts[file_path] = cached
+            else:
+                content = load()
+                if content is None:
+                    continue
                 content = content.replace('\r\n', '\n')
-                
-                # check if adding this file exceeds max_chars
-                if total_chars + len(content) > max_chars:
-                    remaining = max_chars - total_chars
-                    if remaining > 500: # if at least 500 chars can be added
-                        content = content[:remaining] + "\n...[TRUNCATED DUE TO SIZE LIMIT]..."
-                        parts.append(f"--- START OF FILE: {file_path} ---\n{content}\n--- END OF FILE: {file_path} ---\n")
-                    else:
-                        print(f"Skipping {file_path} due to context limit.")
-                    
-                    # reached max_chars, stop processing further files
-                    break
-                
-                parts.append(f"--- START OF FILE: {file_path} ---\n{content}\n--- END OF FILE: {file_path} ---\n")
-                total_chars += len(content)
-                
-            except Exception as e:
-                print(f"Error reading {file_path}: {e}")
-                
-    return "\n".join(parts)
\ No newline at end of file
+            files.append((file_path, content))
+        except Exception as e:
+            print(f"Error reading {file_path}: {e}")
+
+    return "\n".join(pack_files(files, max_tokens, query, slice_min_tokens, token_counts))
\ No newline at end of file
@@ -0,0 +1,103 @@
+# agent_core/utils/workspace_pool.py
+import threading
+from collections import OrderedDict
+from django.conf import settings
+
+from .snapshots import snapshot_key
+from .workspace import setup_workspace, reset_workspace, repo_slug_from_id, mark_workspace_owner, workspace_exists
+from .reclaimer import discard_workspace
+
+
+class WorkspacePool:
+    """
+    Keeps ready workspaces per (repo, base_commit) so batch runs do not
+    materialize and delete the same tree for every task.
+
+    Idle workspaces are kept in LRU order; once more than `max_idle` are
+    idle the least recently used one is deleted.
+    """
+
+    def __init__(self, max_idle: int | None = None, factory=setup_workspace):
+        self.max_idle = max_idle
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()  # workspace path -> key
+        self._leased = {}           # workspace path -> key
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0}
+
+    def _max_idle(self) -> int:
+        if self.max_idle is not None:
+            return self.max_idle
+        return getattr(settings, 'WORKSPACE_POOL_SIZE', 4)
+
+    def lease(self, nocode_bench_id: str, base_commit: str | None = None, owner=None) -> str:
+        key = snapshot_key(repo_slug_from_id(nocode_bench_id), base_commit)
+        path = None
+        with self._lock:
+            # most recently returned workspace first: its pages are likely still cached
+            for candidate in reversed(list(self._idle)):
+                if self._idle[candidate] != key:
+                    continue
+                del self._idle[candidate]
+                # may have been deleted by the reaper in the meantime
+                if workspace_exists(candidate):
+                    path = candidate
+                    self.stats['reused'] += 1
+                    break
+
+        if path is None:
+            path = self.factory(nocode_bench_id, base_commit)
+            self.stats['created'] += 1
+        with self._lock:
+            self._leased[path] = key
+        mark_workspace_owner(path, owner)
+        return path
+
+    def release(self, workspace_path: str):
+        with self._lock:
+            key = self._leased.pop(workspace_path, None)
+
+        if key is None or self._max_idle() <= 0:
+            self._discard(workspace_path)
+            return
+
+        try:
+            reset_workspace(workspace_path)
+        except Exception as e:
+            print(f"Warning: failed to reset {workspace_path}, discarding it: {e}")
+            self._discard(workspace_path)
+            return
+
+        mark_workspace_owner(workspace_path, None)
+        evicted = []
+        with self._lock:
+            self._idle[workspace_path] = key
+            while len(self._idle) > self._max_idle():
+                path, _ = self._idle.popitem(last=False)
+                evicted.append(path)
+                self.stats['evicted'] += 1
+        for path in evicted:
+            self._discard(path)
+
+    def clear(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for path in idle:
+            self._discard(path)
+
+    def _discard(self, workspace_path: str):
+        # deletion happens in the background, off the task's critical path
+        discard_workspace(workspace_path)
+
+
+# process-wide pool shared by all tasks of a worker
+workspace_pool = WorkspacePool()
+
+
+def lease_workspace(nocode_bench_id: str, base_commit: str | None = None, owner=None) -> str:
+    return workspace_pool.lease(nocode_bench_id, base_commit, owner)
+
+
+def release_workspace(workspace_path: str):
+    workspace_pool.release(workspace_path)
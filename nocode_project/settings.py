@@ -127,4 +127,100 @@ CELERY_RESULT_SERIALIZER = 'json'
 # --- Gemini API Key ---
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 print(f"DEBUG: Gemini Key Load Status: {bool(GEMINI_API_KEY)}")
-CORS_ALLOW_ALL_ORIGINS = True
\ No newline at end of file
+CORS_ALLOW_ALL_ORIGINS = True
+
+# --- Agent workspaces ---
+# (Max idle workspaces kept per worker process for reuse; 0 disables pooling)
+WORKSPACE_POOL_SIZE = int(os.environ.get('WORKSPACE_POOL_SIZE', '4'))
+# (full: link every file | sparse: only files the agent reads or writes | overlay: edits kept in memory)
+WORKSPACE_MODE = os.environ.get('WORKSPACE_MODE', 'full')
+# (Storage tiers tried in order, "name=path:budget", e.g. "tmpfs=/dev/shm/nocode:2G";
+#  nocode_workspaces/ on disk is always the unbudgeted last tier)
+WORKSPACE_TIERS = os.environ.get('WORKSPACE_TIERS', '')
+# (Background threads deleting discarded workspaces)
+WORKSPACE_RECLAIM_WORKERS = int(os.environ.get('WORKSPACE_RECLAIM_WORKERS', '2'))
+# (Idle or unowned workspaces older than this are reclaimed by the reaper)
+WORKSPACE_STALE_SECONDS = int(os.environ.get('WORKSPACE_STALE_SECONDS', '21600'))
+
+# --- Periodic reaper for leaked workspaces / runner_* containers (needs `celery beat`) ---
+CELERY_BEAT_SCHEDULE = {
+    'reap-orphaned-resources': {
+        'task': 'agent_core.tasks.reap_orphaned_resources',
+        'schedule': int(os.environ.get('REAPER_INTERVAL_SECONDS', '900')),
+    },
+}
+
+# --- Retrieval ---
+# (Files pre-ranked by BM25 and listed, with their class/def names, to the file-finding call; 0 lists every file)
+RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', '200'))
+# (Processes parsing sources for the per-snapshot symbol index; 0 = one per CPU)
+SYMBOL_INDEX_WORKERS = int(os.environ.get('SYMBOL_INDEX_WORKERS', '0'))
+# (Import-graph neighbours added to the selected files before reading their contents)
+RETRIEVAL_NEIGHBOURS = int(os.environ.get('RETRIEVAL_NEIGHBOURS', '5'))
+# (Model-token budget for file contents in the coder prompt; files that do not fit whole are sliced)
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '50000'))
+# (Python files above this many tokens only keep full bodies of the functions the doc change names; 0 disables)
+CONTEXT_SLICE_MIN_TOKENS = int(os.environ.get('CONTEXT_SLICE_MIN_TOKENS', '8000'))
+# (Shared cache of decoded file contents + token counts per (repo, commit, path); size in bytes)
+CONTENT_CACHE_MAX_BYTES = int(os.environ.get('CONTENT_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# (Optional second level: "redis://redis:6379/1" or a directory; empty keeps it in process memory only)
+CONTENT_CACHE_BACKEND = os.environ.get('CONTENT_CACHE_BACKEND', '')
+# (Above this many candidate files, retrieval first picks directories from a tree summary of at most RETRIEVAL_SUMMARY_DIRS lines)
+RETRIEVAL_HIERARCHY_THRESHOLD = int(os.environ.get('RETRIEVAL_HIERARCHY_THRESHOLD', '5000'))
+RETRIEVAL_SUMMARY_DIRS = int(os.environ.get('RETRIEVAL_SUMMARY_DIRS', '300'))
+# (Token budget for the failed attempts summarised in a retry prompt; older ones are cut to one line)
+RETRY_HISTORY_TOKEN_BUDGET = int(os.environ.get('RETRY_HISTORY_TOKEN_BUDGET', '6000'))
+
+# --- LLM response cache ---
+# (Identical (model, config, prompt) calls are answered from cache; reruns skip the expensive calls)
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', 'True').lower() == 'true'
+LLM_CACHE_TTL_SECONDS = int(os.environ.get('LLM_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+LLM_CACHE_MEMORY_ENTRIES = int(os.environ.get('LLM_CACHE_MEMORY_ENTRIES', '256'))
+# (Second tier: "redis://redis:6379/2" or a directory such as /app/nocode_workspaces/_llm_cache; empty = memory only)
+LLM_CACHE_BACKEND = os.environ.get('LLM_CACHE_BACKEND', '')
+# (Size cap of a directory tier in bytes, oldest responses evicted first)
+LLM_CACHE_MAX_BYTES = int(os.environ.get('LLM_CACHE_MAX_BYTES', str(1024 ** 3)))
+
+# --- LLM call retries ---
+# (Attempts per call, overall deadline across retries, timeout of a single attempt)
+LLM_MAX_ATTEMPTS = int(os.environ.get('LLM_MAX_ATTEMPTS', '5'))
+LLM_DEADLINE_SECONDS = float(os.environ.get('LLM_DEADLINE_SECONDS', '600'))
+LLM_ATTEMPT_TIMEOUT_SECONDS = float(os.environ.get('LLM_ATTEMPT_TIMEOUT_SECONDS', '300'))
+# (Send a duplicate request when an attempt is slower than this latency percentile, e.g. 95; 0 disables)
+LLM_HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', '0'))
+
+# --- LLM rate limits (shared by all workers) ---
+# (Per model "name=RPM/TPM", e.g. "gemini-2.5-flash=1000/1000000,gemini-2.5-pro=150/2000000"; empty = no quota buckets)
+LLM_RATE_LIMITS = os.environ.get('LLM_RATE_LIMITS', '')
+# (Redis holding the buckets; falls back to per-process buckets when unset or unreachable)
+LLM_RATE_LIMIT_REDIS_URL = os.environ.get('LLM_RATE_LIMIT_REDIS_URL', CELERY_BROKER_URL or '')
+# (AIMD in-flight calls per model and process: start, ceiling, and latency above which the limit shrinks; 0 = ignore latency)
+LLM_CONCURRENCY_INITIAL = int(os.environ.get('LLM_CONCURRENCY_INITIAL', '4'))
+LLM_CONCURRENCY_MAX = int(os.environ.get('LLM_CONCURRENCY_MAX', '64'))
+LLM_LATENCY_TARGET_SECONDS = float(os.environ.get('LLM_LATENCY_TARGET_SECONDS', '0'))
+# (Async client: calls in flight per model and event loop, see agent_core/utils/llm_pool.py)
+LLM_ASYNC_CONCURRENCY = int(os.environ.get('LLM_ASYNC_CONCURRENCY', '16'))
+# (Stream generations and write each file as soon as its block is complete)
+LLM_STREAMING = os.environ.get('LLM_STREAMING', 'True').lower() == 'true'
+# (How the coder model returns changes: 'search_replace' hunks per file, or 'whole' file contents)
+LLM_EDIT_FORMAT = os.environ.get('LLM_EDIT_FORMAT', 'search_replace')
+# (Multi-file changes: one planning call, then each file's edits generated concurrently)
+LLM_PARALLEL_EDITS = os.environ.get('LLM_PARALLEL_EDITS', 'False').lower() == 'true'
+# (Candidates sampled per attempt; above 1 they are generated, deduplicated and tested in parallel, first passing one wins)
+LLM_CANDIDATES = int(os.environ.get('LLM_CANDIDATES', '1'))
+LLM_CANDIDATE_TEMPERATURE = float(os.environ.get('LLM_CANDIDATE_TEMPERATURE', '1.0'))
+
+# --- Model cascade ---
+# (Models per stage, cheapest first: the next one is only used when the previous fails)
+LLM_CASCADE_RETRIEVAL = os.environ.get('LLM_CASCADE_RETRIEVAL', 'gemini-2.5-flash,gemini-2.5-pro')
+LLM_CASCADE_CODER = os.environ.get('LLM_CASCADE_CODER', 'gemini-2.5-flash,gemini-2.5-pro')
+# (Skip a cheap coder model on a repo once it has this many attempts there with a lower pass rate)
+LLM_CASCADE_MIN_SAMPLES = int(os.environ.get('LLM_CASCADE_MIN_SAMPLES', '5'))
+LLM_CASCADE_MIN_SUCCESS = float(os.environ.get('LLM_CASCADE_MIN_SUCCESS', '0.3'))
+
+# --- Provider context cache ---
+# (Stable prompt prefixes (instructions + file contents) that will be sent again (retries, candidates, parallel edits) registered as cached content: 'gemini', 'local' (in-process stand-in), or empty = off)
+LLM_CONTEXT_CACHE = os.environ.get('LLM_CONTEXT_CACHE', 'gemini')
+# (Lifetime of a cached prefix; it is extended while in use. Smaller prefixes are sent inline)
+LLM_CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get('LLM_CONTEXT_CACHE_TTL_SECONDS', '3600'))
+LLM_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get('LLM_CONTEXT_CACHE_MIN_TOKENS', '4096'))